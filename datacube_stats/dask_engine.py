@@ -0,0 +1,213 @@
+"""
+Run the chunks of a task as a dask graph, on a local dask scheduler or on a ``distributed`` cluster.
+
+Each chunk becomes three nodes of the graph: loading its masked sources, computing the statistics on them
+and writing the results out. A local scheduler runs as many chunks at once as the memory budget was planned
+for, and a ``distributed`` cluster spills data it has no memory for to disk.
+
+``dask`` and ``distributed`` are optional dependencies (the ``dask`` extra), only imported when the graph is run.
+
+Statistics declaring :meth:`Statistic.is_blockwise` are computed chunk by chunk, the others on one block
+covering the whole task, run on its own after the chunks.
+"""
+import atexit
+import copy
+import logging
+from collections import OrderedDict
+from functools import partial
+
+from datacube_stats.main import EmptyChunkException, SerialisedOutput, covered_chunks, bytes_per_pixel
+from datacube_stats.main import load_chunk, compute_chunk, compute_chunk_iteratively, save_chunk_iteratively
+from datacube_stats.utils import parse_memory_size
+from datacube_stats.utils.checkpoint import chunk_key
+from datacube_stats.utils.timer import MultiTimer
+
+_LOG = logging.getLogger(__name__)
+
+#: schedulers running the graph in the current process
+LOCAL_SCHEDULERS = ('threads', 'synchronous')
+
+# one client per scheduler address, shared by the tasks run by this process
+_CLIENTS = {}
+
+
+def dask_chunk_size() -> int:
+    """ Memory to size chunks for, from the ``array.chunk-size`` dask configuration option. """
+    import dask
+
+    return parse_memory_size(dask.config.get('array.chunk-size'))
+
+
+def get_client(scheduler):
+    """
+    The ``distributed`` client to run the graph with, or `None` for the local schedulers.
+
+    :param str scheduler: one of :data:`LOCAL_SCHEDULERS`, ``processes`` for a cluster of local
+                          worker processes, or the address of a ``distributed`` scheduler
+    """
+    if scheduler is None or scheduler in LOCAL_SCHEDULERS:
+        return None
+
+    if scheduler not in _CLIENTS:
+        from distributed import Client
+
+        if scheduler == 'processes':
+            _CLIENTS[scheduler] = Client(processes=True, set_as_default=False)
+        else:
+            _CLIENTS[scheduler] = Client(scheduler, set_as_default=False)
+
+    return _CLIENTS[scheduler]
+
+
+def close_clients():
+    """ Close the clients of :func:`get_client`, along with the local clusters they started. """
+    while _CLIENTS:
+        scheduler, client = _CLIENTS.popitem()
+        try:
+            client.close()
+        except Exception as e:  # pylint: disable=broad-except
+            _LOG.warning('Error closing the dask client of %s: %s', scheduler, e)
+
+
+atexit.register(close_clients)
+
+
+def split_statistics(task):
+    """ Copies of `task` with only its blockwise-safe statistics, and with only the others. """
+    def with_statistics(blockwise):
+        sub_task = copy.copy(task)
+        sub_task.output_products = OrderedDict((name, stat) for name, stat in task.output_products.items()
+                                               if stat.is_blockwise() == blockwise)
+        return sub_task
+
+    return with_statistics(True), with_statistics(False)
+
+
+def task_graph(task, chunks, prefetch=0, io_threads=0, native_dtypes=False, written_chunks=None,
+               iterative_checkpoint=None, memory_budget=None):
+    """
+    Delayed `(chunk, prod_names, results, timer)` for each block of `task`: a list with each of the
+    `(chunk, geom_mask)` pairs in `chunks` for its blockwise-safe statistics, and a list with the whole task
+    for the others.
+
+    :param written_chunks: optionally, returns the keys of the chunks already written for `prod_names`,
+                           which are left out, given `prod_names`
+    :param iterative_checkpoint: optionally, returns the :class:`IterativeCheckpoint` of the iterative
+                                 statistics `prod_names` computing `chunk`, given `(chunk, prod_names)`
+    :param memory_budget: bytes of memory the chunks were sized for, to warn about the whole task not fitting
+    """
+    from dask import delayed
+
+    blockwise_task, whole_task = split_statistics(task)
+
+    whole_tile = dict(zip(task.sample_tile.dims[1:], task.sample_tile.shape[1:]))
+    if whole_task.output_products and memory_budget is not None:
+        whole_bytes = task.sample_tile.shape[1] * task.sample_tile.shape[2] * \
+            bytes_per_pixel(whole_task, prefetch=prefetch, native_dtypes=native_dtypes)
+        if whole_bytes > memory_budget:
+            _LOG.warning('%s of %s are not blockwise-safe and are computed on the whole tile at once, needing '
+                         'about %d bytes, more than the memory budget of %d bytes',
+                         list(whole_task.output_products), task.spatial_id, whole_bytes, memory_budget)
+
+    chunk_blocks, whole_task_blocks = [], []
+    for sub_task, sub_chunks, blocks in [(blockwise_task, chunks, chunk_blocks),
+                                         (whole_task, None, whole_task_blocks)]:
+        if not sub_task.output_products:
+            continue
+
+        if sub_chunks is None:
+            sub_chunks = covered_chunks(sub_task, whole_tile)
+
+        prod_names = list(sub_task.output_products)
+        written = set() if written_chunks is None else written_chunks(prod_names)
+        sub_task = delayed(sub_task, traverse=False)
+        for chunk, geom_mask in sub_chunks:
+            if chunk_key(chunk) in written:
+                continue
+            if task.is_iterative:
+                checkpoint = None if iterative_checkpoint is None else iterative_checkpoint(chunk, prod_names)
+                blocks.append(delayed(_compute_iteratively, pure=False)(chunk, geom_mask, sub_task,
+                                                                        prefetch, native_dtypes, checkpoint))
+            else:
+                loaded = delayed(_load, pure=False)(chunk, geom_mask, sub_task, io_threads)
+                blocks.append(delayed(_compute, pure=False)(loaded, chunk, sub_task, native_dtypes))
+
+    return chunk_blocks, whole_task_blocks
+
+
+def run_task_graph(output_files, chunks, task, timer, scheduler=None, workers=0, checkpoint_every=0, **kwargs):
+    """
+    Load, compute and save the `(chunk, geom_mask)` pairs in `chunks` with the graph of :func:`task_graph`.
+
+    On a local scheduler, writing the results of each chunk is part of the graph, one write at a time.
+    Only `workers` chunks are in flight at once, as planned for the memory budget, and the whole task block
+    of the statistics that are not blockwise-safe is run on its own after them.
+    On a ``distributed`` cluster, the results are written by this process as each chunk is finished.
+
+    :param int workers: number of threads or processes of a local scheduler, by default one
+    :param int checkpoint_every: number of time slices after which iterative statistics save their state,
+                                 if `output_files` is checkpointing
+    """
+    import dask
+    from dask import delayed
+
+    if checkpoint_every:
+        kwargs['iterative_checkpoint'] = partial(output_files.iterative_checkpoint, every=checkpoint_every)
+
+    chunk_blocks, whole_task_blocks = task_graph(task, chunks, written_chunks=output_files.written_chunks, **kwargs)
+    client = get_client(scheduler)
+
+    if client is None:
+        output_files = SerialisedOutput(output_files)
+
+        def compute(blocks, num_workers):
+            writes = [delayed(_write, pure=False)(output_files, block, task.is_iterative) for block in blocks]
+            return dask.compute(*writes, scheduler=scheduler or 'threads', num_workers=num_workers)
+
+        block_timers = compute(chunk_blocks, max(workers, 1)) + compute(whole_task_blocks, 1)
+    else:
+        from distributed import as_completed
+
+        block_timers = [_write(output_files, block, task.is_iterative)
+                        for _, block in as_completed(client.compute(chunk_blocks + whole_task_blocks),
+                                                     with_results=True)]
+
+    for block_timer in block_timers:
+        timer.merge(block_timer)
+
+
+def _load(chunk, geom_mask, task, io_threads):
+    timer = MultiTimer()
+    try:
+        return load_chunk(chunk, task, timer, geom_mask=geom_mask, io_threads=io_threads), timer
+    except EmptyChunkException:
+        _LOG.debug('Error: No data returned while loading %s for %s. May have all been masked', chunk, task)
+        return None, timer
+
+
+def _compute(loaded, chunk, task, native_dtypes):
+    data, timer = loaded
+    if data is None:
+        return chunk, list(task.output_products), [], timer
+
+    return (chunk, list(task.output_products),
+            list(compute_chunk(data, chunk, task, timer, native_dtypes=native_dtypes)), timer)
+
+
+def _compute_iteratively(chunk, geom_mask, task, prefetch, native_dtypes, checkpoint):
+    timer = MultiTimer()
+    return chunk, list(task.output_products), \
+        compute_chunk_iteratively(chunk, task, timer, geom_mask=geom_mask, prefetch=prefetch,
+                                  native_dtypes=native_dtypes, checkpoint=checkpoint), timer
+
+
+def _write(output_files, block, iterative):
+    chunk, prod_names, results, timer = block
+    with timer.time('writing_data'):
+        if iterative:
+            save_chunk_iteratively(output_files, chunk, results)
+        else:
+            for prod_name, result in results:
+                output_files.write_chunk(prod_name, chunk, result)
+        output_files.mark_chunk_written(chunk, prod_names)
+    return timer
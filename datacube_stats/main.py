@@ -7,14 +7,19 @@ This command is run as ``datacube-stats``, all operation are driven by a configu
 import copy
 import logging
 import sys
+import threading
 
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import partial
+from importlib import import_module
 from itertools import islice
 from textwrap import dedent
 from pathlib import Path
 from datetime import datetime
-from typing import Dict, Iterable, Iterator, Tuple
-from os import path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from os import path, cpu_count
 
 import click
 import numpy as np
@@ -25,20 +30,26 @@ import xarray
 from dateutil import tz
 import datacube
 import datacube_stats
-from datacube.api import GridWorkflow
+from datacube import Datacube
+from datacube.api import GridWorkflow, Tile
 from datacube.storage.masking import make_mask
 from datacube.ui import click as ui
 from datacube.utils import read_documents, import_function
-from datacube.utils.geometry import Geometry, GeoBox
+from datacube.utils.geometry import Geometry, GeoBox, unary_union
 from datacube_stats.models import OutputProduct
 from datacube_stats.output_drivers import OUTPUT_DRIVERS, OutputFileAlreadyExists, get_driver_by_name, \
     NoSuchOutputDriver, OutputDriver, OutputDriverResult
 from datacube_stats.statistics import StatsConfigurationError, STATS
-from datacube_stats.utils import cast_back, pickle_stream, unpickle_stream, _find_periods_with_data
+from datacube_stats.utils import cast_back, _find_periods_with_data
 from datacube_stats.utils import tile_iter, sensible_mask_invalid_data, sensible_where, sensible_where_inplace
+from datacube_stats.utils import ds_completely_invalid, parse_memory_size
 from datacube_stats.utils.dates import date_sequence
 from datacube_stats.utils.timer import MultiTimer, wrap_in_timer
-from datacube_stats.utils import sorted_interleave, Slice, prettier_slice
+from datacube_stats.utils.checkpoint import IterativeCheckpoint, chunk_key
+from datacube_stats.utils.process_runner import ProcessPoolRunner
+from datacube_stats.utils.query_cache import CachedIndex, DatasetQueryCache
+from datacube_stats.utils.task_file import save_tasks, read_tasks
+from datacube_stats.utils import sorted_interleave, prefetch_map, balanced_shards, Slice, prettier_slice
 from datacube_stats.tasks import select_task_generator
 from datacube_stats.schema import stats_schema
 from datacube_stats.models import StatsTask, DataSource
@@ -120,6 +131,9 @@ def with_or_without_qsub_runner():
                 metavar='STATS_CONFIG_FILE')
 @click.option('--save-tasks', type=click.Path(exists=False, writable=True, dir_okay=False))
 @click.option('--load-tasks', type=click.Path(exists=True, readable=True))
+@click.option('--embed-documents/--no-embed-documents', default=True,
+              help='Whether to store dataset documents in the file written by --save-tasks. '
+                   'Without them, loading the tasks looks the datasets up in the index.')
 @click.option('--tile-index', nargs=2, type=int, help='Override input_region specified in configuration with a '
                                                       'single tile_index specified as [X] [Y]')
 @click.option('--tile-index-file',
@@ -131,23 +145,44 @@ def with_or_without_qsub_runner():
               help="The subset of tasks to perform, using Python's slice syntax.")
 @click.option('--batch', type=int,
               help="The number of batch jobs to launch using PBS and the serial executor.")
+@click.option('--balanced-batch', is_flag=True,
+              help="With --batch, generate the tasks up front and give each job a task file "
+                   "of about the same estimated cost, instead of every N-th task.")
+@click.option('--executor', type=click.Choice(['default', 'processes']), default='default',
+              help="Run tasks with the digitalearthau runner (the default), or on a pool of local processes.")
+@click.option('--workers', type=click.IntRange(min=1),
+              help="With --executor processes, the number of worker processes (default: one per CPU).")
+@click.option('--tasks-per-worker', type=click.IntRange(min=0), default=10, show_default=True,
+              help="With --executor processes, the number of tasks each worker process runs before being "
+                   "replaced with a fresh one (0 to never replace them).")
 @click.option('--list-statistics', is_flag=True, callback=list_statistics, expose_value=False)
 @ui.global_cli_options
 @with_or_without_qsub_runner()
 @click.option('--version', is_flag=True, callback=_print_version,
               expose_value=False, is_eager=True)
 @ui.pass_index(app_name='datacube-stats')
-def main(index, stats_config_file, qsub, runner, save_tasks, load_tasks,
-         tile_index, tile_index_file, output_location, year, task_slice, batch):
+def main(index, stats_config_file, save_tasks, load_tasks, embed_documents,
+         tile_index, tile_index_file, output_location, year, task_slice, batch, balanced_batch,
+         executor, workers, tasks_per_worker, qsub=None, runner=None):
 
     try:
         _log_setup()
 
         if qsub is not None and batch is not None:
+            task_files = None
+            if balanced_batch:
+                config = normalize_config(read_config(stats_config_file),
+                                          tile_index, tile_index_file, year, output_location)
+                app = StatsApp(config, index)
+                task_files = app.save_balanced_task_files(index, batch, embed_documents=embed_documents)
+
             for i in range(batch):
                 child = qsub.clone()
                 child.reset_internal_args()
-                child.add_internal_args('--task-slice', '{}::{}'.format(i, batch))
+                if task_files is None:
+                    child.add_internal_args('--task-slice', '{}::{}'.format(i, batch))
+                else:
+                    child.add_internal_args('--load-tasks', task_files[i])
                 click.echo(repr(child))
                 exit_code, _ = child(auto=True, auto_clean=[('--batch', 1)])
                 if exit_code != 0:
@@ -169,14 +204,19 @@ def main(index, stats_config_file, qsub, runner, save_tasks, load_tasks,
         app.log_config()
 
         if save_tasks is not None:
-            app.save_tasks_to_file(save_tasks, index)
+            app.save_tasks_to_file(save_tasks, index, embed_documents=embed_documents)
             failed = 0
         else:
             if load_tasks is not None:
-                tasks = unpickle_stream(load_tasks)
+                # only the tasks in the slice are read from the file
+                tasks = read_tasks(load_tasks, index=index, task_slice=task_slice)
+                task_slice = None
             else:
                 tasks = app.generate_tasks(index)
 
+            if executor == 'processes':
+                runner = ProcessPoolRunner(workers, tasks_per_worker=tasks_per_worker)
+
             successful, failed = app.run_tasks(tasks, runner, task_slice)
 
         timer.pause('main')
@@ -275,13 +315,19 @@ class StatsApp:  # pylint: disable=too-many-instance-attributes
         #: Define filter product to accept all derive product attributes
         self.filter_product = config['filter_product']
 
-        #: An iterable of date ranges.
-        self.date_ranges = _configure_date_ranges(config, index=index)
+        #: Whether (or where) to cache dataset searches made while generating tasks.
+        self.query_cache = config.get('query_cache', False)
 
         #: Generates tasks to compute statistics. These tasks should be :class:`StatsTask` objects
         #: and will define spatial and temporal boundaries, as well as statistical operations to be run.
         self.task_generator = select_task_generator(config['input_region'],
-                                                    self.storage, self.filter_product)
+                                                    self.storage, self.filter_product,
+                                                    **config.get('task_generation', {}))
+
+        #: An iterable of date ranges.
+        self.date_ranges = _configure_date_ranges(config, index=index,
+                                                  task_generator=self.task_generator,
+                                                  cache=self._query_cache())
 
         #: A class which knows how to create and write out data to a permanent storage format.
         #: Implements :class:`.output_drivers.OutputDriver`.
@@ -296,6 +342,7 @@ class StatsApp:  # pylint: disable=too-many-instance-attributes
         """Check StatsApp is correctly configured and raise an error if errors are found."""
         self._ensure_unique_output_product_names()
         self._check_consistent_measurements()
+        self._check_engine_available()
 
         assert callable(self.task_generator)
         assert callable(self.output_driver)
@@ -314,6 +361,21 @@ class StatsApp:  # pylint: disable=too-many-instance-attributes
             raise StatsConfigurationError("Configuration Error: listed measurements of source products "
                                           "are not all the same.")
 
+    def _check_engine_available(self):
+        """Part of configuration validation"""
+        if self.computation.get('engine', 'default') != 'dask':
+            return
+
+        from datacube_stats.dask_engine import LOCAL_SCHEDULERS
+        scheduler = self.computation.get('scheduler')
+        required = ['dask'] if scheduler is None or scheduler in LOCAL_SCHEDULERS else ['dask', 'distributed']
+        try:
+            for module in required:
+                import_module(module)
+        except ImportError as e:
+            raise StatsConfigurationError('The dask engine needs {} installed, eg. with the dask extra: '
+                                          'pip install datacube-stats[dask] ({})'.format(' and '.join(required), e))
+
     def _ensure_unique_output_product_names(self):
         """Part of configuration validation"""
         output_names = [prod['name'] for prod in self.output_product_specs]
@@ -336,7 +398,23 @@ class StatsApp:  # pylint: disable=too-many-instance-attributes
                        app_info=app_info,
                        storage=self.storage,
                        global_attributes=self.global_attributes,
-                       var_attributes=self.var_attributes)
+                       var_attributes=self.var_attributes,
+                       checkpoint=self.computation.get('checkpoint', False))
+
+    def _computation_options(self):
+        """ Options from the `computation` section of the configuration, for :func:`execute_task`. """
+        return dict(chunking=self.computation.get('chunking', {}),
+                    prefetch=self.computation.get('prefetch', 0),
+                    io_threads=self.computation.get('io_threads', 0),
+                    native_dtypes=self.computation.get('native_dtypes', False),
+                    memory_budget=(parse_memory_size(self.computation['memory_budget'])
+                                   if 'memory_budget' in self.computation else None),
+                    chunk_workers=self.computation.get('chunk_workers', 0),
+                    pipeline=self.computation.get('pipeline', False),
+                    engine=self.computation.get('engine', 'default'),
+                    scheduler=self.computation.get('scheduler'),
+                    checkpoint_every=(self.computation.get('checkpoint_every', 0)
+                                      if self.computation.get('checkpoint', False) else 0))
 
     def execute_task(self, task):
         """
@@ -346,23 +424,34 @@ class StatsApp:  # pylint: disable=too-many-instance-attributes
         try:
             execute_task(task,
                          output_driver=self._partially_applied_output_driver(),
-                         chunking=self.computation.get('chunking', {}))
+                         **self._computation_options())
 
             _LOG.debug('task %s finished', task)
         except OutputDriverResult as e:
             return e
 
     def run_tasks(self, tasks, runner=None, task_slice=None):
-        from digitalearthau.qsub import TaskRunner
-        from digitalearthau.runners.model import TaskDescription, DefaultJobParameters
+        """
+        Run the tasks, with a digitalearthau task runner or a :class:`ProcessPoolRunner`.
 
+        :return: the number of tasks run successfully, and the number that failed
+        """
         if task_slice is not None:
             tasks = islice(tasks, task_slice.start, task_slice.stop, task_slice.step)
 
         output_driver = self._partially_applied_output_driver()
         task_runner = partial(execute_task,
                               output_driver=output_driver,
-                              chunking=self.computation.get('chunking', {}))
+                              **self._computation_options())
+
+        if isinstance(runner, ProcessPoolRunner):
+            return runner(tasks, task_runner)
+
+        return self._run_tasks_with_digitalearthau(tasks, task_runner, runner)
+
+    def _run_tasks_with_digitalearthau(self, tasks, task_runner, runner=None):
+        from digitalearthau.qsub import TaskRunner
+        from digitalearthau.runners.model import TaskDescription, DefaultJobParameters
 
         # does not need to be thorough for now
         task_desc = TaskDescription(type_='datacube_stats',
@@ -389,14 +478,39 @@ class StatsApp:  # pylint: disable=too-many-instance-attributes
 
         return result
 
-    def save_tasks_to_file(self, filename, index):
+    def save_tasks_to_file(self, filename, index, embed_documents=True):
         _LOG.debug('Saving tasks to %s.', filename)
         output_products = self.configure_outputs(index)
 
         tasks = self.generate_tasks(index, output_products)
-        num_saved = pickle_stream(tasks, filename)
+        num_saved = save_tasks(tasks, filename, embed_documents=embed_documents)
         _LOG.debug('Successfully saved %s tasks to %s.', num_saved, filename)
 
+    def save_balanced_task_files(self, index, num_shards, embed_documents=True) -> List[str]:
+        """
+        Generate all the tasks and split them into `num_shards` task files of about the same estimated cost.
+
+        :return: the task file names, in the `tasks` directory of the output location
+        """
+        tasks = list(self.generate_tasks(index))
+        options = self._computation_options()
+        costs = [estimate_task_cost(task, options['chunking'], prefetch=options['prefetch'],
+                                    native_dtypes=options['native_dtypes'], memory_budget=options['memory_budget'])
+                 for task in tasks]
+
+        tasks_path = Path(self.location) / 'tasks'
+        tasks_path.mkdir(parents=True, exist_ok=True)
+
+        filenames = []
+        for shard_index, shard in enumerate(balanced_shards(costs, num_shards)):
+            filename = str(tasks_path / 'batch_{}_of_{}.tasks'.format(shard_index, num_shards))
+            save_tasks((tasks[position] for position in shard), filename, embed_documents=embed_documents)
+            _LOG.info('Saved %s tasks with an estimated cost of %.0f to %s.',
+                      len(shard), sum(costs[position] for position in shard), filename)
+            filenames.append(filename)
+
+        return filenames
+
     def generate_tasks(self, index,
                        output_products: Dict[str, OutputProduct] = None,
                        metadata_type='eo') -> Iterator[StatsTask]:
@@ -424,12 +538,28 @@ class StatsApp:  # pylint: disable=too-many-instance-attributes
 
         is_iterative = all(op.is_iterative() for op in output_products.values())
 
+        if self.query_cache:
+            index = CachedIndex(index, self._query_cache())
+
         for task in self.task_generator(index=index, date_ranges=self.date_ranges,
                                         sources_spec=self.sources):
             task.output_products = output_products
             task.is_iterative = is_iterative
             yield task
 
+    def _query_cache(self):
+        if not self.query_cache:
+            return None
+        return DatasetQueryCache(self._query_cache_path())
+
+    def _query_cache_path(self):
+        if isinstance(self.query_cache, str):
+            return Path(self.query_cache)
+
+        location = Path(self.location)
+        location.mkdir(parents=True, exist_ok=True)
+        return location / 'query_cache.sqlite'
+
     def configure_outputs(self, index, metadata_type='eo') -> Dict[str, OutputProduct]:
         """
         Return dict mapping Output Product Name<->Output Product
@@ -488,25 +618,76 @@ def geometry_mask(geoms: Iterable[Geometry], geobox: GeoBox,
                                            invert=invert)
 
 
-def execute_task(task: StatsTask, output_driver, chunking) -> StatsTask:
+def execute_task(task: StatsTask, output_driver, chunking, prefetch=0, io_threads=0,
+                 native_dtypes=False, memory_budget=None, chunk_workers=0, pipeline=False,
+                 engine='default', scheduler=None, checkpoint_every=0) -> StatsTask:
     """
     Load data, run the statistical operations and write results out to the filesystem.
 
     :param datacube_stats.models.StatsTask task:
     :type output_driver: OutputDriver
     :param chunking: dict of dimension sizes to chunk the computation by
+    :param prefetch: number of time slices to load ahead in the background, for iterative statistics
+    :param io_threads: number of threads reading data in parallel, for statistics loading all of a chunk at once
+    :param native_dtypes: keep integer data in its own type, with `nodata` marking masked out pixels
+    :param memory_budget: bytes of memory to size chunks for, instead of `chunking`
+    :param chunk_workers: number of threads loading and computing chunks in parallel, with `memory_budget`
+                          shared between them. With the ``dask`` engine on a local scheduler, one per CPU by default
+    :param pipeline: overlap the loading, computing and writing of consecutive chunks, see :func:`pipeline_chunks`
+    :param engine: ``dask`` to run the chunks as a dask graph, see :mod:`datacube_stats.dask_engine`
+    :param scheduler: dask scheduler to run the graph on, with the ``dask`` engine
+    :param checkpoint_every: number of time slices after which iterative statistics save their state,
+                             if `output_driver` is checkpointing
     """
     timer = MultiTimer().start('total')
 
     process_chunk = load_process_save_chunk_iteratively if task.is_iterative else load_process_save_chunk
 
+    if native_dtypes:
+        task = copy.copy(task)
+        task.sources = native_dtype_sources(task.sources)
+
+    if engine == 'dask':
+        from datacube_stats.dask_engine import run_task_graph, dask_chunk_size, LOCAL_SCHEDULERS
+
+        if not chunk_workers and (scheduler is None or scheduler in LOCAL_SCHEDULERS):
+            # as many chunks at once as dask has threads by default
+            chunk_workers = cpu_count() or 1
+
+        if not chunking and memory_budget is None:
+            # chunks the size of dask arrays
+            memory_budget = dask_chunk_size() * max(chunk_workers, 1)
+
+    if memory_budget is not None:
+        # chunks held in memory at once
+        concurrent_chunks = chunk_workers if chunk_workers > 1 else 2 if pipeline else 1
+        chunking = plan_chunking(task, memory_budget / concurrent_chunks,
+                                 prefetch=prefetch, native_dtypes=native_dtypes)
+        _LOG.debug('Chunking %s for a memory budget of %s bytes: %s', task.spatial_id, memory_budget, chunking)
+
     try:
         with output_driver(task=task) as output_files:
             # currently for polygons process will load entirely
             if len(chunking) == 0:
                 chunking = {'x': task.sample_tile.shape[2], 'y': task.sample_tile.shape[1]}
-            for sub_tile_slice in tile_iter(task.sample_tile, chunking):
-                process_chunk(output_files, sub_tile_slice, task, timer)
+            chunks = list(covered_chunks(task, chunking))
+
+            written = output_files.written_chunks()
+            if written:
+                chunks = [(chunk, geom_mask) for chunk, geom_mask in chunks if chunk_key(chunk) not in written]
+                _LOG.info('Resuming %s: %d chunks already written, %d to go', task.spatial_id, len(written),
+                          len(chunks))
+
+            workers = plan_chunk_workers(task, chunking, chunk_workers, len(chunks), memory_budget,
+                                         prefetch=prefetch, native_dtypes=native_dtypes)
+            if engine == 'dask':
+                run_task_graph(output_files, chunks, task, timer, scheduler=scheduler, workers=workers,
+                               prefetch=prefetch, io_threads=io_threads, native_dtypes=native_dtypes,
+                               checkpoint_every=checkpoint_every, memory_budget=memory_budget)
+            else:
+                process_chunks(process_chunk, output_files, chunks, task, timer, workers=workers,
+                               pipeline=pipeline, prefetch=prefetch, io_threads=io_threads,
+                               native_dtypes=native_dtypes, checkpoint_every=checkpoint_every)
     except OutputFileAlreadyExists as e:
         _LOG.warning(str(e))
     except OutputDriverResult as e:
@@ -523,28 +704,319 @@ def execute_task(task: StatsTask, output_driver, chunking) -> StatsTask:
     return task
 
 
+def covered_chunks(task: StatsTask, chunking) -> Iterator[Tuple[Tuple[slice, slice, slice], Optional[np.ndarray]]]:
+    """
+    The chunks of `task` that any data source and the feature polygon (if any) cover, with the feature mask
+    of each. The other chunks are left as nodata in the output.
+    """
+    coverage = task_coverage(task)
+    feature_mask = task_feature_mask(task)
+    for sub_tile_slice in tile_iter(task.sample_tile, chunking):
+        geom_mask = None if feature_mask is None else feature_mask[sub_tile_slice[1:]]
+        if not chunk_is_covered(task, sub_tile_slice, coverage) or \
+                (geom_mask is not None and not geom_mask.any()):
+            _LOG.debug('Skipping chunk %s of %s: no data sources or feature polygon cover it',
+                       "({})".format(", ".join(prettier_slice(c) for c in sub_tile_slice)), task.spatial_id)
+            continue
+        yield sub_tile_slice, geom_mask
+
+
+def process_chunks(process_chunk, output_files: OutputDriver, chunks, task: StatsTask, timer: MultiTimer,
+                   workers=0, pipeline=False, **kwargs):
+    """
+    Load, compute and save each of the `(chunk, geom_mask)` pairs in `chunks` with `process_chunk`.
+
+    With more than one worker, chunks are loaded and computed on that many threads at once, while their
+    results are written to `output_files` by one thread at a time. Otherwise, with `pipeline`, they go
+    through :func:`pipeline_chunks`.
+    """
+    if workers <= 1 and pipeline:
+        pipeline_chunks(output_files, chunks, task, timer, **kwargs)
+        return
+
+    if workers <= 1:
+        for chunk, geom_mask in chunks:
+            process_chunk(output_files, chunk, task, timer, geom_mask=geom_mask, **kwargs)
+        return
+
+    output_files = SerialisedOutput(output_files)
+    timer_lock = threading.Lock()
+
+    def process(chunk_and_mask):
+        chunk, geom_mask = chunk_and_mask
+        chunk_timer = MultiTimer()
+        process_chunk(output_files, chunk, task, chunk_timer, geom_mask=geom_mask, **kwargs)
+        with timer_lock:
+            timer.merge(chunk_timer)
+
+    for _ in prefetch_map(process, chunks, prefetch=workers, ordered=False):
+        pass
+
+
+def pipeline_chunks(output_files: OutputDriver, chunks, task: StatsTask, timer: MultiTimer,
+                    prefetch=0, io_threads=0, native_dtypes=False, checkpoint_every=0):
+    """
+    Load, compute and save the `(chunk, geom_mask)` pairs in `chunks` as a pipeline of three stages, each
+    on its own thread: the next chunk is loaded while the current one is computed and the previous one
+    is written. Each stage waits for the next one to take its last chunk, so at most two chunks of data
+    and one chunk of results are held at once.
+
+    Iterative statistics load their time slices while computing, so only their writing is overlapped.
+    """
+    load_timer, write_timer = MultiTimer(), MultiTimer()
+
+    def load(chunk_and_mask):
+        chunk, geom_mask = chunk_and_mask
+        if task.is_iterative:
+            return chunk, geom_mask, None
+
+        try:
+            return chunk, geom_mask, load_chunk(chunk, task, load_timer, geom_mask=geom_mask, io_threads=io_threads)
+        except EmptyChunkException:
+            _LOG.debug('Error: No data returned while loading %s for %s. May have all been masked',
+                       chunk, task)
+            return chunk, geom_mask, None
+
+    def save(chunk, results):
+        with write_timer.time('writing_data'):
+            if task.is_iterative:
+                save_chunk_iteratively(output_files, chunk, results)
+            else:
+                for prod_name, result in results:
+                    output_files.write_chunk(prod_name, chunk, result)
+            output_files.mark_chunk_written(chunk, task.output_products)
+
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        writing = None
+        for chunk, geom_mask, data in prefetch_map(load, chunks, prefetch=1):
+            if task.is_iterative:
+                checkpoint = (output_files.iterative_checkpoint(chunk, task.output_products, checkpoint_every)
+                              if checkpoint_every else None)
+                results = compute_chunk_iteratively(chunk, task, timer, geom_mask=geom_mask, prefetch=prefetch,
+                                                    native_dtypes=native_dtypes, checkpoint=checkpoint)
+            elif data is None:
+                # all masked out, nothing to write
+                results = []
+            else:
+                results = list(compute_chunk(data, chunk, task, timer, native_dtypes=native_dtypes))
+            del data
+
+            if writing is not None:
+                writing.result()
+            writing = writer.submit(save, chunk, results)
+
+        if writing is not None:
+            writing.result()
+
+    timer.merge(load_timer).merge(write_timer)
+
+
+class SerialisedOutput:
+    """ Passes writes on to an :class:`OutputDriver` from one thread at a time. """
+
+    def __init__(self, output_files: OutputDriver):
+        self._output_files = output_files
+        self._lock = threading.Lock()
+
+    def write_chunk(self, prod_name, chunk, result):
+        with self._lock:
+            self._output_files.write_chunk(prod_name, chunk, result)
+
+    def write_data(self, prod_name, measurement_name, chunk, values):
+        with self._lock:
+            self._output_files.write_data(prod_name, measurement_name, chunk, values)
+
+    def mark_chunk_written(self, chunk, prod_names):
+        with self._lock:
+            self._output_files.mark_chunk_written(chunk, prod_names)
+
+    def __getattr__(self, name):
+        return getattr(self._output_files, name)
+
+
+def plan_chunk_workers(task: StatsTask, chunking, chunk_workers, num_chunks, memory_budget=None,
+                       prefetch=0, native_dtypes=False) -> int:
+    """
+    Number of threads to process the chunks of `task` with: no more than `chunk_workers`, or than there
+    are chunks, and with a `memory_budget`, no more than the chunks that fit into it at once.
+    """
+    workers = min(chunk_workers, num_chunks)
+    if memory_budget is None or workers <= 1:
+        return workers
+
+    y_dim, x_dim = task.sample_tile.dims[1:]
+    height, width = task.sample_tile.shape[1:]
+    chunk_pixels = min(chunking.get(y_dim, height), height) * min(chunking.get(x_dim, width), width)
+    chunk_bytes = chunk_pixels * bytes_per_pixel(task, prefetch=prefetch, native_dtypes=native_dtypes)
+    if chunk_bytes == 0:
+        return workers
+
+    return max(1, min(workers, int(memory_budget // chunk_bytes)))
+
+
+def bytes_per_pixel(task: StatsTask, prefetch=0, native_dtypes=False) -> float:
+    """
+    Estimated memory needed per pixel to load and compute a chunk of `task`.
+
+    This is estimated from the time slices, bands and loaded data types of each source (for iterative
+    statistics, only the time slices held at once), times one plus the largest memory multiplier of the
+    statistics being computed.
+    """
+    stats = list(task.output_products.values())
+    num_observations = 0
+    pixel_bytes = 0
+    float_bytes_per_pixel = 0
+
+    for source_prod in task.sources:
+        tile = source_prod.data
+        num_times = tile.shape[0]
+        if num_times == 0:
+            continue
+
+        if task.is_iterative:
+            # see `load_data_lazy`
+            num_times = min(num_times, prefetch + 2)
+
+        dtypes = _loaded_dtypes(source_prod, tile).values()
+        num_observations += num_times
+        pixel_bytes += num_times * sum(dtype.itemsize for dtype in dtypes)
+        float_bytes_per_pixel += num_times * sum(np.result_type(dtype, np.float32).itemsize for dtype in dtypes)
+
+    if task.is_iterative:
+        num_observations = 1
+
+    multiplier = max((stat.memory_multiplier(num_observations) for stat in stats), default=1.0)
+    pixel_bytes *= 1 + multiplier
+    if native_dtypes and not all(stat.supports_native_dtypes() for stat in stats):
+        # see `load_process_save_chunk`
+        pixel_bytes += float_bytes_per_pixel
+
+    return pixel_bytes
+
+
+def plan_chunking(task: StatsTask, memory_budget: int, prefetch=0, native_dtypes=False) -> Dict[str, int]:
+    """
+    Spatial chunk sizes for `task`, so that loading and computing a chunk takes about `memory_budget` bytes,
+    as estimated by :func:`bytes_per_pixel`.
+    """
+    pixel_bytes = bytes_per_pixel(task, prefetch=prefetch, native_dtypes=native_dtypes)
+
+    y_dim, x_dim = task.sample_tile.dims[1:]
+    height, width = task.sample_tile.shape[1:]
+    if pixel_bytes == 0:
+        return {y_dim: height, x_dim: width}
+
+    num_pixels = max(1, int(memory_budget // pixel_bytes))
+    side = int(np.sqrt(num_pixels))
+    if side >= width:
+        # whole rows
+        return {y_dim: max(1, min(height, num_pixels // width)), x_dim: width}
+
+    return {y_dim: max(1, min(height, side)), x_dim: max(1, side)}
+
+
+def estimate_task_cost(task: StatsTask, chunking, prefetch=0, native_dtypes=False, memory_budget=None) -> float:
+    """
+    Relative cost of running `task` with the given computation options, to balance tasks between batch jobs.
+
+    Each chunk that the task will process (see :func:`covered_chunks`) costs the loading of its observations
+    plus the declared compute cost of every statistic for that many observations. Chunks already written by
+    an interrupted run of a checkpointed task are only known once its output files are opened, so a
+    partly-completed task is still weighted as if it was starting over.
+    """
+    if memory_budget is not None:
+        chunking = plan_chunking(task, memory_budget, prefetch=prefetch, native_dtypes=native_dtypes)
+
+    num_chunks = sum(1 for _ in covered_chunks(task, chunking))
+    num_observations = task.data_sources_length()
+
+    return num_chunks * (num_observations + sum(output_product.compute_cost(num_observations)
+                                                for output_product in task.output_products.values()))
+
+
 def load_process_save_chunk_iteratively(output_files: OutputDriver,
                                         chunk: Tuple[slice, slice, slice],
                                         task: StatsTask,
-                                        timer: MultiTimer):
+                                        timer: MultiTimer,
+                                        geom_mask=None, prefetch=0, io_threads=0, native_dtypes=False,
+                                        checkpoint_every=0):
+    checkpoint = (output_files.iterative_checkpoint(chunk, task.output_products, checkpoint_every)
+                  if checkpoint_every else None)
+    results = compute_chunk_iteratively(chunk, task, timer, geom_mask=geom_mask, prefetch=prefetch,
+                                        native_dtypes=native_dtypes, checkpoint=checkpoint)
+    with timer.time('writing_data'):
+        save_chunk_iteratively(output_files, chunk, results)
+        output_files.mark_chunk_written(chunk, task.output_products)
+
+
+def compute_chunk_iteratively(chunk: Tuple[slice, slice, slice], task: StatsTask, timer: MultiTimer,
+                              geom_mask=None, prefetch=0, native_dtypes=False,
+                              checkpoint: Optional[IterativeCheckpoint] = None) -> List[Tuple[str, xarray.Dataset]]:
+    """
+    Load `chunk` one time slice at a time, updating the iterative statistics with each.
+
+    With a `checkpoint`, the statistics continue from its saved state, if any, and save theirs to it
+    every `checkpoint.every` time slices.
+    """
     procs = [(stat.make_iterative_proc(), name, stat) for name, stat in task.output_products.items()]
+    consumed = None
+
+    if checkpoint is not None:
+        saved = checkpoint.load()
+        if saved is not None:
+            procs, consumed = saved
+            _LOG.info('Resuming %s of %s after %d time slices', chunk_key(chunk), task.spatial_id, sum(consumed))
+        else:
+            consumed = [0] * len(task.sources)
 
     def update(ds):
-        for proc, name, _ in procs:
+        float_ds = None
+        for proc, name, stat in procs:
             with timer.time(name):
-                proc(ds)
+                if native_dtypes and not stat.supports_native_dtypes():
+                    # converted once, for all the statistics that need it
+                    if float_ds is None:
+                        float_ds = sensible_mask_invalid_data(ds)
+                    proc(float_ds)
+                else:
+                    proc(ds)
+
+    if geom_mask is None:
+        geom_mask = chunk_feature_mask(task, chunk)
+    slices = load_data_lazy(chunk, task.sources, geom_mask=geom_mask, timer=timer, prefetch=prefetch,
+                            consumed=consumed)
+    for count, ds in enumerate(slices, start=1):
+        update(ds)
+        if checkpoint is not None and checkpoint.every and count % checkpoint.every == 0:
+            with timer.time('checkpointing'):
+                checkpoint.save(procs, consumed)
 
-    def save(name, ds):
+    return [(name, cast_back(proc(), stat.data_measurements)) for proc, name, stat in procs]
+
+
+def save_chunk_iteratively(output_files: OutputDriver, chunk: Tuple[slice, slice, slice], results):
+    for name, ds in results:
         for var_name, var in ds.data_vars.items():
             output_files.write_data(name, var_name, chunk, var.values)
 
-    geom = geometry_for_task(task)
-    for ds in load_data_lazy(chunk, task.sources, geom=geom, timer=timer):
-        update(ds)
 
-    with timer.time('writing_data'):
-        for proc, name, stat in procs:
-            save(name, cast_back(proc(), stat.data_measurements))
+def native_dtype_sources(sources: Iterable[DataSource]) -> List[DataSource]:
+    """
+    Sources loading their data in its native types, with masked out pixels set to `nodata` in place.
+    Only changes sources made up of integer measurements; floating point data already uses NaN.
+    """
+    def native(source_prod):
+        if source_prod.data.sources.size == 0:
+            return source_prod
+
+        measurements = source_prod.data.product.lookup_measurements(source_prod.spec.get('measurements'))
+        if any(np.dtype(measurement['dtype']).kind == 'f' for measurement in measurements.values()):
+            return source_prod
+
+        spec = dict(source_prod.spec, mask_nodata=False, mask_inplace=True)
+        return DataSource(source_prod.data, source_prod.masks, spec, source_index=source_prod.source_index)
+
+    return [native(source_prod) for source_prod in sources]
 
 
 def geometry_for_task(task: StatsTask):
@@ -555,32 +1027,67 @@ def geometry_for_task(task: StatsTask):
         return None
 
 
-def load_process_save_chunk(output_files: OutputDriver,
-                            chunk: Tuple[slice, slice, slice],
-                            task: StatsTask, timer: MultiTimer):
-    try:
-        with timer.time('loading_data'):
-            geom = geometry_for_task(task)
-            data = load_data(chunk, task.sources, geom=geom)
+def task_feature_mask(task: StatsTask) -> Optional[np.ndarray]:
+    """ The feature polygon of `task` rasterised over the whole task geobox, `True` inside. """
+    geom = geometry_for_task(task)
+    if geom is None:
+        return None
+    return geometry_mask([geom], task.geobox, invert=True)
+
+
+def chunk_feature_mask(task: StatsTask, chunk: Tuple[slice, slice, slice]) -> Optional[np.ndarray]:
+    """ The feature polygon of `task` rasterised over the extent of a single `chunk`, `True` inside. """
+    geom = geometry_for_task(task)
+    if geom is None:
+        return None
+    return geometry_mask([geom], task.geobox[chunk[1:]], invert=True)
 
-        last_idx = len(task.output_products) - 1
-        for idx, (prod_name, stat) in enumerate(task.output_products.items()):
-            _LOG.debug("Computing %s in tile %s %s; %s",
-                       prod_name, task.spatial_id,
-                       "({})".format(", ".join(prettier_slice(c) for c in chunk)),
-                       timer)
 
-            measurements = stat.data_measurements
+def task_coverage(task: StatsTask) -> Optional[Geometry]:
+    """
+    The area where `task` can have any data: the union of the footprints of its source datasets,
+    clipped to the feature polygon of the task if there is one. In the CRS of the task.
+
+    :return: `None` if the footprint of some dataset is unknown, so that nothing can be ruled out
+    """
+    crs = task.geobox.crs
+    footprints = []
+    for source_prod in task.sources:
+        for datasets in source_prod.data.sources.values:
+            for dataset in datasets:
+                if dataset.extent is None:
+                    return None
+                footprints.append(dataset.extent.to_crs(crs))
+
+    if not footprints:
+        return None
+
+    coverage = unary_union(footprints)
+
+    geom = geometry_for_task(task)
+    if geom is not None:
+        coverage = coverage.intersection(geom.to_crs(crs))
+
+    return coverage
 
-            with timer.time(prod_name):
-                result = stat.compute(data)
 
-                if idx == last_idx:  # make sure input data is released early
-                    del data
+def chunk_is_covered(task: StatsTask, chunk: Tuple[slice, slice, slice], coverage: Optional[Geometry]) -> bool:
+    """ Does the spatial extent of `chunk` intersect the `coverage` of the task? """
+    if coverage is None:
+        return True
 
-                # restore nodata values back
-                result = cast_back(result, measurements)
+    return task.geobox[chunk[1:]].extent.intersects(coverage)
 
+
+def load_process_save_chunk(output_files: OutputDriver,
+                            chunk: Tuple[slice, slice, slice],
+                            task: StatsTask, timer: MultiTimer, geom_mask=None, prefetch=0, io_threads=0,
+                            native_dtypes=False, checkpoint_every=0):
+    try:
+        # only the generator holds on to the loaded data, so that it can be released early
+        results = compute_chunk(load_chunk(chunk, task, timer, geom_mask=geom_mask, io_threads=io_threads),
+                                chunk, task, timer, native_dtypes=native_dtypes)
+        for prod_name, result in results:
             # For each of the data variables, shove this chunk into the output results
             with timer.time('writing_data'):
                 output_files.write_chunk(prod_name, chunk, result)
@@ -589,66 +1096,289 @@ def load_process_save_chunk(output_files: OutputDriver,
         _LOG.debug('Error: No data returned while loading %s for %s. May have all been masked',
                    chunk, task)
 
+    output_files.mark_chunk_written(chunk, task.output_products)
+
+
+def load_chunk(chunk: Tuple[slice, slice, slice], task: StatsTask, timer: MultiTimer, geom_mask=None,
+               io_threads=0) -> xarray.Dataset:
+    """ Load the whole time stack of `chunk`, from all of the sources of `task`. """
+    with timer.time('loading_data'):
+        if geom_mask is None:
+            geom_mask = chunk_feature_mask(task, chunk)
+        keep_empty = any(stat.needs_empty_time_slices() for stat in task.output_products.values())
+        return load_data(chunk, task.sources, geom_mask=geom_mask, io_threads=io_threads, keep_empty=keep_empty)
+
+
+def compute_chunk(data: xarray.Dataset, chunk: Tuple[slice, slice, slice], task: StatsTask, timer: MultiTimer,
+                  native_dtypes=False) -> Iterator[Tuple[str, xarray.Dataset]]:
+    """ Compute each of the statistics of `task` on the loaded `data`, releasing it after the last one. """
+    float_data = None
+    last_idx = len(task.output_products) - 1
+    for idx, (prod_name, stat) in enumerate(task.output_products.items()):
+        _LOG.debug("Computing %s in tile %s %s; %s",
+                   prod_name, task.spatial_id,
+                   "({})".format(", ".join(prettier_slice(c) for c in chunk)),
+                   timer)
+
+        measurements = stat.data_measurements
+
+        with timer.time(prod_name):
+            if native_dtypes and not stat.supports_native_dtypes():
+                # converted once, for all the statistics that need it
+                if float_data is None:
+                    float_data = sensible_mask_invalid_data(data)
+                result = stat.compute(float_data)
+            elif native_dtypes:
+                result = stat.compute_native(data)
+            else:
+                result = stat.compute(data)
+
+            if idx == last_idx:  # make sure input data is released early
+                del data, float_data
+
+            # restore nodata values back
+            result = cast_back(result, measurements)
+
+        yield prod_name, result
+
 
 class EmptyChunkException(Exception):
     pass
 
 
-def load_data_lazy(sub_tile_slice, sources, geom=None, reverse=False, timer=None):
+def load_data_lazy(sub_tile_slice, sources, geom=None, reverse=False, timer=None, prefetch=0, geom_mask=None,
+                   consumed=None):
+    """
+    Load the masked time slices of all `sources`, one at a time and in order of time.
+
+    :param consumed: optionally, a list of the number of time slices already taken from each of the
+                     `sources`, which are skipped, updated as each time slice is returned
+    """
     def by_time(ds):
         return ds.time.values[0]
 
-    data = [load_masked_data_lazy(sub_tile_slice, source,
-                                  reverse=reverse, geom=geom, src_idx=source.source_index, timer=timer)
-            for source in sources]
+    if consumed is None:
+        data = [load_masked_data_lazy(sub_tile_slice, source,
+                                      reverse=reverse, geom=geom, src_idx=source.source_index, timer=timer,
+                                      prefetch=prefetch, geom_mask=geom_mask)
+                for source in sources]
+
+        if len(data) == 1:
+            return data[0]
+
+        return sorted_interleave(*data, key=by_time, reverse=reverse)
+
+    def counted(index, source):
+        for ds in load_masked_data_lazy(sub_tile_slice, source,
+                                        reverse=reverse, geom=geom, src_idx=source.source_index, timer=timer,
+                                        prefetch=prefetch, geom_mask=geom_mask, skip=consumed[index]):
+            yield index, ds
 
-    if len(data) == 1:
-        return data[0]
+    def count(data):
+        for index, ds in data:
+            consumed[index] += 1
+            yield ds
 
-    return sorted_interleave(*data, key=by_time, reverse=reverse)
+    data = [counted(index, source) for index, source in enumerate(sources)]
+    return count(sorted_interleave(*data, key=lambda item: by_time(item[1]), reverse=reverse))
 
 
 def load_data(sub_tile_slice: Tuple[slice, slice, slice],
-              sources: Iterable[DataSource], geom=None) -> xarray.Dataset:
+              sources: Iterable[DataSource], geom=None, io_threads=0, geom_mask=None,
+              keep_empty=False) -> xarray.Dataset:
     """
     Load a masked chunk of data from the datacube, based on a specification and list of datasets in `sources`.
 
+    The output arrays are allocated once, already sorted by time, using the time slices and
+    dtypes known from the source tiles. Each source then writes its time slices straight into
+    them, so the peak memory use stays close to the size of the returned stack. Time slices left
+    without any valid observation after masking (see :func:`ds_completely_invalid`) are dropped,
+    unless `keep_empty` is set. Mask time slices are matched to the data by time, and data without
+    all of its masks is dropped.
+
     :param sub_tile_slice: A portion of a tile, tuple coordinates
     :param sources: a dictionary containing `data`, `spec` and `masks`
     :param geom: polygon feature to mask by
+    :param io_threads: number of threads reading time slices, measurements and masks in parallel
+    :param geom_mask: `geom` already rasterised over the chunk, `True` inside
+    :param keep_empty: keep time slices without any valid observation, for statistics that need the whole time axis
     :return: :class:`xarray.Dataset` containing loaded data. Will be indexed and sorted by time.
     """
-    datasets = [load_masked_data(sub_tile_slice, source_prod, geom=geom)
-                for source_prod in sources]  # list of datasets
+    sources = list(sources)
+    tiles = [source_prod.data[sub_tile_slice] for source_prod in sources]
+
+    # the time slices of each source that have all of its masks, and the mask slices of the same times
+    matched = []
+    for source_prod, tile in zip(sources, tiles):
+        mask_tiles = _sliced_mask_tiles(sub_tile_slice, source_prod)
+        if mask_tiles is None:
+            # Discard data due to no mask data
+            continue
+        matched.append((source_prod, tile, mask_tiles) + _match_mask_times(tile, mask_tiles))
+
+    times, rows = _time_stack_layout([tile.sources.time.values[positions] for _, tile, _, positions, _ in matched])
+    if times.size == 0:
+        raise EmptyChunkException()
 
-    datasets = _remove_emptys(datasets)
-    if len(datasets) == 0:
+    if geom_mask is None and geom is not None:
+        geom_mask = geometry_mask([geom], tiles[0].geobox, invert=True)
+
+    stack = _allocate_time_stack(sources, tiles, times.size)
+    source_ids = np.zeros(times.size, dtype=int)
+    has_data = np.zeros(times.size, dtype=bool)
+    template = None
+
+    def store(source_prod, row, finish_slice):
+        nonlocal template
+        data, _ = finish_slice()
+        has_data[row] = keep_empty or not ds_completely_invalid(data)
+        if source_prod.source_index is not None:
+            source_ids[row] = source_prod.source_index
+
+        for name, var in data.data_vars.items():
+            stack[name][row] = var.values[0]
+
+        if template is None:
+            template = data
+
+    with _io_executor(io_threads) as executor:
+        # slices are stored in the same order as they are started, at most `io_threads` of them are being read
+        pending = deque()
+        for (source_prod, tile, mask_tiles, positions, mask_positions), source_rows in zip(matched, rows):
+            for j, row in enumerate(source_rows):
+                mask_slices = [_time_slice(mask_tile, mask_slice_positions[j])
+                               for mask_tile, mask_slice_positions in zip(mask_tiles, mask_positions)]
+                pending.append((source_prod, row,
+                                _start_masked_slice(_time_slice(tile, positions[j]), mask_slices,
+                                                    source_prod.spec, geom_mask, executor, check_empty=False)))
+                if len(pending) > io_threads:
+                    store(*pending.popleft())
+
+        while pending:
+            store(*pending.popleft())
+
+    # Discard empty time slices, moving the others up in place
+    kept = np.flatnonzero(has_data)
+    if kept.size == 0:
         raise EmptyChunkException()
 
+    if kept.size < times.size:
+        for name, values in stack.items():
+            for new_row, row in enumerate(kept):
+                if new_row != row:
+                    values[new_row] = values[row]
+            stack[name] = values[:kept.size]
+        times, source_ids = times[kept], source_ids[kept]
+
     # TODO: Add check for compatible data variable attributes
     # flags_definition between pq products is different and is silently dropped
-    ds = xarray.concat(datasets, dim='time')  # Copies all the data
-    if len(ds.time) == 0:
-        raise EmptyChunkException()
+    coords = OrderedDict((name, coord) for name, coord in template.coords.items() if 'time' not in coord.dims)
+    coords['time'] = xarray.Variable('time', times, attrs=template.time.attrs)
+    if all(source_prod.source_index is not None for source_prod in sources):
+        coords['source'] = ('time', source_ids)
+
+    return xarray.Dataset(OrderedDict((name, (var.dims, stack[name], var.attrs))
+                                      for name, var in template.data_vars.items()),
+                          coords=coords, attrs=template.attrs)
+
+
+def _time_stack_layout(tile_times):
+    """
+    Time values of the sorted stack of the time slices of all tiles, given the times of each,
+    and for each tile the rows of the stack its time slices go to.
+    """
+    all_times = np.concatenate(tile_times) if tile_times else np.array([], dtype='datetime64[ns]')
+
+    # stable, so that equal times keep the order of the sources, as `concat` followed by `sortby` would
+    order = np.argsort(all_times, kind='mergesort')
+    positions = np.empty_like(order)
+    positions[order] = np.arange(order.size)
+
+    bounds = np.cumsum([0] + [times.size for times in tile_times])
+    return all_times[order], [positions[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def _match_mask_times(data_tile, mask_tiles):
+    """
+    Match the time slices of `data_tile` to the time slices of each of its `mask_tiles` with the same time value.
+    Masks may have been found for different times than the data, eg. for non-gridded sources.
+
+    :return: positions in `data_tile` of the time slices all of the masks have, and for each mask
+             the positions of its time slices for them
+    """
+    times = data_tile.sources.time.values
+    matched = np.ones(times.size, dtype=bool)
+    mask_positions = []
+    for mask_tile in mask_tiles:
+        mask_times = mask_tile.sources.time.values
+        if mask_times.size == 0:
+            matched[:] = False
+            mask_positions.append(np.zeros(times.size, dtype=int))
+            continue
+
+        order = np.argsort(mask_times, kind='mergesort')
+        found = np.minimum(np.searchsorted(mask_times[order], times), mask_times.size - 1)
+        matched &= mask_times[order][found] == times
+        mask_positions.append(order[found])
+
+    positions = np.flatnonzero(matched)
+    if positions.size < times.size:
+        _LOG.debug('Discarding %d time slices without mask data', times.size - positions.size)
+    return positions, [mask_slice_positions[positions] for mask_slice_positions in mask_positions]
+
+
+def _time_slice(tile, position):
+    """ The time slice of `tile` at `position`, keeping the time dimension. """
+    return tile[(slice(position, position + 1), slice(None), slice(None))]
+
+
+def _select_times(tile, positions):
+    """ The time slices of `tile` at `positions`. """
+    if np.array_equal(positions, np.arange(tile.shape[0])):
+        return tile
+    return Tile(tile.sources.isel(time=positions), tile.geobox)
+
+
+def _loaded_dtypes(source_prod: DataSource, tile) -> Dict[str, np.dtype]:
+    """ Data types of the measurements of `source_prod` after loading and masking. """
+    mask_nodata = source_prod.spec.get('mask_nodata', True)
+    measurements = tile.product.lookup_measurements(source_prod.spec.get('measurements'))
+
+    def loaded_dtype(measurement):
+        dtype = np.dtype(measurement['dtype'])
+        if mask_nodata and dtype.kind != 'f':
+            # see `sensible_mask_invalid_data`
+            return np.dtype('float32')
+        return dtype
+
+    return OrderedDict((name, loaded_dtype(measurement)) for name, measurement in measurements.items())
 
-    # sort along time dim
-    return ds.sortby('time')  # Copies all the data again
 
+def _allocate_time_stack(sources: Iterable[DataSource], tiles, num_times) -> Dict[str, np.ndarray]:
+    """ One uninitialised array per measurement, large enough for the time slices of all sources. """
+    dtypes = OrderedDict()
+    for source_prod, tile in zip(sources, tiles):
+        if tile.sources.size == 0:
+            continue
+        for name, dtype in _loaded_dtypes(source_prod, tile).items():
+            dtypes[name] = np.result_type(dtypes.get(name, dtype), dtype)
 
-def _remove_emptys(datasets):
-    return [dataset
-            for dataset in datasets
-            if dataset is not None]
+    shape = (num_times,) + tiles[0].geobox.shape
+    return OrderedDict((name, np.empty(shape, dtype=dtype)) for name, dtype in dtypes.items())
 
 
 def load_masked_tile_lazy(tile, masks,
                           mask_nodata=False,
                           mask_inplace=False,
+                          mask_first=False,
                           reverse=True,
                           geom=None,
                           inverts=None,
                           src_idx=None,
                           timer=None,
+                          prefetch=0,
+                          geom_mask=None,
+                          skip=0,
                           **kwargs):
     """Given data tile and an optional list of masks load data and masks apply
     masks to data and return one time slice at a time.
@@ -662,73 +1392,92 @@ def load_masked_tile_lazy(tile, masks,
 
     mask_nodata  -- Convert data to float32 replacing nodata values with nan
     mask_inplace -- Apply mask without conversion to float
+    mask_first   -- Load masks before data, only read data where pixels are not masked out
     reverse      -- Return data earliest observation first
     geom         -- polygon feature to mask by
     inverts      -- Whether or not to invert the corresponding mask
     src_idx      -- If set adds extra axis called source with supplied value
     timer        -- Optionally track time
+    prefetch     -- Number of time slices to load ahead on background threads
+    geom_mask    -- `geom` already rasterised over the tile, True inside
+    skip         -- Number of time slices to leave out at the start, eg. already used before
 
 
     Returns an iterator of DataFrames one time-slice at a time
 
     """
 
-    ii = list(range(tile.shape[0]))
+    positions, mask_positions = _match_mask_times(tile, [m_tile for m_tile, _, _ in masks])
+    ii = list(range(positions.size))
     if reverse:
         ii = ii[::-1]
+    ii = ii[skip:]
 
-    def load_slice(i):
-        loc = [slice(i, i + 1), slice(None), slice(None)]
-        d = GridWorkflow.load(tile[loc], **kwargs)
+    where = _select_where(mask_nodata, mask_inplace)
+
+    if geom_mask is None and geom is not None:
+        geom_mask = geometry_mask([geom], tile.geobox, invert=True)
+
+    def load(data_tile):
+        d = GridWorkflow.load(data_tile, **kwargs)
 
         if mask_nodata:
             d = sensible_mask_invalid_data(d)
 
+        return d
+
+    def load_slice(i):
+        data_tile = _time_slice(tile, positions[i])
+
         # Load all masks and combine them all into one
         mask = None
-        for (m_tile, flags, load_args), invert in zip(masks, inverts):
-            m = GridWorkflow.load(m_tile[loc], **load_args)
+        for (m_tile, flags, load_args), invert, m_positions in zip(masks, inverts, mask_positions):
+            m = GridWorkflow.load(_time_slice(m_tile, m_positions[i]), **load_args)
             m, *other = m.data_vars.values()
-            # TODO make use of make_mask_from_spec here
-            m = make_mask(m, **flags)
-
-            if invert:
-                m = np.logical_not(m)
+            m = make_mask_from_spec(m, {'flags': flags, 'invert': invert})
 
             if mask is None:
                 mask = m
             else:
                 mask &= m
 
-        if mask_inplace or not mask_nodata:
-            where = sensible_where_inplace
+        if mask_first:
+            clear = np.ones(data_tile.shape, dtype=bool) if mask is None else np.asarray(mask)
+            if geom_mask is not None:
+                clear = clear & geom_mask
+
+            d, _ = _load_clear_windows(data_tile, clear, load, where,
+                                       measurements=kwargs.get('measurements'), mask_nodata=mask_nodata)
         else:
-            where = sensible_where
+            d = load(data_tile)
 
-        if mask is not None:
-            # Apply mask in place if asked or if we already performed
-            # conversion to float32, this avoids reallocation of memory and
-            # hence increases the largest data set size one can load without
-            # running out of memory
-            d = where(d, mask)
+            if mask is not None:
+                # Apply mask in place if asked or if we already performed
+                # conversion to float32, this avoids reallocation of memory and
+                # hence increases the largest data set size one can load without
+                # running out of memory
+                d = where(d, mask)
 
-        if geom is not None:
-            d = where(d, geometry_mask([geom], d.geobox, invert=True))
+            if geom_mask is not None:
+                d = where(d, geom_mask)
 
         if src_idx is not None:
             d.coords['source'] = ('time', np.repeat(src_idx, d.time.size))
 
         return d
 
-    extract = wrap_in_timer(load_slice, timer, 'loading_data')
+    # with prefetching the timer measures how long the computation waits for data
+    slices = prefetch_map(load_slice, ii, prefetch)
+    extract = wrap_in_timer(next, timer, 'loading_data')
 
-    for i in ii:
-        yield extract(i)
+    for _ in ii:
+        yield extract(slices)
 
 
 def load_masked_data_lazy(sub_tile_slice: Tuple[slice, slice, slice],
                           source_prod: DataSource,
-                          geom=None, reverse=False, src_idx=None, timer=None) -> xarray.Dataset:
+                          geom=None, reverse=False, src_idx=None, timer=None, prefetch=0,
+                          geom_mask=None, skip=0) -> xarray.Dataset:
     data_fuse_func = import_function(source_prod.spec['fuse_func']) if 'fuse_func' in source_prod.spec else None
     data_tile = source_prod.data[sub_tile_slice]
     data_measurements = source_prod.spec.get('measurements')
@@ -753,17 +1502,67 @@ def load_masked_data_lazy(sub_tile_slice: Tuple[slice, slice, slice],
                                  masks,
                                  mask_nodata=mask_nodata,
                                  mask_inplace=mask_inplace,
+                                 mask_first=source_prod.spec.get('mask_first', False),
                                  reverse=reverse,
                                  inverts=inverts,
                                  src_idx=src_idx,
                                  timer=timer,
+                                 prefetch=prefetch,
                                  geom=geom,
+                                 geom_mask=geom_mask,
+                                 skip=skip,
                                  fuse_func=data_fuse_func,
                                  measurements=data_measurements,
                                  skip_broken_datasets=True)
 
 
 def make_mask_from_spec(loaded_mask_data, mask_spec):
+    """
+    Decode a loaded mask layer into booleans, `True` where data is to be kept, according to `mask_spec`.
+
+    Layers of 8 or 16 bit integers are decoded through a lookup table, see :func:`mask_lookup_table`.
+    """
+    lookup_table = mask_lookup_table(mask_spec, loaded_mask_data.dtype,
+                                     loaded_mask_data.attrs.get('flags_definition'))
+    if lookup_table is not None:
+        values = np.asarray(loaded_mask_data.values)
+        mask = np.empty(values.shape, dtype=bool)
+        np.take(lookup_table, values.view('u{}'.format(values.dtype.itemsize)), out=mask)
+        return xarray.DataArray(mask, dims=loaded_mask_data.dims, coords=loaded_mask_data.coords)
+
+    return _evaluate_mask_spec(loaded_mask_data, mask_spec)
+
+
+_MASK_LOOKUP_TABLES = {}
+
+
+def mask_lookup_table(mask_spec, dtype, flags_definition=None):
+    """
+    Compile `mask_spec` for mask layers of `dtype` into a lookup table of the decoded value of every integer
+    of that type, indexed by its bit pattern as an unsigned integer. Tables are cached, so a mask spec
+    is only compiled once per process.
+
+    :return: `None` for types with more than 16 bits, which are decoded directly
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'ui' or dtype.itemsize > 2:
+        return None
+
+    key = (repr(sorted(mask_spec.items())), dtype.str, repr(flags_definition))
+    lookup_table = _MASK_LOOKUP_TABLES.get(key)
+    if lookup_table is None:
+        # every value of `dtype`, placed at the index of its bit pattern
+        values = np.arange(2 ** (8 * dtype.itemsize), dtype='u{}'.format(dtype.itemsize)).view(dtype)
+        attrs = {} if flags_definition is None else {'flags_definition': flags_definition}
+
+        decoded = _evaluate_mask_spec(xarray.DataArray(values, dims=['value'], attrs=attrs), mask_spec)
+        lookup_table = np.asarray(decoded, dtype=bool)
+        _MASK_LOOKUP_TABLES[key] = lookup_table
+
+    return lookup_table
+
+
+def _evaluate_mask_spec(loaded_mask_data, mask_spec):
     if mask_spec.get('flags') is not None:
         mask = make_mask(loaded_mask_data, **mask_spec['flags'])
     elif mask_spec.get('less_than') is not None:
@@ -783,53 +1582,229 @@ def make_mask_from_spec(loaded_mask_data, mask_spec):
 
 
 def load_masked_data(sub_tile_slice: Tuple[slice, slice, slice],
-                     source_prod: DataSource, geom=None) -> xarray.Dataset:
-    data_fuse_func = import_function(source_prod.spec['fuse_func']) if 'fuse_func' in source_prod.spec else None
-    data = GridWorkflow.load(source_prod.data[sub_tile_slice],
-                             measurements=source_prod.spec.get('measurements'),
-                             fuse_func=data_fuse_func,
-                             skip_broken_datasets=True)
+                     source_prod: DataSource, geom=None, io_threads=0, geom_mask=None) -> xarray.Dataset:
+    data_tile = source_prod.data[sub_tile_slice]
 
-    mask_inplace = source_prod.spec.get('mask_inplace', False)
-    mask_nodata = source_prod.spec.get('mask_nodata', True)
+    mask_tiles = _sliced_mask_tiles(sub_tile_slice, source_prod)
+    if mask_tiles is None:
+        # Discard data due to no mask data
+        return None
 
-    if mask_nodata:
-        data = sensible_mask_invalid_data(data)
+    positions, mask_positions = _match_mask_times(data_tile, mask_tiles)
+    if positions.size == 0:
+        return None
+    data_tile = _select_times(data_tile, positions)
+    mask_tiles = [_select_times(mask_tile, mask_slice_positions)
+                  for mask_tile, mask_slice_positions in zip(mask_tiles, mask_positions)]
+
+    if geom_mask is None and geom is not None:
+        geom_mask = geometry_mask([geom], data_tile.geobox, invert=True)
+
+    with _io_executor(io_threads) as executor:
+        data, has_data = _start_masked_slice(data_tile, mask_tiles, source_prod.spec, geom_mask, executor)()
 
-    # if all NaN
-    completely_empty = all(ds for ds in xarray.ufuncs.isnan(data).all().data_vars.values())
-    if completely_empty:
-        # Discard empty slice
+    if not has_data:
+        # Discard empty or completely masked slice
         return None
 
+    if source_prod.source_index is not None:
+        data.coords['source'] = ('time', np.repeat(source_prod.source_index, data.time.size))
+
+    return data
+
+
+def _select_where(mask_nodata, mask_inplace):
+    """ Apply masks in place, unless the data is converted to float32 (with NaN as nodata) anyway. """
     if mask_inplace or not mask_nodata:
-        where = sensible_where_inplace
-    else:
-        where = sensible_where
+        return sensible_where_inplace
+    return sensible_where
 
-    if 'masks' in source_prod.spec:
-        for mask_spec, mask_tile in zip(source_prod.spec['masks'], source_prod.masks):
-            if mask_tile is None:
-                # Discard data due to no mask data
-                return None
-            mask_fuse_func = import_function(mask_spec['fuse_func']) if 'fuse_func' in mask_spec else None
-            mask = GridWorkflow.load(mask_tile[sub_tile_slice],
-                                     measurements=[mask_spec['measurement']],
-                                     fuse_func=mask_fuse_func,
-                                     skip_broken_datasets=True)[mask_spec['measurement']]
 
-            data = where(data, make_mask_from_spec(mask, mask_spec))
-            del mask
+@contextmanager
+def _io_executor(io_threads):
+    """ A thread pool for reading data, or `None` to read everything in the calling thread. """
+    if not io_threads:
+        yield None
+        return
 
-    if geom is not None:
-        data = where(data, geometry_mask([geom], data.geobox, invert=True))
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+        yield executor
 
-    if source_prod.source_index is not None:
-        data.coords['source'] = ('time', np.repeat(source_prod.source_index, data.time.size))
+
+def _read_later(executor, func, *args, **kwargs):
+    """
+    Start `func` on the `executor`, if there is one, and return a function that waits for its result.
+    Without an `executor` `func` is only called once its result is asked for.
+    """
+    if executor is None:
+        return partial(func, *args, **kwargs)
+    return executor.submit(func, *args, **kwargs).result
+
+
+def _start_masked_slice(data_tile, mask_tiles, spec, geom_mask=None, executor=None, check_empty=True):
+    """
+    Start reading and masking `data_tile` with its `mask_tiles`.
+
+    :return: a function that waits for the reads, and returns the masked data and whether it has any
+             (for `mask_first` sources, whether any pixel was left clear; otherwise, unless `check_empty`
+             is off, whether there was any data before masking)
+    """
+    if spec.get('mask_first', False):
+        read_masks = [_read_later(executor, _load_source_mask, mask_tile, mask_spec)
+                      for mask_spec, mask_tile in zip(spec.get('masks', []), mask_tiles)]
+
+        def finish():
+            return _load_source_mask_first(data_tile, [read() for read in read_masks], spec, geom_mask, executor)
+
+        return finish
+
+    read_data = _start_source_data(data_tile, spec, executor)
+    read_masks = [_read_later(executor, _load_source_mask, mask_tile, mask_spec)
+                  for mask_spec, mask_tile in zip(spec.get('masks', []), mask_tiles)]
+
+    def finish():
+        data = read_data()
+        has_data = not check_empty or not _completely_empty(data)
+        return _apply_source_masks(data, [read() for read in read_masks], spec, geom_mask), has_data
+
+    return finish
+
+
+def _start_source_data(data_tile, spec, executor=None):
+    """
+    Start loading the data of a source `Tile`, replacing nodata values with NaN unless `mask_nodata` is off.
+    With an `executor` each measurement is read on its own thread.
+
+    :return: a function that waits for and returns the :class:`xarray.Dataset`
+    """
+    data_fuse_func = import_function(spec['fuse_func']) if 'fuse_func' in spec else None
+    mask_nodata = spec.get('mask_nodata', True)
+
+    def load(measurements):
+        data = GridWorkflow.load(data_tile,
+                                 measurements=measurements,
+                                 fuse_func=data_fuse_func,
+                                 skip_broken_datasets=True)
+
+        if mask_nodata:
+            data = sensible_mask_invalid_data(data)
+
+        return data
+
+    if executor is None:
+        return partial(load, spec.get('measurements'))
+
+    names = list(data_tile.product.lookup_measurements(spec.get('measurements')))
+    read_measurements = [_read_later(executor, load, [name]) for name in names]
+
+    def finish():
+        data, *others = [read() for read in read_measurements]
+        for other in others:
+            data.update(other)
+        return data
+
+    return finish
+
+
+def _load_source_data(data_tile, spec, executor=None) -> xarray.Dataset:
+    """ Load the data of a source `Tile`, replacing nodata values with NaN unless `mask_nodata` is off. """
+    return _start_source_data(data_tile, spec, executor)()
+
+
+def _completely_empty(data: xarray.Dataset) -> bool:
+    """ Is every value NaN, or `nodata` for non floating point data? """
+    return ds_completely_invalid(data)
+
+
+def _sliced_mask_tiles(sub_tile_slice, source_prod: DataSource):
+    """ Portion of each of the mask tiles of a source, or `None` if any of the masks is missing. """
+    mask_tiles = []
+    for _, mask_tile in zip(source_prod.spec.get('masks', []), source_prod.masks):
+        if mask_tile is None:
+            return None
+        mask_tiles.append(mask_tile[sub_tile_slice])
+    return mask_tiles
+
+
+def _load_source_mask(mask_tile, mask_spec) -> xarray.DataArray:
+    """ Load a mask `Tile` and decode it into booleans, `True` where data is to be kept. """
+    mask_fuse_func = import_function(mask_spec['fuse_func']) if 'fuse_func' in mask_spec else None
+    mask = GridWorkflow.load(mask_tile,
+                             measurements=[mask_spec['measurement']],
+                             fuse_func=mask_fuse_func,
+                             skip_broken_datasets=True)[mask_spec['measurement']]
+
+    return make_mask_from_spec(mask, mask_spec)
+
+
+def _apply_source_masks(data, masks, spec, geom_mask=None) -> xarray.Dataset:
+    """ Apply the decoded `masks` of a source, and the rasterised feature polygon `geom_mask`, to `data`. """
+    where = _select_where(spec.get('mask_nodata', True), spec.get('mask_inplace', False))
+
+    for mask in masks:
+        data = where(data, mask)
+
+    if geom_mask is not None:
+        data = where(data, geom_mask)
 
     return data
 
 
+def _load_source_mask_first(data_tile, masks, spec, geom_mask=None, executor=None):
+    """
+    Combine the decoded `masks` of a source before loading any of its data, then only read the data that is left clear.
+
+    :return: masked data and whether any pixel was left clear
+    """
+    clear = np.ones(data_tile.shape, dtype=bool)
+    for mask in masks:
+        clear &= np.asarray(mask)
+
+    if geom_mask is not None:
+        clear &= geom_mask
+
+    mask_nodata = spec.get('mask_nodata', True)
+    return _load_clear_windows(data_tile, clear, partial(_load_source_data, spec=spec, executor=executor),
+                               _select_where(mask_nodata, spec.get('mask_inplace', False)),
+                               measurements=spec.get('measurements'), mask_nodata=mask_nodata)
+
+
+def _load_clear_windows(data_tile, clear, load, where, measurements=None, mask_nodata=True):
+    """
+    Read only the time slices of `data_tile` that have `clear` pixels, and within each of them
+    only the window bounding those pixels. Everything else is filled with nodata without being read.
+
+    :param data_tile: `Tile` to load
+    :param clear: boolean array of the shape of `data_tile`, `True` where a pixel is not masked out
+    :param load: loads a portion of `data_tile` into an :class:`xarray.Dataset`
+    :param where: applies a mask to loaded data
+    :param measurements: names of the measurements `load` returns
+    :param mask_nodata: whether `load` converts data to float32 with NaN as nodata
+    :return: masked data and whether any pixel was clear
+    """
+    measurement_defs = data_tile.product.lookup_measurements(measurements)
+    data = Datacube.create_storage(data_tile.sources.coords, data_tile.geobox, list(measurement_defs.values()))
+    if mask_nodata:
+        data = sensible_mask_invalid_data(data)
+
+    any_clear = False
+    for t, clear_slice in enumerate(clear):
+        rows = np.flatnonzero(clear_slice.any(axis=1))
+        if rows.size == 0:
+            continue
+
+        any_clear = True
+        cols = np.flatnonzero(clear_slice.any(axis=0))
+        window = (slice(t, t + 1), slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+
+        loaded = where(load(data_tile[window]), clear[window])
+        for name, var in loaded.data_vars.items():
+            data[name].values[window] = var.values
+        del loaded
+
+    return data, any_clear
+
+
 def _source_measurement_defs(index, sources):
     """
 
@@ -897,7 +1872,7 @@ def _prepare_output_driver(storage):
                                       'configuration file.'.format(msg, list(OUTPUT_DRIVERS.keys())))
 
 
-def _configure_date_ranges(config, index=None):
+def _configure_date_ranges(config, index=None, task_generator=None, cache=None):
     if 'date_ranges' not in config:
         raise StatsConfigurationError(dedent("""\
         No Date Range specification was found in the stats configuration file, please add a section similar to:
@@ -932,9 +1907,11 @@ def _configure_date_ranges(config, index=None):
 
         sources = config['sources']
         product_names = [source['product'] for source in sources]
+        geopolygon = None if task_generator is None else task_generator.input_geopolygon()
         output = list(_find_periods_with_data(index, product_names=product_names,
                                               start_date=date_ranges['start_date'],
-                                              end_date=date_ranges['end_date']))
+                                              end_date=date_ranges['end_date'],
+                                              geopolygon=geopolygon, cache=cache))
     else:
         raise StatsConfigurationError('Unknown date_ranges specification. Should be type=simple or '
                                       'type=find_daily_data')
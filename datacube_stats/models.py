@@ -166,6 +166,10 @@ class OutputProduct:
     def compute(self):
         return self.statistic.compute
 
+    @property
+    def compute_native(self):
+        return self.statistic.compute_native
+
     @property
     def is_iterative(self):
         return self.statistic.is_iterative
@@ -174,6 +178,26 @@ class OutputProduct:
     def make_iterative_proc(self):
         return self.statistic.make_iterative_proc
 
+    @property
+    def supports_native_dtypes(self):
+        return self.statistic.supports_native_dtypes
+
+    @property
+    def needs_empty_time_slices(self):
+        return self.statistic.needs_empty_time_slices
+
+    @property
+    def is_blockwise(self):
+        return self.statistic.is_blockwise
+
+    @property
+    def memory_multiplier(self):
+        return self.statistic.memory_multiplier
+
+    @property
+    def compute_cost(self):
+        return self.statistic.compute_cost
+
     def _create_product(self, metadata_type, product_type, data_measurements, storage, stats_metadata,
                         custom_metadata):
         product_definition = {
@@ -10,8 +10,9 @@ import pydash
 from collections import OrderedDict
 from functools import reduce as reduce_
 from pathlib import Path
-from typing import Iterable, Tuple, List
+from typing import Iterable, Tuple, List, Optional, Set
 
+import netCDF4
 import numpy
 import rasterio
 import xarray
@@ -26,6 +27,7 @@ from six import with_metaclass
 
 from .models import OutputProduct
 from .utils import prettier_slice
+from .utils.checkpoint import ChunkManifest, IterativeCheckpoint, chunk_key
 
 _LOG = logging.getLogger(__name__)
 _NETCDF_VARIABLE__PARAMETER_NAMES = {'zlib',
@@ -140,10 +142,16 @@ class OutputDriver(with_metaclass(RegisterDriver)):
               'time': 1}
           'dimension_order': ['time', 'y', 'x']}
     :param app_info:
+    :param bool checkpoint: keep partially written files of failed tasks, along with a manifest of the
+        chunks written to them, to resume from when the task is run again (see :mod:`.utils.checkpoint`)
     """
     valid_extensions: List[str] = []
 
-    def __init__(self, task, storage, output_path, app_info=None, global_attributes=None, var_attributes=None):
+    #: whether partially written files can be reopened to resume writing them
+    supports_checkpoint = False
+
+    def __init__(self, task, storage, output_path, app_info=None, global_attributes=None, var_attributes=None,
+                 checkpoint=False):
         self._storage = storage
 
         self._output_path = output_path
@@ -168,6 +176,16 @@ class OutputDriver(with_metaclass(RegisterDriver)):
         #: dict of str to dict of str to str
         self.var_attributes = var_attributes if var_attributes is not None else {}
 
+        if checkpoint and not self.supports_checkpoint:
+            _LOG.warning('The %s output driver cannot resume partially written files, not checkpointing',
+                         self.format_name())
+
+        #: Whether partially written files are kept to resume from
+        self.checkpoint = checkpoint and self.supports_checkpoint
+
+        #: Maps from prod_name to the manifest of chunks written to its temporary file
+        self._manifests = {}
+
     def close_files(self, completed_successfully: bool) -> Iterable[Path]:
         # Turn file_handles into paths
         written_paths = list(_walk_dict(self._output_file_handles, self._handle_to_path))
@@ -181,8 +199,13 @@ class OutputDriver(with_metaclass(RegisterDriver)):
             for tmp, dest in zip(written_paths, destinations):
                 atomic_rename(tmp, dest)
 
+            for manifest in self._manifests.values():
+                manifest.remove()
+
             return destinations
         else:
+            if self.checkpoint:
+                _LOG.info('Keeping partially written %s to resume from', [str(path) for path in written_paths])
             return written_paths
 
     @classmethod
@@ -200,6 +223,58 @@ class OutputDriver(with_metaclass(RegisterDriver)):
         for var_name, var in result.data_vars.items():
             self.write_data(prod_name, var_name, chunk, var.values)
 
+    def written_chunks(self, prod_names=None) -> Set[str]:
+        """
+        Keys (see :func:`.utils.checkpoint.chunk_key`) of the chunks already written to the output files
+        of all of `prod_names`, by default all output products.
+        """
+        manifests = [self._manifests.get(prod_name) for prod_name in (prod_names or self._output_products)]
+        if not manifests or None in manifests:
+            return set()
+        return set.intersection(*(manifest.chunks for manifest in manifests))
+
+    def mark_chunk_written(self, chunk, prod_names):
+        """ Record that all of the results of `chunk` for `prod_names` have been written. """
+        prod_names = list(prod_names)
+        for prod_name in prod_names:
+            if prod_name in self._manifests:
+                self._manifests[prod_name].add(chunk)
+
+        iterative_checkpoint = self.iterative_checkpoint(chunk, prod_names)
+        if iterative_checkpoint is not None:
+            iterative_checkpoint.remove()
+
+    def iterative_checkpoint(self, chunk, prod_names, every=0) -> Optional[IterativeCheckpoint]:
+        """
+        Where to save the state of the iterative statistics `prod_names` computing `chunk`,
+        next to the temporary file of the first of them. `None` if not checkpointing.
+        """
+        prod_names = list(prod_names)
+        if not prod_names or prod_names[0] not in self._manifests:
+            return None
+
+        manifest_path = self._manifests[prod_names[0]].path
+        return IterativeCheckpoint(manifest_path.with_name('{}.{}.state'.format(manifest_path.stem,
+                                                                                chunk_key(chunk))),
+                                   every)
+
+    def _resumable_manifest(self, prod_name, tmp_path: Path) -> Optional[ChunkManifest]:
+        """
+        The manifest of `tmp_path`, if it was left behind by a failed run of the task with chunks written to it.
+        Otherwise, any leftovers are removed and writing starts over with an empty manifest.
+        """
+        manifest = ChunkManifest(tmp_path.with_name(tmp_path.name + '.chunks'))
+        self._manifests[prod_name] = manifest
+
+        if tmp_path.exists() and len(manifest) > 0:
+            return manifest
+
+        if tmp_path.exists():
+            tmp_path.unlink()
+        manifest.remove()
+        self._manifests[prod_name] = ChunkManifest(manifest.path)
+        return None
+
     @abc.abstractmethod
     def write_data(self, prod_name, measurement_name,
                    chunk: Tuple[slice, slice, slice],
@@ -242,9 +317,13 @@ class OutputDriver(with_metaclass(RegisterDriver)):
         except OSError:
             pass
 
-        with tempfile.NamedTemporaryFile(dir=str(output_path.parent)) as tmpfile:
-            pass
-        tmp_path = Path(tmpfile.name)
+        if self.checkpoint:
+            # the same name every time the task is run, to find a partially written file
+            tmp_path = output_path.with_name(output_path.name + '.partial')
+        else:
+            with tempfile.NamedTemporaryFile(dir=str(output_path.parent)) as tmpfile:
+                pass
+            tmp_path = Path(tmpfile.name)
         self.output_filename_tmpname[tmp_path] = output_path
 
         return tmp_path
@@ -333,6 +412,8 @@ class NetCDFCFOutputDriver(OutputDriver):
 
     valid_extensions = ['.nc']
 
+    supports_checkpoint = True
+
     @classmethod
     def format_name(cls):
         return 'NetCDF'
@@ -340,7 +421,23 @@ class NetCDFCFOutputDriver(OutputDriver):
     def open_output_files(self):
         for prod_name, stat in self._output_products.items():
             output_filename = self._prepare_output_file(stat)
-            self._output_file_handles[prod_name] = self._create_storage_unit(stat, output_filename)
+            self._output_file_handles[prod_name] = self._open_storage_unit(prod_name, stat, output_filename)
+
+    def _open_storage_unit(self, prod_name, stat: OutputProduct, output_filename: Path):
+        if self.checkpoint:
+            manifest = self._resumable_manifest(prod_name, output_filename)
+            if manifest is not None:
+                try:
+                    nco = netCDF4.Dataset(str(output_filename), 'a')
+                    _LOG.info('Resuming %s with %d chunks already written', output_filename, len(manifest))
+                    return nco
+                except OSError as e:
+                    _LOG.warning('Cannot resume %s, starting over: %s', output_filename, e)
+                    output_filename.unlink()
+                    manifest.remove()
+                    self._manifests[prod_name] = ChunkManifest(manifest.path)
+
+        return self._create_storage_unit(stat, output_filename)
 
     def _handle_to_path(self, file_handle) -> Path:
         return Path(file_handle.filepath())
@@ -2,10 +2,12 @@ from string import Formatter
 import datetime
 
 import pandas as pd
-from voluptuous import Schema, Required, All, Length, Date, ALLOW_EXTRA, Optional, Any, In, Invalid, Inclusive
+from voluptuous import Schema, Required, All, Length, Date, ALLOW_EXTRA, Optional, Any, In, Invalid, Inclusive, \
+    Range
 
 from .statistics import STATS
 from .output_drivers import OUTPUT_DRIVERS
+from .utils import parse_memory_size
 
 # pylint: disable=invalid-name
 
@@ -107,6 +109,16 @@ date_ranges_schema = Schema({
     'type': Any('simple', 'find_daily_data'),
 })
 
+
+def memory_size(size):
+    """ A number of bytes, or a string like `4GB` or `512MiB`. """
+    try:
+        parse_memory_size(size)
+    except ValueError as e:
+        raise Invalid(str(e))
+    return size
+
+
 computation_schema = Schema({
     Inclusive('x', 'proj'): Any(float, int),
     Inclusive('y', 'proj'): Any(float, int),
@@ -120,8 +132,25 @@ stats_schema = Schema({
     'sources': All([source_schema], Length(min=1)),
     'storage': storage_schema,
     'output_products': All([output_product_schema], Length(min=1)),
-    Optional('computation'): {'chunking': computation_schema},
+    Optional('computation'): {
+        Optional('chunking'): computation_schema,
+        Optional('prefetch'): All(int, Range(min=0)),
+        Optional('io_threads'): All(int, Range(min=0)),
+        Optional('native_dtypes'): bool,
+        Optional('memory_budget'): memory_size,
+        Optional('chunk_workers'): All(int, Range(min=0)),
+        Optional('pipeline'): bool,
+        Optional('engine'): Any('default', 'dask'),
+        Optional('scheduler'): str,
+        Optional('checkpoint'): bool,
+        Optional('checkpoint_every'): All(int, Range(min=0))
+    },
     Optional('input_region'): Any(single_tile, tile_list, from_file, geometry, boundary_coords),
+    Optional('query_cache'): Any(bool, str),
+    Optional('task_generation'): {
+        Optional('workers'): All(int, Range(min=0)),
+        Optional('ordered'): bool
+    },
     Optional('global_attributes'): dict,
     Optional('var_attributes'): {str: {str: str}},
     Optional('filter_product'): filter_product
@@ -105,7 +105,7 @@ def section_by_index(array, index, axis=0):
     return array[fancy_index]
 
 
-def argpercentile(a, q, axis=0):
+def argpercentile(a, q, axis=0, nodata=None):
     """
     Compute the index of qth percentile of the data along the specified axis.
     Returns the index of qth percentile of the array elements.
@@ -117,7 +117,14 @@ def argpercentile(a, q, axis=0):
         Percentile to compute which must be between 0 and 100 inclusive.
     axis : int or sequence of int, optional
         Axis along which the percentiles are computed. The default is 0.
+    nodata : optional
+        For non floating point input, values to treat as missing, like NaNs.
     """
+    if nodata is not None and a.dtype.kind != 'f':
+        invalid = a == nodata
+        a = a.astype(np.result_type(a.dtype, np.float32))
+        a[invalid] = np.nan
+
     q = np.array(q, dtype=np.float64, copy=True) / 100.0
     nans = np.isnan(a).sum(axis=axis)
     q = q.reshape(q.shape + (1,) * nans.ndim)
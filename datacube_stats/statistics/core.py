@@ -46,6 +46,65 @@ class Statistic(abc.ABC):
         """
         return False
 
+    def supports_native_dtypes(self) -> bool:
+        """
+        Should return True if class can compute on data in its native (integer) types,
+        where missing observations are marked by the `nodata` value of each variable instead of NaN.
+
+        :rtype: Bool
+        """
+        return False
+
+    def compute_native(self, data: xarray.Dataset) -> xarray.Dataset:
+        """
+        Compute the statistic on data in its native (integer) types, with missing observations marked
+        by the `nodata` value of each variable. Only used if `supports_native_dtypes()` returns True.
+
+        Base implementation is the same as :meth:`compute`.
+
+        :param xarray.Dataset data:
+        :return: xarray.Dataset
+        """
+        return self.compute(data)
+
+    def needs_empty_time_slices(self) -> bool:
+        """
+        Should return True if the result depends on the whole time axis of the data, so that time slices
+        without any valid observation must be kept. Otherwise they are dropped before computing.
+
+        :rtype: Bool
+        """
+        return False
+
+    def is_blockwise(self) -> bool:
+        """
+        Should return True if each pixel of the result only depends on the same pixel of the data,
+        so that the statistic can be computed on any spatial block of it independently.
+        Used by the dask engine to split the computation into chunks.
+
+        :rtype: Bool
+        """
+        return False
+
+    def memory_multiplier(self, num_observations: int) -> float:
+        """
+        Extra memory used while computing, as a multiple of the size of the data it is given,
+        for data with `num_observations` time slices. Used to pick chunk sizes for a memory budget.
+
+        :rtype: float
+        """
+        return 1.0
+
+    def compute_cost(self, num_observations: int) -> float:
+        """
+        Relative time taken to compute a pixel with `num_observations` time slices,
+        where one unit is about the time to load one observation of it. Used to balance
+        tasks across batch jobs.
+
+        :rtype: float
+        """
+        return float(num_observations)
+
     def make_iterative_proc(self):
         """
         Should return `None` if `is_iterative()` returns `False`.
@@ -93,3 +152,6 @@ class SimpleStatistic(Statistic):
 
     def compute(self, data):
         return self.stat_func(data)
+
+    def is_blockwise(self):
+        return True
@@ -41,12 +41,30 @@ class ExternalPlugin(Statistic):
     def make_iterative_proc(self):
         return self.impl.make_iterative_proc()
 
+    def supports_native_dtypes(self) -> bool:
+        return getattr(self.impl, 'supports_native_dtypes', lambda: False)()
+
+    def needs_empty_time_slices(self) -> bool:
+        return getattr(self.impl, 'needs_empty_time_slices', lambda: False)()
+
+    def is_blockwise(self) -> bool:
+        return getattr(self.impl, 'is_blockwise', lambda: False)()
+
+    def memory_multiplier(self, num_observations: int) -> float:
+        return getattr(self.impl, 'memory_multiplier', lambda num_observations: 1.0)(num_observations)
+
+    def compute_cost(self, num_observations: int) -> float:
+        return getattr(self.impl, 'compute_cost', float)(num_observations)
+
     def measurements(self, input_measurements: Iterable[Measurement]) -> Iterable[Measurement]:
         return self.impl.measurements(input_measurements)
 
     def compute(self, data: xarray.Dataset) -> xarray.Dataset:
         return self.impl.compute(data)
 
+    def compute_native(self, data: xarray.Dataset) -> xarray.Dataset:
+        return getattr(self.impl, 'compute_native', self.impl.compute)(data)
+
     # caused trouble in unpickle stream
     # def __getattr__(self, name):
     #     # If attribute not on current object or on Statistic, try to find it on self.impl
@@ -17,6 +17,9 @@ try:
             self.eps = eps
             self.num_threads = num_threads
 
+        def is_blockwise(self):
+            return True
+
         def compute(self, data):
             """
             :param xarray.Dataset data:
@@ -82,6 +85,9 @@ try:
             self.eps = eps
             self.num_threads = num_threads
 
+        def is_blockwise(self):
+            return True
+
         def compute(self, data):
             """
             :param xarray.Dataset data:
@@ -51,6 +51,12 @@ class MaskMultiCounter(Statistic):
     def is_iterative(self):
         return True
 
+    def supports_native_dtypes(self):
+        return True
+
+    def is_blockwise(self):
+        return True
+
     def make_iterative_proc(self):
         def _to_mask(ds):
             da = first_var(ds)
@@ -9,7 +9,7 @@ import xarray
 
 from datacube.model import Measurement
 from datacube_stats.utils.dates import datetime64_to_inttime
-from datacube_stats.utils import da_nodata
+from datacube_stats.utils import da_nodata, da_is_float, da_invalid, ds_invalid, da_float_values
 from datacube_stats.stat_funcs import axisindex, argpercentile, _compute_medoid
 from datacube_stats.stat_funcs import anynan, section_by_index, medoid_indices
 
@@ -18,6 +18,12 @@ from .core import StatsProcessingError, StatsConfigurationError
 
 
 class NoneStat(Statistic):
+    def is_blockwise(self):
+        return True
+
+    def needs_empty_time_slices(self):
+        return True
+
     def compute(self, data):
         return data
 
@@ -34,10 +40,47 @@ class ReducingXarrayStatistic(Statistic):
         # TODO: Validate that reduction function exists
         self._stat_func_name = reduction_function
 
+    #: reductions that can be computed directly on data marked with `nodata` values
+    NATIVE_DTYPE_REDUCTIONS = ('min', 'max', 'count')
+
+    def is_blockwise(self):
+        return True
+
     def compute(self, data):
         func = getattr(xarray.Dataset, self._stat_func_name)
         return func(data, dim='time')
 
+    def compute_native(self, data):
+        if self._stat_func_name in self.NATIVE_DTYPE_REDUCTIONS:
+            return data.apply(self._reduce_with_nodata)
+
+        return self.compute(data)
+
+    def supports_native_dtypes(self):
+        return self._stat_func_name in self.NATIVE_DTYPE_REDUCTIONS
+
+    def _reduce_with_nodata(self, var):
+        if da_is_float(var):
+            return getattr(var, self._stat_func_name)(dim='time')
+
+        invalid = da_invalid(var)
+        axis = var.get_axis_num('time')
+
+        if self._stat_func_name == 'count':
+            return var.reduce(lambda values, axis: np.count_nonzero(~invalid, axis=axis), dim='time')
+
+        # fill missing observations with a value that never wins the reduction
+        info = np.iinfo(var.dtype)
+        fill = info.max if self._stat_func_name == 'min' else info.min
+        func = getattr(np, self._stat_func_name)
+
+        def worker(values, axis):
+            result = func(np.where(invalid, fill, values), axis=axis)
+            result[invalid.all(axis=axis)] = da_nodata(var)
+            return result
+
+        return var.reduce(worker, dim='time')
+
 
 class WofsStats(Statistic):
     """
@@ -49,6 +92,16 @@ class WofsStats(Statistic):
     def __init__(self, freq_only=False):
         self.freq_only = freq_only
 
+    def supports_native_dtypes(self):
+        return True
+
+    def memory_multiplier(self, num_observations):
+        # boolean comparisons of 8 bit data
+        return 4.0
+
+    def is_blockwise(self):
+        return True
+
     def compute(self, data):
         is_integer_type = np.issubdtype(data.water.dtype, np.integer)
 
@@ -111,6 +164,9 @@ class NormalisedDifferenceStats(Statistic):
         self.name = name
         self.clamp_outputs = clamp_outputs
 
+    def is_blockwise(self):
+        return True
+
     def compute(self, data):
         nd = (data[self.band1] - data[self.band2]) / (data[self.band1] + data[self.band2])
         outputs = {}
@@ -191,6 +247,9 @@ class TCWStats(Statistic):
         else:
             self.coeffs = coeffs
 
+    def is_blockwise(self):
+        return True
+
     def compute(self, data):
         coeffs = self.coeffs
         thresholds = self.thresholds
@@ -255,6 +314,9 @@ class PerBandIndexStat(SimpleStatistic):
             assert isinstance(per_pixel_metadata, Sequence)
             self.per_pixel_metadata = per_pixel_metadata
 
+    def needs_empty_time_slices(self):
+        return bool(self.per_pixel_metadata)
+
     def compute(self, data):
         index = super(PerBandIndexStat, self).compute(data)
 
@@ -349,17 +411,40 @@ class Percentile(PerBandIndexStat):
         self.not_valid_mark = not_valid_mark
         super(Percentile, self).__init__(per_pixel_metadata=per_pixel_metadata)
 
+    def supports_native_dtypes(self):
+        return True
+
+    def memory_multiplier(self, num_observations):
+        # 64 bit sort indices for each band, and a NaN copy of integer data
+        return 3.0
+
+    def compute_cost(self, num_observations):
+        # sorting through time
+        return float(num_observations * np.log2(num_observations + 1))
+
     def compute(self, data):
+        return self._compute(data, native=False)
+
+    def compute_native(self, data):
+        return self._compute(data, native=True)
+
+    def _compute(self, data, native):
         # calculate masks for pixel without enough data
-        arr = data.to_array().values
-        invalid = anynan(arr, axis=0)
+        if native:
+            invalid = ds_invalid(data)
+        else:
+            invalid = anynan(data.to_array().values, axis=0)
         count_valid = np.count_nonzero(~invalid, axis=0)
         not_enough = np.logical_and(count_valid < self.minimum_valid_observations,
                                     count_valid > 0)
 
         def single(q):
-            stat_func = partial(xarray.Dataset.reduce, dim='time',
-                                func=argpercentile, q=q)
+            if native:
+                def stat_func(ds):
+                    return ds.apply(lambda var: var.reduce(argpercentile, dim='time', q=q, nodata=da_nodata(var)))
+            else:
+                stat_func = partial(xarray.Dataset.reduce, dim='time',
+                                    func=argpercentile, q=q)
 
             per_pixel_metadata = self.per_pixel_metadata
 
@@ -462,6 +547,9 @@ class PercentileNoProv(Statistic):
     def __init__(self, q):
         self.q = q
 
+    def is_blockwise(self):
+        return True
+
     def compute(self, data):
         index = data.reduce(dim='time', func=argpercentile, q=self.q)
 
@@ -542,13 +630,36 @@ class Medoid(Statistic):
 
         return selected + extra
 
+    def supports_native_dtypes(self):
+        return True
+
+    def memory_multiplier(self, num_observations):
+        # pairwise differences between all the observations of every band
+        return num_observations + 2.0
+
+    def compute_cost(self, num_observations):
+        # pairwise differences again
+        return float(num_observations) ** 2
+
+    def is_blockwise(self):
+        return True
+
     def compute(self, data):
+        return self._compute(data, native=False)
+
+    def compute_native(self, data):
+        return self._compute(data, native=True)
+
+    def _compute(self, data, native):
         # calculate medoid using only the fields in `input_measurements`
         input_data = data[select_names(self.input_measurements,
                                        list(data.data_vars))]
 
         # calculate medoid indices
-        arr = input_data.to_array().values
+        if native:
+            arr = np.stack([da_float_values(var) for var in input_data.data_vars.values()])
+        else:
+            arr = input_data.to_array().values
         invalid = anynan(arr, axis=0)
         index = medoid_indices(arr, invalid)
 
@@ -1,58 +1,74 @@
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Iterator
 from functools import partial
 
 import fiona
+import numpy as np
+from shapely.strtree import STRtree
 from datacube import Datacube
 from datacube.api import GridWorkflow, Tile
 from datacube.api.query import query_group_by, query_geopolygon
 from datacube.model import GridSpec
-from datacube.utils.geometry import CRS, GeoBox, Geometry
+from datacube.utils.geometry import CRS, GeoBox, Geometry, box, unary_union
 
 from datacube_stats.models import StatsTask
 from datacube_stats.utils.dates import filter_time_by_source
 from datacube_stats.utils.tide_utility import features_from_file, get_filter_product
 from .models import DataSource
-from .utils import report_unmatched_datasets
-from .utils.query import multi_product_list_cells
+from .utils import report_unmatched_datasets, prefetch_map
+from .utils.query import list_period_cells, match_period_cells
 from .utils.timer import MultiTimer
 
+#: The precision to which source times are matched against the times chosen by each filter_product method
+_FILTER_TIME_UNITS = {'by_hydrological_months': 'D', 'by_tide_height': 's'}
+
 DEFAULT_GROUP_BY = 'time'
 
 _LOG = logging.getLogger(__name__)
 
 
-def select_task_generator(input_region, storage, filter_product):
+def select_task_generator(input_region, storage, filter_product, workers=0, ordered=True):
+    """
+    The task generator for `input_region`.
+
+    :param workers: number of threads planning tasks (and querying the index) concurrently
+    :param ordered: whether tasks planned concurrently are generated in a deterministic order
+    """
     if input_region is None or input_region == {}:
         _LOG.info('No input_region specified. Generating full available spatial region, gridded files.')
-        return GriddedTaskGenerator(storage)
+        return GriddedTaskGenerator(storage, workers=workers)
 
     elif 'geometry' in input_region:  # Larger spatial region
         # A large, multi-tile input region, specified as geojson. Output will be individual tiles.
         geometry = Geometry(input_region['geometry'], CRS('EPSG:4326'))  # GeoJSON is always 4326
-        return GriddedTaskGenerator(storage, geopolygon=geometry, tile_indexes=input_region.get('tiles'))
+        return GriddedTaskGenerator(storage, geopolygon=geometry, tile_indexes=input_region.get('tiles'),
+                                    workers=workers)
 
     elif 'tile' in input_region:  # For one tile
-        return GriddedTaskGenerator(storage, tile_indexes=[input_region['tile']])
+        return GriddedTaskGenerator(storage, tile_indexes=[input_region['tile']], workers=workers)
 
     elif 'tiles' in input_region:  # List of tiles
-        return GriddedTaskGenerator(storage, tile_indexes=input_region['tiles'])
+        return GriddedTaskGenerator(storage, tile_indexes=input_region['tiles'], workers=workers)
 
     elif 'from_file' in input_region:
         _LOG.info('Input spatial region specified by file: %s', input_region['from_file'])
 
         if 'feature_id' in input_region or input_region.get('gridded') is False:
             _LOG.info('Generating tasks based on feature polygons.')
-            features = features_from_file(input_region['from_file'], input_region.get('feature_id'))
+            features = list(features_from_file(input_region['from_file'], input_region.get('feature_id')))
 
             return NonGriddedTaskGenerator(input_region=input_region,
                                            filter_product=filter_product,
-                                           features=features, storage=storage)
+                                           features=features, storage=storage,
+                                           workers=workers, ordered=ordered)
 
         else:
             _LOG.info('Generating tasks based on grid.')
             geometry = boundary_polygon_from_file(input_region['from_file'])
-            return GriddedTaskGenerator(storage, geopolygon=geometry)
+            return GriddedTaskGenerator(storage, geopolygon=geometry, workers=workers)
     else:
         _LOG.info('Generating statistics for an ungridded `input region`. Output as a single file.')
         return NonGriddedTaskGenerator(input_region=input_region, storage=storage,
@@ -72,82 +88,129 @@ def boundary_polygon_from_file(filename: str) -> Geometry:
 
 
 class GriddedTaskGenerator:
-    def __init__(self, storage, geopolygon=None, tile_indexes=None):
+    def __init__(self, storage, geopolygon=None, tile_indexes=None, workers=0):
         self.grid_spec = _make_grid_spec(storage)
         self.geopolygon = geopolygon
         self.tile_indexes = tile_indexes
+        self.workers = workers
         self._total_unmatched = 0
 
+    def input_geopolygon(self):
+        """ The region tasks are generated for, or `None` for everywhere. """
+        if self.geopolygon is not None or self.tile_indexes is None:
+            return self.geopolygon
+        return unary_union(self.grid_spec.tile_geobox(tuple(tile_index)).extent for tile_index in self.tile_indexes)
+
     def __call__(self, index, sources_spec, date_ranges) -> Iterator[StatsTask]:
         """
         Generate the required tasks through time and across a spatial grid.
 
-        Input region can be limited by specifying either/or both of `geopolygon` and `cell_index`, which
+        Input region can be limited by specifying either/or both of `geopolygon` and `tile_indexes`, which
         will both result in only datasets covering the poly or cell to be included.
 
         :param index: Datacube Index
         :return:
         """
         workflow = GridWorkflow(index, grid_spec=self.grid_spec)
-
-        for time_period in date_ranges:
-            _LOG.info('Making output product tasks for time period: %s', time_period)
-            timer = MultiTimer().start('creating_tasks')
-            created_tasks = 0
-
-            if self.tile_indexes is not None:
-                for tile_index in self.tile_indexes:
-                    _LOG.debug('task for tile %s', tile_index)
-                    for task in self.collect_tasks(workflow, time_period, sources_spec, tile_index):
-                        created_tasks += 1
-                        yield task
-            else:
-                for task in self.collect_tasks(workflow, time_period, sources_spec):
-                    created_tasks += 1
-                    yield task
-
-            # is timing it still appropriate here?
+        date_ranges = list(date_ranges)
+
+        # The index is queried once over all time periods (and all of the requested
+        # tiles), and the tasks are then handed out one time period at a time, as soon as they are ready
+        timer = MultiTimer().start('creating_tasks')
+        total = 0
+        for time_period, tasks in zip(date_ranges, self.collect_tasks_by_period(workflow, date_ranges,
+                                                                                sources_spec, self.tile_indexes)):
             timer.pause('creating_tasks')
-            if created_tasks:
-                _LOG.info('Created %s tasks for time period: %s. In: %s',
-                          created_tasks, time_period, timer)
+            _LOG.info('Making output product tasks for time period: %s', time_period)
+            yield from tasks
+
+            if tasks:
+                _LOG.info('Created %s tasks for time period: %s', len(tasks), time_period)
+            total += len(tasks)
+            timer.start('creating_tasks')
+
+        timer.pause('creating_tasks')
+        _LOG.info('Created %s tasks for %s time periods. In: %s', total, len(date_ranges), timer)
 
-    def collect_tasks(self, workflow, time_period, sources_spec, tile_index=None):
+    def collect_tasks(self, workflow, time_period, sources_spec, tile_indexes=None):
         """ Collect tasks for a time period. """
+        return next(self.collect_tasks_by_period(workflow, [time_period], sources_spec, tile_indexes))
+
+    def collect_tasks_by_period(self, workflow, time_periods, sources_spec, tile_indexes=None):
+        """
+        Collect tasks for each of a list of time periods, with a single index query per product.
+        The list of tasks of each period is generated as soon as it is ready, in the order of `time_periods`.
+        Datasets are assigned to the periods by their `center_time`, see :func:`.utils.query.list_period_cells`.
+
+        If `tile_indexes` are given, tasks are only generated for (and in the order of) those tiles.
+        With `workers`, the products of all of the sources are queried concurrently, and then the
+        tasks of that many periods are collected concurrently, on the same threads.
+        """
         # Tasks are grouped by tile_index, and may contain sources from multiple places
         # Each source may be masked by multiple masks
 
         # pylint: disable=too-many-locals
-        tasks = {}
-
+        sources = []
         for source_index, source_spec in enumerate(sources_spec):
-            ep_range = filter_time_by_source(source_spec.get('time'), time_period)
-            if ep_range is None:
-                _LOG.info("Datasets not included for %s and time range for %s", source_spec['product'], time_period)
-                continue
-            group_by_name = source_spec.get('group_by', DEFAULT_GROUP_BY)
-
-            products = [source_spec['product']] + [mask['product'] for mask in source_spec.get('masks', [])]
-
+            ep_ranges = {}
+            for period_index, time_period in enumerate(time_periods):
+                ep_range = filter_time_by_source(source_spec.get('time'), time_period)
+                if ep_range is None:
+                    _LOG.info("Datasets not included for %s and time range for %s",
+                              source_spec['product'], time_period)
+                    continue
+                ep_ranges[period_index] = ep_range
+
+            if ep_ranges:
+                products = [source_spec['product']] + [mask['product'] for mask in source_spec.get('masks', [])]
+                sources.append((source_index, source_spec, ep_ranges, products))
+
+        if tile_indexes is not None:
+            tile_order = list(OrderedDict.fromkeys(tuple(tile_index) for tile_index in tile_indexes))
+
+        def list_cells(query):
+            (_, source_spec, ep_ranges, products), product = query
             product_query = {products[0]: {'source_filter': source_spec.get('source_filter', None)}}
+            return list_period_cells(product, workflow, list(ep_ranges.values()),
+                                     cell_indexes=tile_indexes,
+                                     product_query=product_query,
+                                     group_by=source_spec.get('group_by', DEFAULT_GROUP_BY),
+                                     geopolygon=self.geopolygon)
+
+        def period_tasks(period_index):
+            tasks = OrderedDict()
+            unmatched = 0
+            for (source_index, source_spec, ep_ranges, _), obs in zip(sources, source_obs):
+                if period_index not in ep_ranges:
+                    continue
+
+                ep_range = ep_ranges[period_index]
+                (data, *masks), unmatched_ = match_period_cells(obs, ep_range,
+                                                                group_by=source_spec.get('group_by', DEFAULT_GROUP_BY))
+                unmatched += report_unmatched_datasets(unmatched_[0], _LOG.warning)
+
+                for tile, tile_sources in data.items():
+                    task = tasks.setdefault(tile, StatsTask(time_period=ep_range,
+                                                            spatial_id={'x': tile[0], 'y': tile[1]}))
+                    task.sources.append(DataSource(data=tile_sources,
+                                                   masks=[mask.get(tile) for mask in masks],
+                                                   spec=source_spec,
+                                                   source_index=source_index))
 
-            (data, *masks), unmatched_ = multi_product_list_cells(products, workflow,
-                                                                  product_query=product_query,
-                                                                  cell_index=tile_index,
-                                                                  time=ep_range,
-                                                                  group_by=group_by_name,
-                                                                  geopolygon=self.geopolygon)
+            if tile_indexes is None:
+                return list(tasks.values()), unmatched
+            return [tasks[tile] for tile in tile_order if tile in tasks], unmatched
 
-            self._total_unmatched += report_unmatched_datasets(unmatched_[0], _LOG.warning)
+        # a single thread pool for the index queries of all products and the tasks of all periods
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as executor:
+            queries = [(source, product) for source in sources for product in source[3]]
+            observations = iter(prefetch_map(list_cells, queries, prefetch=self.workers, executor=executor))
+            source_obs = [[next(observations) for _ in products] for _, _, _, products in sources]
 
-            for tile, sources in data.items():
-                task = tasks.setdefault(tile, StatsTask(time_period=ep_range, spatial_id={'x': tile[0], 'y': tile[1]}))
-                task.sources.append(DataSource(data=sources,
-                                               masks=[mask.get(tile) for mask in masks],
-                                               spec=source_spec,
-                                               source_index=source_index))
-
-        return list(tasks.values())
+            for tasks, unmatched in prefetch_map(period_tasks, range(len(time_periods)),
+                                                 prefetch=self.workers, executor=executor):
+                self._total_unmatched += unmatched
+                yield tasks
 
     def __del__(self):
         if self._total_unmatched > 0:
@@ -177,13 +240,26 @@ class NonGriddedTaskGenerator:
 
     :param input_region:
     :param storage:
+    :param workers: number of threads planning the tasks of different features concurrently
+    :param ordered: whether to generate tasks in the order of the features, rather than as soon as they are ready
     """
 
-    def __init__(self, input_region, filter_product, storage, features=None):
+    def __init__(self, input_region, filter_product, storage, features=None, workers=0, ordered=True):
         self.input_region = input_region
         self.filter_product = filter_product
         self.features = features
         self.storage = storage
+        self.workers = workers
+        self.ordered = ordered
+
+    def input_geopolygon(self):
+        """ The region tasks are generated for, or `None` if there are no features to generate them for. """
+        if self.features is None:
+            return query_geopolygon(**self.input_region)
+        if not self.features:
+            return None
+        crs = self.features[0].geopolygon.crs
+        return unary_union(feature.geopolygon.to_crs(crs) for feature in self.features)
 
     def set_task(self, task, filtered_times):
         """
@@ -192,26 +268,30 @@ class NonGriddedTaskGenerator:
         :param filtered_times: Filtered date/times depending on products
         :return: new task sources
         """
-        remove_index_list = list()
+        method = self.filter_product.get('method')
+        if method not in _FILTER_TIME_UNITS:
+            raise ValueError('Unknown filter_product method: {}'.format(method))
+
+        # filtered times are strings, either dates or times to the second
+        unit = 'M8[{}]'.format(_FILTER_TIME_UNITS[method])
+        filtered_times = np.array(filtered_times, dtype=unit)
 
-        for i, sr in enumerate(task.sources):
+        sources = []
+        for sr in task.sources:
             v = sr.data
-            if self.filter_product.get('method') == "by_hydrological_months":
-                all_dates = [s.strftime("%Y-%m-%d") for s in
-                             v.sources.time.values.astype('M8[s]').astype('O').tolist()]
-            elif self.filter_product.get('method') == "by_tide_height":
-                all_dates = [s.strftime("%Y-%m-%dT%H:%M:%S") for s in
-                             v.sources.time.values.astype('M8[s]').astype('O').tolist()]
-            if set(all_dates) & set(filtered_times):
-                v.sources = v.sources.isel(time=[i for i, item in enumerate(all_dates) if item in
-                                                 filtered_times])
+            times = v.sources.time.values.astype('M8[s]').astype(unit)
+            included = np.flatnonzero(np.isin(times, filtered_times))
+            if len(included) > 0:
+                v.sources = v.sources.isel(time=included)
                 _LOG.info("source included %s", v.sources.time)
-            else:
-                remove_index_list.append(i)
-        if len(remove_index_list) > 0:
-            # NOTE pretty sure this should not work
-            for i in remove_index_list:
-                del task.sources[i]
+                # masks are matched to the data by time, keep the same time slices of them
+                for m in sr.masks:
+                    if m is not None:
+                        m.sources = m.sources.isel(time=np.flatnonzero(np.isin(m.sources.time.values,
+                                                                               v.sources.time.values)))
+                sources.append(sr)
+
+        task.sources = sources
         return task
 
     def filter_task(self, task, feature, date_ranges):
@@ -221,17 +301,13 @@ class NonGriddedTaskGenerator:
         :param date_ranges: This is passed onto filter product function as epoch range
         :return: new task in case of filtering
         """
-        all_source_times = list()
         if self.filter_product is not None and self.filter_product != {}:
-            for sr in task.sources:
-                v = sr.data
-                all_source_times = (all_source_times +
-                                    [dd for dd in v.sources.time.data.astype('M8[s]').astype('O').tolist()])
-            all_source_times = sorted(all_source_times)
+            all_source_times = np.sort(np.concatenate([sr.data.sources.time.values.astype('M8[s]')
+                                                       for sr in task.sources]))
 
             extra_fn_args, filtered_times = get_filter_product(self.filter_product,
                                                                feature,
-                                                               all_source_times, date_ranges)
+                                                               all_source_times.astype('O').tolist(), date_ranges)
             _LOG.info("Filtered times %s", filtered_times)
             task = self.set_task(task, filtered_times)
 
@@ -250,49 +326,65 @@ class NonGriddedTaskGenerator:
         if features is None:
             # input region not from a shapefile
             features = [None]
+            bulk_tile_maker = None
+        elif not features:
+            _LOG.warning('No features in %s, no tasks to generate', self.input_region.get('from_file'))
+            return
+        else:
+            bulk_tile_maker = BulkTileMaker(features, self.storage)
 
-        for feature in features:
-
-            if feature is None or feature.id is None:
-                feature_id = '(none)'
-            else:
-                feature_id = str(feature.id)
-
-            for time_period in date_ranges:
-                task = StatsTask(time_period=time_period, spatial_id={'feature_id': feature_id}, feature=feature)
-                _LOG.info('Making output product tasks for time period: %s, feature: %s', time_period, feature_id)
-
-                for source_index, source_spec in enumerate(sources_spec):
-                    ep_range = filter_time_by_source(source_spec.get('time'), time_period)
-                    if ep_range is None:
-                        _LOG.info("Datasets not included for %s and time range for %s", source_spec['product'],
-                                  time_period)
-                        continue
+        date_ranges = list(date_ranges)
 
-                    # Build Tile
-                    make_tile = partial(ArbitraryTileMaker(self.input_region, feature, self.storage),
-                                        index=index, time=ep_range,
-                                        group_by=source_spec.get('group_by', DEFAULT_GROUP_BY))
+        def feature_tasks(feature):
+            return list(self._feature_tasks(index, feature, sources_spec, date_ranges, bulk_tile_maker))
 
-                    data = make_tile(product=source_spec['product'])
-                    masks = [make_tile(product=mask['product'])
-                             for mask in source_spec.get('masks', [])]
+        for tasks in prefetch_map(feature_tasks, features, prefetch=self.workers, ordered=self.ordered):
+            yield from tasks
 
-                    if len(data.sources.time) == 0:
-                        _LOG.info("No matched for product %s", source_spec['product'])
-                        continue
+    def _feature_tasks(self, index, feature, sources_spec, date_ranges, bulk_tile_maker):
+        if feature is None or feature.id is None:
+            feature_id = '(none)'
+        else:
+            feature_id = str(feature.id)
 
-                    task.sources.append(DataSource(data=data,
-                                                   masks=masks,
-                                                   spec=source_spec,
-                                                   source_index=source_index))
+        for time_period in date_ranges:
+            task = StatsTask(time_period=time_period, spatial_id={'feature_id': feature_id}, feature=feature)
+            _LOG.info('Making output product tasks for time period: %s, feature: %s', time_period, feature_id)
+
+            for source_index, source_spec in enumerate(sources_spec):
+                ep_range = filter_time_by_source(source_spec.get('time'), time_period)
+                if ep_range is None:
+                    _LOG.info("Datasets not included for %s and time range for %s", source_spec['product'],
+                              time_period)
+                    continue
+
+                # Build Tile
+                if bulk_tile_maker is not None:
+                    tile_maker = partial(bulk_tile_maker, feature=feature)
+                else:
+                    tile_maker = ArbitraryTileMaker(self.input_region, feature, self.storage)
+                make_tile = partial(tile_maker, index=index, time=ep_range,
+                                    group_by=source_spec.get('group_by', DEFAULT_GROUP_BY))
+
+                data = make_tile(product=source_spec['product'])
+                masks = [make_tile(product=mask['product'])
+                         for mask in source_spec.get('masks', [])]
+
+                if len(data.sources.time) == 0:
+                    _LOG.info("No matched for product %s", source_spec['product'])
+                    continue
+
+                task.sources.append(DataSource(data=data,
+                                               masks=masks,
+                                               spec=source_spec,
+                                               source_index=source_index))
 
-                _LOG.info("make tile finished")
-                if task.sources:
-                    # Function which takes a Tile, containing sources, and returns a new 'filtered' Tile
-                    task = self.filter_task(task, feature, date_ranges)
-                    _LOG.info('Created task for time period: %s', time_period)
-                    yield task
+            _LOG.info("make tile finished")
+            if task.sources:
+                # Function which takes a Tile, containing sources, and returns a new 'filtered' Tile
+                task = self.filter_task(task, feature, date_ranges)
+                _LOG.info('Created task for time period: %s', time_period)
+                yield task
 
 
 class ArbitraryTileMaker:
@@ -312,7 +404,6 @@ class ArbitraryTileMaker:
 
     def __call__(self, index, product, time, group_by) -> Tile:
         # Do for a specific poly whose boundary is known
-        output_crs = CRS(self.storage['crs'])
         filtered_items = ['geopolygon', 'lon', 'lat', 'longitude', 'latitude', 'x', 'y']
         filtered_dict = {k: v for k, v in self.input_region.items() if k in filtered_items}
         if self.feature is not None:
@@ -323,10 +414,77 @@ class ArbitraryTileMaker:
 
         dc = Datacube(index=index)
         datasets = dc.find_datasets(product=product, time=time, group_by=group_by, **filtered_dict)
-        group_by = query_group_by(group_by=group_by)
-        sources = dc.group_datasets(datasets, group_by)
-        output_resolution = [self.storage['resolution'][dim] for dim in output_crs.dimensions]
-        geopoly = geopoly.to_crs(output_crs)
-        geobox = GeoBox.from_geopolygon(geopoly, resolution=output_resolution)
+        return _make_tile(datasets, geopoly, group_by, self.storage)
+
+
+class BulkTileMaker:
+    """
+    Create :class:`Tile` objects for many features, with one dataset search per product and time range.
+
+    Datasets are searched for over the bounding box of all of the features, and then assigned
+    to the features that they intersect using a spatial index of their footprints.
 
-        return Tile(sources, geobox)
+    :param features: the features tiles will be made for, all in the same CRS
+    """
+
+    def __init__(self, features, storage):
+        self.storage = storage
+        self.crs = features[0].crs
+        bounds = [feature.geopolygon.to_crs(self.crs).boundingbox for feature in features]
+        self.geopolygon = box(min(bbox.left for bbox in bounds), min(bbox.bottom for bbox in bounds),
+                              max(bbox.right for bbox in bounds), max(bbox.top for bbox in bounds),
+                              self.crs)
+        self._searches = {}
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def __call__(self, index, feature, product, time, group_by) -> Tile:
+        geopoly = feature.geopolygon
+        datasets = self._datasets_intersecting(index, product, time, geopoly.to_crs(self.crs))
+        return _make_tile(datasets, geopoly, group_by, self.storage)
+
+    def _datasets_intersecting(self, index, product, time, geopoly):
+        key = (product, tuple(time))
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        # features are searched concurrently when generating tasks with workers
+        with key_lock:
+            if key not in self._searches:
+                datasets = Datacube(index=index).find_datasets(product=product, time=time, geopolygon=self.geopolygon)
+                self._searches[key] = _FootprintIndex(datasets, self.crs)
+
+        return self._searches[key].intersecting(geopoly)
+
+
+class _FootprintIndex:
+    """ A spatial index of dataset footprints (in a given CRS). """
+
+    def __init__(self, datasets, crs):
+        self.datasets = datasets
+        self.footprints = [dataset.extent.to_crs(crs).geom for dataset in datasets]
+        self.tree = STRtree(self.footprints) if self.footprints else None
+        self._positions = {id(footprint): position for position, footprint in enumerate(self.footprints)}
+
+    def intersecting(self, geopoly):
+        """ The datasets whose footprints intersect `geopoly`, in their original order. """
+        if self.tree is None:
+            return []
+
+        geom = geopoly.geom
+        candidates = self.tree.query(geom)
+        if len(candidates) > 0 and not isinstance(candidates[0], (int, np.integer)):
+            # shapely < 2 returns the geometries themselves
+            candidates = [self._positions[id(footprint)] for footprint in candidates]
+
+        return [self.datasets[position] for position in sorted(candidates)
+                if geom.intersects(self.footprints[position])]
+
+
+def _make_tile(datasets, geopoly, group_by, storage) -> Tile:
+    """ A tile of `datasets` covering `geopoly`, in the output CRS and resolution of `storage`. """
+    output_crs = CRS(storage['crs'])
+    sources = Datacube.group_datasets(datasets, query_group_by(group_by=group_by))
+    output_resolution = [storage['resolution'][dim] for dim in output_crs.dimensions]
+    geobox = GeoBox.from_geopolygon(geopoly.to_crs(output_crs), resolution=output_resolution)
+
+    return Tile(sources, geobox)
@@ -1,25 +1,31 @@
 """
 Useful utilities used in Stats
 """
+import heapq
 import itertools
+import re
 import pickle
 import functools
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 from typing import Dict, Iterator, Tuple, Iterable, Any
 
 import cloudpickle
 import numpy as np
 import xarray
 import click
-from datetime import timezone
+from datetime import datetime, timezone
 from datetime import timedelta
 
-from datacube.api.query import Query
+from datacube.api.query import Query, solar_offset
 
 from datacube.storage.masking import mask_invalid_data, create_mask_value
 from datacube.api import Tile
-from datacube.model import Range
 from datacube.ui.task_app import pickle_stream, unpickle_stream
 
+from .query_cache import query_key, product_state
+
 
 def tile_iter(tile: Tile, chunk_size: Dict[str, int]) -> Iterator[Tuple[None, slice, slice]]:
     """
@@ -51,6 +57,26 @@ def _slicify(step, size):
         return (slice(i, min(i + step, size)) for i in range(0, size, step))
 
 
+_MEMORY_UNITS = {'': 1, 'B': 1,
+                 'KB': 10 ** 3, 'MB': 10 ** 6, 'GB': 10 ** 9, 'TB': 10 ** 12,
+                 'KIB': 2 ** 10, 'MIB': 2 ** 20, 'GIB': 2 ** 30, 'TIB': 2 ** 40}
+
+
+def parse_memory_size(size) -> int:
+    """
+    Number of bytes in `size`, given either as a number of bytes or as a string like `4GB` or `512MiB`.
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([A-Za-z]*)\s*', str(size))
+    if match is None or match.group(2).upper() not in _MEMORY_UNITS:
+        raise ValueError('Not a memory size: {!r}'.format(size))
+
+    number, unit = match.groups()
+    return int(float(number) * _MEMORY_UNITS[unit.upper()])
+
+
 def first(xs):
     """ Get first element from a sequence
     """
@@ -123,6 +149,93 @@ def da_nodata(da, default=None):
     return 0
 
 
+def da_invalid(da):
+    """
+    Mask of missing observations in DataArray, as an ndarray
+
+      NaN for floating point arrays
+      the `nodata` value for everything else, if it is set
+    """
+    block_valid = _block_valid(da)
+    if block_valid is None:
+        return np.zeros(da.shape, dtype=bool)
+    return ~block_valid(da.values)
+
+
+def ds_invalid(ds: xarray.Dataset):
+    """
+    Mask of observations missing from any of the data variables of a dataset
+    """
+    invalid = None
+    for da in ds.data_vars.values():
+        if invalid is None:
+            invalid = da_invalid(da)
+        else:
+            invalid |= da_invalid(da)
+    return invalid
+
+
+def da_float_values(da):
+    """
+    Values of DataArray as floating point, with NaN for missing observations.
+    Floating point arrays are returned as they are, without a copy.
+    """
+    if da_is_float(da):
+        return da.values
+
+    values = da.values.astype(np.result_type(da.dtype, np.float32))
+    values[da_invalid(da)] = np.nan
+    return values
+
+
+def iter_blocks(values: np.ndarray, block_size=2 ** 16) -> Iterator[np.ndarray]:
+    """
+    Split an array into views of about `block_size` elements, in memory order, without copying it.
+    """
+    if values.ndim == 0:
+        yield values
+        return
+
+    inner_size = values[0].size if values.shape[0] > 0 else 0
+    if values.ndim == 1 or inner_size <= block_size:
+        step = max(1, block_size // max(inner_size, 1))
+        for i in range(0, values.shape[0], step):
+            yield values[i:i + step]
+    else:
+        for part in values:
+            yield from iter_blocks(part, block_size)
+
+
+def _block_valid(da):
+    """
+    Function finding valid observations in a block of values of DataArray, the opposite of :func:`da_invalid`,
+    or `None` if they are all valid (for non floating point arrays without `nodata`).
+    """
+    if da_is_float(da):
+        return lambda block: ~np.isnan(block)
+
+    nodata = getattr(da, 'nodata', None)
+    if nodata is None:
+        return None
+    return lambda block: block != nodata
+
+
+def ds_completely_invalid(ds: xarray.Dataset) -> bool:
+    """
+    Check if there are no valid observations at all in a dataset, stopping at the first block with one.
+    """
+    for da in ds.data_vars.values():
+        block_valid = _block_valid(da)
+        if block_valid is None:
+            return False
+
+        for block in iter_blocks(da.values):
+            if block_valid(block).any():
+                return False
+
+    return True
+
+
 def nodata_like(ds):
     """Similar to xarray.full_like but filled with nodata value or with NaN for
     floating point variables.
@@ -387,33 +500,113 @@ def sorted_interleave(*iterators, key=lambda x: x, reverse=False):
             vv.append(x)
 
 
-def _find_periods_with_data(index, product_names, period_duration='1 day',
-                            start_date='1985-01-01', end_date='2000-01-01'):
+def prefetch_map(func, items, prefetch=0, ordered=True, executor=None):
     """
-    Search the datacube and find which periods contain data
+    Like `map`, but with up to `prefetch` calls running ahead on background threads.
+
+    Results are returned in the order of `items`, and no more than `prefetch + 1` of them are
+    ever held waiting. With `prefetch` of 0 every call is made in the calling thread, on demand.
+
+    If not `ordered`, results are instead returned as soon as they are ready.
+    Calls run on `executor` if given, eg. to share one thread pool between several maps.
+    """
+    if prefetch <= 0:
+        for item in items:
+            yield func(item)
+        return
+
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            yield from prefetch_map(func, items, prefetch, ordered, executor)
+        return
+
+    if not ordered:
+        yield from _unordered_prefetch_map(executor, func, items, prefetch)
+        return
+
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) > prefetch:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def _unordered_prefetch_map(executor, func, items, prefetch):
+    pending = set()
+    for item in items:
+        pending.add(executor.submit(func, item))
+        if len(pending) > prefetch:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+    for future in as_completed(pending):
+        yield future.result()
+
+
+def balanced_shards(costs, num_shards):
+    """
+    Split items with the given `costs` into `num_shards` groups of similar total cost.
+
+    Items are handed out most costly first, each to the group with the least total cost
+    so far (longest processing time first scheduling).
+
+    :return: list of `num_shards` sorted lists of item positions
+    """
+    shards = [[] for _ in range(num_shards)]
+    loads = [(0.0, shard) for shard in range(num_shards)]
+
+    for position in sorted(range(len(costs)), key=lambda position: costs[position], reverse=True):
+        load, shard = heapq.heappop(loads)
+        shards[shard].append(position)
+        heapq.heappush(loads, (load + costs[position], shard))
+
+    return [sorted(shard) for shard in shards]
+
+
+def _find_periods_with_data(index, product_names, start_date='1985-01-01', end_date='2000-01-01',
+                            geopolygon=None, cache=None):
+    """
+    Search the datacube and find which days contain data
 
     This is very useful when running stats in the `daily` mode (which outputs a file for each day). It is
     very slow to create an output for every day regardless of data availability, so it is better to only find
     the useful days at the beginning.
 
+    All of the products are searched at once, returning only the time of each dataset. Days are solar days
+    at the middle of `geopolygon` (UTC days without one), returned as the UTC periods they span.
+
+    :param geopolygon: the input region to search
+    :param DatasetQueryCache cache: to reuse the days found by the same search, while the products are unchanged
     :return: sequence of (start_date, end_date) tuples
     """
-    # TODO: Read 'simple' job configuration from file
-    # TODO: need get rid of the hard-coded query
-    query = dict(y=(-41*(40000-1600), -41*40000), x=(15*40000, 15*(40000+1600)),
-                 crs='EPSG:3577', time=(start_date, end_date))
-
-    valid_dates = set()
-    for product in product_names:
-        counts = index.datasets.count_product_through_time(period_duration, product=product,
-                                                           **Query(**query).search_terms)
-        for time_range, count in counts:
-            if count > 0:
-                time_range = Range(time_range.begin.astimezone(timezone.utc),
-                                   time_range.end.astimezone(timezone.utc))
-                valid_dates.add(time_range)
-    for time_range in sorted(valid_dates):
-        yield time_range.begin, time_range.end
+    query = Query(geopolygon=geopolygon, time=(start_date, end_date)).search_terms
+    offset = timedelta(0) if geopolygon is None else solar_offset(geopolygon)
+
+    key = query_key(dict(query, product=sorted(product_names), solar_offset=offset.total_seconds()))
+    state = json.dumps([product_state(index, product) for product in sorted(product_names)]) if cache else None
+
+    days = cache.get_result(key, state) if cache else None
+    if days is None:
+        times = index.datasets.search_returning(('time',), product=list(product_names), **query)
+        days = sorted({str((_range_middle(row.time).astimezone(timezone.utc) + offset).date()) for row in times})
+        if cache:
+            cache.put_result(key, state, days)
+
+    for day in days:
+        begin = datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=timezone.utc) - offset
+        yield begin, begin + timedelta(days=1)
+
+
+def _range_middle(time):
+    """ The middle of a time range, as returned by a search (like the `center_time` of a dataset). """
+    begin, end = getattr(time, 'lower', None), getattr(time, 'upper', None)
+    if begin is None:
+        begin, end = time.begin, time.end
+    return begin + (end - begin) / 2
 
 
 class Slice(click.ParamType):
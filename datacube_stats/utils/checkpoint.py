@@ -0,0 +1,103 @@
+"""
+Chunk-level checkpoints of partially written output files, to resume interrupted tasks.
+
+While a task runs, the chunks written to each temporary output file are recorded in a
+manifest next to it. When an interrupted task is run again, the output driver reopens its
+temporary files, and the chunks already in all of their manifests are skipped.
+
+Iterative statistics can also save their accumulated state every so many time slices, so
+that a chunk interrupted half way through its time series does not start over either.
+"""
+import logging
+import os
+from pathlib import Path
+from typing import Optional, Tuple
+
+import cloudpickle
+from boltons import fileutils
+
+_LOG = logging.getLogger(__name__)
+
+
+def chunk_key(chunk: Tuple[slice, slice, slice]) -> str:
+    """ A name for the spatial extent of `chunk`, eg. ``'0-200_400-600'``, usable in file names. """
+    return '_'.join('{}-{}'.format(s.start, s.stop) for s in chunk[1:])
+
+
+class ChunkManifest:
+    """
+    The chunks written to a temporary output file, one line per chunk in a text file.
+
+    Each line is flushed to disk before the next chunk is started, and a line cut short by
+    the process being killed is ignored.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+        if self.path.exists():
+            with self.path.open() as fl:
+                # the last item is either empty or an incomplete line
+                self.chunks = set(fl.read().split('\n')[:-1])
+        else:
+            self.chunks = set()
+
+    def add(self, chunk):
+        key = chunk_key(chunk)
+        if key in self.chunks:
+            return
+
+        with self.path.open('a') as fl:
+            fl.write(key + '\n')
+            fl.flush()
+            os.fsync(fl.fileno())
+        self.chunks.add(key)
+
+    def remove(self):
+        if self.path.exists():
+            self.path.unlink()
+
+    def __contains__(self, chunk):
+        return chunk_key(chunk) in self.chunks
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __repr__(self):
+        return 'ChunkManifest({}, {} chunks)'.format(self.path, len(self.chunks))
+
+
+class IterativeCheckpoint:
+    """
+    The state of the iterative statistics of a chunk, saved every `every` time slices.
+
+    The state is the list of `proc` functions (see :meth:`Statistic.make_iterative_proc`),
+    pickled along with the number of time slices of each source they have been given.
+    """
+
+    def __init__(self, path: Path, every: int):
+        self.path = Path(path)
+        self.every = every
+
+    def load(self) -> Optional[tuple]:
+        """ The saved `(procs, consumed)`, or `None` if there is no usable saved state. """
+        if not self.path.exists():
+            return None
+
+        try:
+            with self.path.open('rb') as fl:
+                return cloudpickle.load(fl)
+        except Exception as e:  # pylint: disable=broad-except
+            _LOG.warning('Ignoring unreadable checkpoint %s: %s', self.path, e)
+            return None
+
+    def save(self, procs, consumed):
+        with fileutils.atomic_save(str(self.path), text_mode=False) as fl:
+            cloudpickle.dump((procs, list(consumed)), fl)
+
+    def remove(self):
+        if self.path.exists():
+            self.path.unlink()
+
+    def __repr__(self):
+        return 'IterativeCheckpoint({}, every={})'.format(self.path, self.every)
@@ -0,0 +1,71 @@
+"""
+Run tasks on a pool of local worker processes, without needing digitalearthau.
+"""
+import logging
+import multiprocessing
+import threading
+
+_LOG = logging.getLogger(__name__)
+
+
+class ProcessPoolRunner:
+    """
+    Runs a function over each of a stream of tasks, on a pool of worker processes.
+
+    Tasks are only taken from the stream as workers become free, so that no more than
+    `max_pending` of them are waiting in memory at once, and each worker process is
+    replaced with a fresh one after `tasks_per_worker` tasks, so that memory
+    fragmentation does not build up over a long run.
+
+    :param int workers: number of worker processes, by default one per CPU
+    :param int tasks_per_worker: tasks each worker runs before being replaced, or `None` to never replace them
+    :param int max_pending: tasks submitted but not yet finished, by default twice the number of workers
+    """
+
+    def __init__(self, workers=None, tasks_per_worker=None, max_pending=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.tasks_per_worker = tasks_per_worker or None
+        self.max_pending = max_pending or 2 * self.workers
+
+    def __call__(self, tasks, task_runner):
+        """
+        Run `task_runner` on every task.
+
+        :return: the number of tasks run successfully, and the number that failed
+        """
+        free = threading.BoundedSemaphore(self.max_pending)
+        lock = threading.Lock()
+        counts = {True: 0, False: 0}
+
+        def finished(success):
+            with lock:
+                counts[success] += 1
+            free.release()
+
+        def failed(error):
+            _LOG.error('Task could not be run: %s', error)
+            finished(False)
+
+        pool = multiprocessing.Pool(self.workers, maxtasksperchild=self.tasks_per_worker)
+        try:
+            for task in tasks:
+                free.acquire()
+                pool.apply_async(_run_task, (task_runner, task), callback=finished, error_callback=failed)
+
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+
+        _LOG.debug('Ran %s tasks, %s failed.', counts[True] + counts[False], counts[False])
+        return counts[True], counts[False]
+
+
+def _run_task(task_runner, task):
+    """ Run a task in a worker process, reporting whether it succeeded. """
+    try:
+        task_runner(task)
+        return True
+    except Exception:  # pylint: disable=broad-except
+        _LOG.exception('Task %s failed.', task)
+        return False
@@ -1,7 +1,12 @@
+from datetime import datetime, timedelta, timezone
 from functools import reduce
 
-from datacube.api.query import query_group_by
+import numpy as np
+
+from datacube.api.query import query_group_by, Query
 from datacube.api import GridWorkflow
+from datacube.utils.dates import normalise_dt
+from datacube.utils.geometry import unary_union
 
 
 def common_subset(sets, key_by=None):
@@ -29,6 +34,27 @@ def common_subset(sets, key_by=None):
     return cc
 
 
+def match_times(*times):
+    """Match observation times across products.
+
+    *times -- one `datetime64` array per product, in any order, possibly with repeated times
+
+    Returns a `(common_idx, unmatched_idx)` pair of index arrays for each product:
+    the positions of the times present in all of the products, and of the rest.
+    """
+    common = reduce(np.intersect1d, times[1:], np.unique(times[0]))
+
+    def split(product_times):
+        if common.size == 0:
+            matched = np.zeros(product_times.shape, dtype=bool)
+        else:
+            pos = np.searchsorted(common, product_times).clip(max=common.size - 1)
+            matched = common[pos] == product_times
+        return np.flatnonzero(matched), np.flatnonzero(~matched)
+
+    return [split(product_times) for product_times in times]
+
+
 def common_obs_per_cell(*tile_obs):
     """Given cell observations for one given tile, from two a more products, split them into two sets:
 
@@ -37,26 +63,34 @@ def common_obs_per_cell(*tile_obs):
 
     *tile_obs -- [{'datasets': [Dataset],
                    'geobox': Geobox}]
+
+    Observations may also carry the `center_time` of their datasets as a `datetime64` array
+    under `'times'`, as produced by `_sort_cell_observations`, to save recomputing it.
     """
+    times = [o['times'] if 'times' in o else _dataset_times(o['datasets']) for o in tile_obs]
+
+    def pick(o, idx):
+        return dict(datasets=[o['datasets'][i] for i in idx], geobox=o['geobox'])
 
-    def ds_time(ds):
-        return ds.center_time
+    matches = match_times(*times)
 
-    tt_common = common_subset([o['datasets'] for o in tile_obs], ds_time)
+    return ([pick(o, common_idx) for o, (common_idx, _) in zip(tile_obs, matches)],
+            [pick(o, unmatched_idx) for o, (_, unmatched_idx) in zip(tile_obs, matches)])
 
-    def pick_with(o, pred):
-        o_ = o.copy()
-        o_['datasets'] = [ds for ds in o['datasets'] if pred(ds)]
-        return o_
 
-    def pick_common(o):
-        return pick_with(o, lambda ds: ds_time(ds) in tt_common)
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_UTC = _EPOCH.replace(tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
 
-    def pick_unmatched(o):
-        return pick_with(o, lambda ds: ds_time(ds) not in tt_common)
 
-    return ([pick_common(o) for o in tile_obs],
-            [pick_unmatched(o) for o in tile_obs])
+def _dataset_times(datasets):
+    """ `center_time` of each dataset, as a `datetime64` array in UTC. """
+    # much faster than having numpy convert datetime objects
+    def microseconds(time):
+        return (time - (_EPOCH_UTC if time.tzinfo is not None else _EPOCH)) // _MICROSECOND
+
+    return np.fromiter((microseconds(ds.center_time) for ds in datasets),
+                       dtype='int64', count=len(datasets)).view('datetime64[us]')
 
 
 def multi_product_list_cells(products,
@@ -88,10 +122,6 @@ def multi_product_list_cells(products,
     if product_query is None:
         product_query = {}
 
-    empty_cell = dict(datasets=[], geobox=None)
-    co_common = [dict() for _ in products]
-    co_unmatched = [dict() for _ in products]
-
     group_by = query_group_by(**query)
 
     obs = [gw.cell_observations(product=product,
@@ -100,6 +130,104 @@ def multi_product_list_cells(products,
                                 **query)
            for product in products]
 
+    return _match_cell_observations(obs, group_by)
+
+
+def list_period_cells(product, gw, time_ranges, cell_indexes=None, product_query=None, **query):
+    """The cell observations of `product` over the whole span of `time_ranges`,
+    to be split into the individual time ranges with `match_period_cells`.
+
+    This keeps the number of index queries independent of the number of time
+    ranges. Similarly, when `cell_indexes` are given, all of the cells are
+    fetched with a single spatial query (over the union of the cells) and only
+    then split into cells.
+
+    Note that the datasets are split by `center_time`, whereas a search of the
+    index for a single time range returns the datasets whose time range overlaps
+    it. A dataset whose own time range crosses the boundary between two time
+    ranges is only assigned to the one containing its `center_time`.
+
+    product       -- product name
+    gw            -- Preconfigured GridWorkflow object
+    time_ranges   -- list of (start, end) time ranges, as accepted by the `time` query parameter
+    cell_indexes  -- Limit search area to a list of cells, replaces any `geopolygon` in the query
+    product_query -- Product specific query, dict product_name => product specific query
+    **query       -- Common query parameters across all products, excluding `time`
+    """
+    if product_query is None:
+        product_query = {}
+
+    bounds = [_time_bounds(time_range) for time_range in time_ranges]
+    if not bounds:
+        return {}
+
+    span = (min(begin for begin, _ in bounds), max(end for _, end in bounds))
+
+    if cell_indexes is not None:
+        cell_indexes = set(tuple(cell_index) for cell_index in cell_indexes)
+        if not cell_indexes:
+            return {}
+
+        query['geopolygon'] = unary_union(gw.grid_spec.tile_geobox(cell_index).extent
+                                          for cell_index in cell_indexes)
+
+    obs = gw.cell_observations(product=product,
+                               time=span,
+                               **product_query.get(product, {}),
+                               **query)
+    if cell_indexes is not None:
+        obs = {cidx: cell for cidx, cell in obs.items() if cidx in cell_indexes}
+    return _sort_cell_observations(obs)
+
+
+def match_period_cells(obs, time_range, **query):
+    """The `(co_common, co_unmatched)` of a single time range, as returned by `multi_product_list_cells`,
+    from the cell observations of each product found by `list_period_cells`.
+    """
+    begin, end = _time_bounds(time_range)
+    return _match_cell_observations([_cell_observations_between(o, begin, end) for o in obs],
+                                    query_group_by(**query))
+
+
+def _time_bounds(time_range):
+    """ Inclusive (begin, end) of a `time` query, exactly as the index interprets it. """
+    search_time = Query(time=time_range).search_terms['time']
+    begin, end = (search_time.begin, search_time.end) if hasattr(search_time, 'end') else (search_time, search_time)
+    return normalise_dt(begin), normalise_dt(end)
+
+
+def _sort_cell_observations(obs):
+    """ Sort the datasets of each cell by `center_time`, remembering the sort keys as `'times'`. """
+    def sort_cell(cell):
+        times = _dataset_times(cell['datasets'])
+        order = np.argsort(times, kind='stable')
+        return dict(cell, datasets=[cell['datasets'][i] for i in order], times=times[order])
+
+    return {cidx: sort_cell(cell) for cidx, cell in obs.items()}
+
+
+def _cell_observations_between(obs, begin, end):
+    """
+    Cell observations restricted to datasets with `begin <= center_time <= end`
+    (not to those whose time range overlaps `begin` to `end`, as an index search would).
+    """
+    begin, end = np.datetime64(begin, 'us'), np.datetime64(end, 'us')
+    selected = {}
+    for cidx, cell in obs.items():
+        times = cell['times']
+        first, last = np.searchsorted(times, begin, side='left'), np.searchsorted(times, end, side='right')
+        if first < last:
+            selected[cidx] = dict(datasets=cell['datasets'][first:last], geobox=cell['geobox'],
+                                  times=times[first:last])
+    return selected
+
+
+def _match_cell_observations(obs, group_by):
+    """ Split cell observations of several products into those that have a full set across products and the rest. """
+    empty_cell = dict(datasets=[], geobox=None)
+    co_common = [dict() for _ in obs]
+    co_unmatched = [dict() for _ in obs]
+
     # set of all cell indexes found across all products
     all_cell_idx = set(reduce(list.__add__,
                               [list(o.keys()) for o in obs]))
@@ -110,7 +238,7 @@ def multi_product_list_cells(products,
     for cidx in all_cell_idx:
         common, unmatched = common_obs_per_cell(*[o.get(cidx, empty_cell) for o in obs])
 
-        for i in range(len(products)):
+        for i in range(len(obs)):
             if cidx in obs[i]:
                 if not cell_is_empty(common[i]):
                     co_common[i][cidx] = common[i]
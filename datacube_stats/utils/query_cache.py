@@ -0,0 +1,199 @@
+"""
+A local, on-disk cache of dataset searches.
+
+Task generation searches the index for the datasets of every source and mask product,
+which is slow for large regions, and is repeated in full when re-running after a
+partial failure. :class:`CachedIndex` wraps an index so that dataset searches are
+answered from a sqlite file instead, as long as no datasets of the searched product
+have been added or archived since (see :func:`product_state`).
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+
+from datacube.model import Dataset
+
+_LOG = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS query (
+    key TEXT PRIMARY KEY,
+    product_state TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS query_dataset (
+    key TEXT NOT NULL,
+    dataset_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS query_dataset_key ON query_dataset (key);
+CREATE TABLE IF NOT EXISTS dataset (
+    id TEXT PRIMARY KEY,
+    product TEXT NOT NULL,
+    uris TEXT NOT NULL,
+    metadata_doc TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS query_result (
+    key TEXT PRIMARY KEY,
+    product_state TEXT NOT NULL,
+    result TEXT NOT NULL
+);
+"""
+
+
+def query_key(query):
+    """ A stable hash of a dataset search query. """
+    return hashlib.sha1(json.dumps(query, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+
+
+def product_state(index, product):
+    """
+    Changes whenever datasets of the product are added, archived or deleted, but not when the metadata of a
+    dataset is updated in place.
+
+    For a postgres index, this is the number of datasets of the product (archived ones included), how many
+    of them are archived and when the last one was added, all from a single aggregate query. Other indexes
+    only report the number of active datasets and their time span, which misses as many datasets being
+    archived as are added in the same time span.
+    """
+    changes = _product_changes(index, product)
+    if changes is not None:
+        return json.dumps([str(value) for value in changes])
+
+    time_bounds = index.datasets.get_product_time_bounds(product)
+    return json.dumps([index.datasets.count(product=product), [str(bound) for bound in time_bounds]])
+
+
+def _product_changes(index, product):
+    """ `(datasets, archived datasets, latest added time)` of a product in a postgres index, or `None`. """
+    try:
+        from datacube.drivers.postgres import PostgresDb
+        from datacube.drivers.postgres._schema import DATASET
+        from sqlalchemy import select, func
+    except ImportError:
+        return None
+
+    db = getattr(index, '_db', None)
+    if not isinstance(db, PostgresDb):
+        return None
+
+    product_id = index.products.get_by_name(product).id
+    query = select([func.count(), func.count(DATASET.c.archived), func.max(DATASET.c.added)]) \
+        .where(DATASET.c.dataset_type_ref == product_id)
+    with db.connect() as connection:
+        # pylint: disable=protected-access
+        return tuple(connection._connection.execute(query).fetchone())
+
+
+class DatasetQueryCache:
+    """
+    Dataset search results, stored in a sqlite file.
+
+    Results are keyed by a hash of the search query, and are only returned while the
+    state of the searched product (see :func:`product_state`) is the same as when they
+    were stored.
+    """
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.filename, check_same_thread=False)
+        with self._connection:
+            self._connection.executescript(_SCHEMA)
+
+    def get(self, key, product_state):
+        """ The `(product_name, metadata_doc, uris)` of the datasets stored for `key`, or `None`. """
+        with self._lock:
+            row = self._connection.execute('SELECT product_state FROM query WHERE key = ?', (key,)).fetchone()
+            if row is None or row[0] != product_state:
+                return None
+
+            rows = self._connection.execute('SELECT dataset.product, dataset.metadata_doc, dataset.uris '
+                                            'FROM query_dataset JOIN dataset ON dataset.id = query_dataset.dataset_id '
+                                            'WHERE query_dataset.key = ?', (key,)).fetchall()
+
+        return [(product, json.loads(metadata_doc), json.loads(uris)) for product, metadata_doc, uris in rows]
+
+    def put(self, key, product_state, datasets):
+        """ Store the result of a search for `key`, replacing anything stored for it before. """
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM query_dataset WHERE key = ?', (key,))
+            self._connection.execute('INSERT OR REPLACE INTO query (key, product_state) VALUES (?, ?)',
+                                     (key, product_state))
+            self._connection.executemany('INSERT OR REPLACE INTO dataset (id, product, uris, metadata_doc) '
+                                         'VALUES (?, ?, ?, ?)',
+                                         [(str(ds.id), ds.type.name, json.dumps(ds.uris or []),
+                                           json.dumps(ds.metadata_doc)) for ds in datasets])
+            self._connection.executemany('INSERT INTO query_dataset (key, dataset_id) VALUES (?, ?)',
+                                         [(key, str(ds.id)) for ds in datasets])
+
+    def get_result(self, key, product_state):
+        """ The (JSON serialisable) result of some other search stored for `key`, or `None`. """
+        with self._lock:
+            row = self._connection.execute('SELECT product_state, result FROM query_result WHERE key = ?',
+                                           (key,)).fetchone()
+        if row is None or row[0] != product_state:
+            return None
+        return json.loads(row[1])
+
+    def put_result(self, key, product_state, result):
+        """ Store the (JSON serialisable) result of some other search for `key`. """
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO query_result (key, product_state, result) '
+                                     'VALUES (?, ?, ?)', (key, product_state, json.dumps(result)))
+
+    def close(self):
+        self._connection.close()
+
+
+class CachedIndex:
+    """
+    An index whose dataset searches go through a :class:`DatasetQueryCache`.
+
+    Everything else is passed through to the wrapped index.
+    """
+
+    def __init__(self, index, cache):
+        self._index = index
+        self.datasets = _CachedDatasetResource(index, cache)
+
+    def __getattr__(self, name):
+        return getattr(self._index, name)
+
+
+class _CachedDatasetResource:
+    def __init__(self, index, cache):
+        self._index = index
+        self._cache = cache
+        self._product_states = {}
+
+    def __getattr__(self, name):
+        return getattr(self._index.datasets, name)
+
+    def _product_state(self, product):
+        if product not in self._product_states:
+            self._product_states[product] = product_state(self._index, product)
+        return self._product_states[product]
+
+    def search(self, limit=None, **query):
+        product = query.get('product')
+        if limit is not None or not isinstance(product, str):
+            yield from self._index.datasets.search(limit=limit, **query)
+            return
+
+        key = query_key(query)
+        product_state = self._product_state(product)
+
+        cached = self._cache.get(key, product_state)
+        if cached is not None:
+            _LOG.debug('Found %s datasets of %s in the query cache', len(cached), product)
+            yield from (Dataset(self._index.products.get_by_name(name), metadata_doc, uris=uris)
+                        for name, metadata_doc, uris in cached)
+            return
+
+        datasets = self._index.datasets.search_eager(**query)
+        self._cache.put(key, product_state, datasets)
+        yield from datasets
+
+    def search_eager(self, **query):
+        return list(self.search(**query))
@@ -0,0 +1,240 @@
+"""
+A compact task file format, for ``--save-tasks`` and ``--load-tasks``.
+
+Pickling whole :class:`StatsTask` objects stores every dataset document once per task
+that uses it, and a task can only be reached by unpickling all of the tasks before it.
+Instead, a task file stores for each task:
+
+- the geobox parameters of its tiles,
+- the id, product and URIs of its datasets, and how they are grouped in time,
+- everything else about the task (time period, spatial id, source specification, ...).
+
+Dataset documents are stored at most once per file, and the output products once for
+all tasks. An index of offsets at the end of the file lets a worker seek straight to
+the tasks it processes. Their datasets are rebuilt from the embedded documents or,
+if the file was saved without documents, with one bulk fetch from the index per task.
+
+Layout::
+
+    MAGIC, task and document pickles (in any order), header pickle, header offset (8 bytes)
+"""
+import pickle
+import struct
+from itertools import islice
+
+import numpy as np
+import xarray
+from affine import Affine
+from datacube.api import Tile
+from datacube.model import Dataset
+from datacube.ui.task_app import unpickle_stream
+from datacube.utils.geometry import GeoBox, CRS
+
+from datacube_stats.models import StatsTask, DataSource
+
+MAGIC = b'DATACUBE-STATS-TASKS\x00\x01'
+_FOOTER = struct.Struct('<q')
+
+
+def is_task_file(filename):
+    """ Whether `filename` is a task file, rather than a stream of pickled tasks. """
+    with open(filename, 'rb') as fl:
+        return fl.read(len(MAGIC)) == MAGIC
+
+
+def save_tasks(tasks, filename, embed_documents=True):
+    """
+    Write `tasks` to a task file.
+
+    :param bool embed_documents: store dataset documents, so loading does not need an index
+    :return: the number of tasks saved
+    """
+    with open(filename, 'wb') as fl:
+        fl.write(MAGIC)
+        writer = _TaskWriter(fl, embed_documents)
+        for task in tasks:
+            writer.write(task)
+        return writer.finish()
+
+
+def read_tasks(filename, index=None, task_slice=None):
+    """
+    Read the tasks in `task_slice` from a task file, or from a stream of pickled tasks.
+
+    :param index: Datacube Index, to look up datasets for files saved without documents
+    :param slice task_slice: the subset of tasks to read
+    """
+    if not is_task_file(filename):
+        tasks = unpickle_stream(filename)
+        if task_slice is not None:
+            tasks = islice(tasks, task_slice.start, task_slice.stop, task_slice.step)
+        yield from tasks
+        return
+
+    with TaskFile(filename) as task_file:
+        yield from task_file.tasks(task_slice, index=index)
+
+
+class _TaskWriter:
+    def __init__(self, fl, embed_documents):
+        self._fl = fl
+        self._embed_documents = embed_documents
+        self._task_offsets = []
+        self._document_offsets = []
+        self._document_numbers = {}
+        self._products = {}
+        self._output_products = None
+
+    def _dump(self, obj):
+        offset = self._fl.tell()
+        pickle.dump(obj, self._fl, protocol=pickle.HIGHEST_PROTOCOL)
+        return offset
+
+    def _dataset_ref(self, dataset):
+        dataset_id = str(dataset.id)
+        self._products.setdefault(dataset.type.name, dataset.type)
+
+        document_number = None
+        if self._embed_documents:
+            document_number = self._document_numbers.get(dataset_id)
+            if document_number is None:
+                document_number = self._document_numbers[dataset_id] = len(self._document_offsets)
+                self._document_offsets.append(self._dump(dataset.metadata_doc))
+
+        return dataset_id, dataset.type.name, list(dataset.uris or []), document_number
+
+    def _tile_record(self, tile):
+        if tile is None:
+            return None
+
+        sources = tile.sources
+        geobox = tile.geobox
+        return dict(geobox=(geobox.width, geobox.height, tuple(geobox.affine)[:6], str(geobox.crs)),
+                    dims=sources.dims,
+                    shape=sources.shape,
+                    coords={name: (coord.dims, coord.values, dict(coord.attrs))
+                            for name, coord in sources.coords.items()},
+                    datasets=[[self._dataset_ref(dataset) for dataset in group] for group in sources.values.ravel()])
+
+    def _source_record(self, source):
+        return dict(attrs={key: value for key, value in vars(source).items() if key not in ('data', 'masks')},
+                    data=self._tile_record(source.data),
+                    masks=[self._tile_record(mask) for mask in source.masks])
+
+    def write(self, task):
+        if self._output_products is None:
+            self._output_products = task.output_products
+
+        attrs = {key: value for key, value in vars(task).items() if key not in ('sources', 'output_products')}
+        record = dict(attrs=attrs, sources=[self._source_record(source) for source in task.sources])
+        if task.output_products is not self._output_products:
+            record['output_products'] = task.output_products
+
+        self._task_offsets.append(self._dump(record))
+
+    def finish(self):
+        header = dict(task_offsets=np.array(self._task_offsets, dtype='int64'),
+                      document_offsets=np.array(self._document_offsets, dtype='int64'),
+                      products=self._products,
+                      output_products=self._output_products)
+        self._fl.write(_FOOTER.pack(self._dump(header)))
+        return len(self._task_offsets)
+
+
+class TaskFile:
+    """ Random access to the tasks in a task file. """
+
+    def __init__(self, filename):
+        self._fl = open(filename, 'rb')
+        if self._fl.read(len(MAGIC)) != MAGIC:
+            self._fl.close()
+            raise ValueError('{} is not a task file'.format(filename))
+
+        self._fl.seek(-_FOOTER.size, 2)
+        header_offset, = _FOOTER.unpack(self._fl.read(_FOOTER.size))
+        header = self._load(header_offset)
+
+        self._task_offsets = header['task_offsets']
+        self._document_offsets = header['document_offsets']
+        self._products = header['products']
+        self._output_products = header['output_products']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._fl.close()
+
+    def __len__(self):
+        return len(self._task_offsets)
+
+    def _load(self, offset):
+        self._fl.seek(offset)
+        return pickle.load(self._fl)
+
+    def tasks(self, task_slice=None, index=None):
+        """ The tasks in `task_slice` (by default, all of them). """
+        for number in range(len(self))[task_slice or slice(None)]:
+            yield self.read(number, index=index)
+
+    def read(self, number, index=None) -> StatsTask:
+        """ Task number `number`, with its datasets rebuilt. """
+        record = self._load(int(self._task_offsets[number]))
+        datasets = self._load_datasets(record, index)
+
+        def tile(tile_record):
+            if tile_record is None:
+                return None
+
+            width, height, affine, crs = tile_record['geobox']
+            groups = np.empty(len(tile_record['datasets']), dtype=object)
+            for i, group in enumerate(tile_record['datasets']):
+                groups[i] = tuple(datasets[dataset_id] for dataset_id, *_ in group)
+
+            coords = {name: xarray.Variable(dims, values, attrs)
+                      for name, (dims, values, attrs) in tile_record['coords'].items()}
+            sources = xarray.DataArray(groups.reshape(tile_record['shape']), dims=tile_record['dims'], coords=coords)
+            return Tile(sources, GeoBox(width, height, Affine(*affine), CRS(crs)))
+
+        def source(source_record):
+            data_source = DataSource(data=tile(source_record['data']),
+                                     masks=[tile(mask) for mask in source_record['masks']],
+                                     spec=None)
+            vars(data_source).update(source_record['attrs'])
+            return data_source
+
+        task = StatsTask(time_period=None, spatial_id=None,
+                         sources=[source(source_record) for source_record in record['sources']],
+                         output_products=record.get('output_products', self._output_products))
+        vars(task).update(record['attrs'])
+        return task
+
+    def _load_datasets(self, record, index):
+        refs = {}
+        for source_record in record['sources']:
+            for tile_record in [source_record['data'], *source_record['masks']]:
+                if tile_record is not None:
+                    for group in tile_record['datasets']:
+                        refs.update((ref[0], ref) for ref in group)
+
+        datasets = {}
+        missing = []
+        for dataset_id, product, uris, document_number in refs.values():
+            if document_number is None:
+                missing.append(dataset_id)
+            else:
+                document = self._load(int(self._document_offsets[document_number]))
+                datasets[dataset_id] = Dataset(self._products[product], document, uris=uris)
+
+        if missing:
+            if index is None:
+                raise ValueError('task file was saved without dataset documents, an index is required to load it')
+            datasets.update((str(dataset.id), dataset) for dataset in index.datasets.bulk_get(missing))
+            not_found = set(missing) - set(datasets)
+            if not_found:
+                raise ValueError('datasets not found in the index: {}'.format(', '.join(sorted(not_found))))
+
+        return datasets
@@ -27,6 +27,14 @@ class MultiTimer:
         if rss > self.max_rss[name]:
             self.max_rss[name] = rss
 
+    def merge(self, other):
+        """ Add the run times of `other`, eg. timing the same steps on another thread. """
+        for name, run_time in other.run_times.items():
+            self.run_times[name] += run_time
+        for name, rss in other.max_rss.items():
+            self.max_rss[name] = max(self.max_rss[name], rss)
+        return self
+
     def __str__(self):
         formatted_sizes = {k: sizeof_fmt(v) for k, v in self.max_rss.items()}
         formatted_times = {k: '{:.0f}m {:.0f}s'.format(*divmod(v, 60)) for k, v in self.run_times.items()}
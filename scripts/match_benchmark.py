@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Time matching of observations across products, as done for every cell during task generation.
+
+Compares the vectorised matcher in `datacube_stats.utils.query` against the
+previous approach of building sets of `center_time` values for every cell.
+"""
+
+from datetime import datetime, timedelta
+import random
+import time
+
+import click
+
+
+class FakeDataset:
+    def __init__(self, center_time):
+        self.center_time = center_time
+
+
+def set_based_obs_per_cell(*tile_obs):
+    from datacube_stats.utils.query import common_subset
+
+    def ds_time(ds):
+        return ds.center_time
+
+    tt_common = common_subset([o['datasets'] for o in tile_obs], ds_time)
+
+    return ([dict(o, datasets=[ds for ds in o['datasets'] if ds_time(ds) in tt_common]) for o in tile_obs],
+            [dict(o, datasets=[ds for ds in o['datasets'] if ds_time(ds) not in tt_common]) for o in tile_obs])
+
+
+def make_cells(num_cells, num_products, num_obs, missing, seed):
+    rnd = random.Random(seed)
+    start = datetime(1987, 1, 1)
+
+    cells = []
+    for _ in range(num_cells):
+        times = [start + timedelta(days=16 * i, seconds=rnd.randrange(3600)) for i in range(num_obs)]
+        cells.append([dict(datasets=[FakeDataset(t) for t in times if rnd.random() >= missing], geobox=None)
+                      for _ in range(num_products)])
+    return cells
+
+
+@click.command(help='Benchmark matching of observations across products')
+@click.option('--cells', type=int, default=1000, help='Number of cells')
+@click.option('--products', type=int, default=3, help='Number of products, eg. NBAR + PQ + WOfS')
+@click.option('--observations', type=int, default=700, help='Observations per product per cell')
+@click.option('--missing', type=float, default=0.02, help='Fraction of observations missing from each product')
+@click.option('--seed', type=int, default=0)
+def main(cells, products, observations, missing, seed):
+    from datacube_stats.utils.query import common_obs_per_cell, _sort_cell_observations
+
+    tile_obs = make_cells(cells, products, observations, missing, seed)
+
+    def run(name, match, prepare=None):
+        if prepare is not None:
+            t_start = time.time()
+            prepared = [[prepare(o) for o in obs] for obs in tile_obs]
+            click.echo('{:>12}: {:.3f}s (preparing times)'.format(name, time.time() - t_start))
+        else:
+            prepared = tile_obs
+
+        t_start = time.time()
+        results = [match(*obs) for obs in prepared]
+        click.echo('{:>12}: {:.3f}s'.format(name, time.time() - t_start))
+        return results
+
+    expected = run('sets', set_based_obs_per_cell)
+    result = run('numpy', common_obs_per_cell)
+    run('numpy+times', common_obs_per_cell, lambda o: _sort_cell_observations({None: o})[None])
+
+    def times(results):
+        return [[sorted(ds.center_time for ds in o['datasets']) for o in split] for r in results for split in r]
+
+    assert times(result) == times(expected), 'matchers disagree'
+
+
+if __name__ == '__main__':
+    main()
@@ -36,6 +36,14 @@ def test_raises_error_on_no_sources(sample_stats_config):
         stats_app = StatsApp(config=sample_stats_config)
 
 
+def test_raises_error_on_dask_engine_without_dask(sample_stats_config):
+    sample_stats_config['computation'] = {'engine': 'dask'}
+
+    with mock.patch.dict('sys.modules', {'dask': None}):
+        with pytest.raises(StatsConfigurationError):
+            stats_app = StatsApp(config=sample_stats_config)
+
+
 def test_can_create_output_products(sample_stats_config, mock_index):
     # GIVEN: A simple stats app
     stats_app = StatsApp(config=sample_stats_config)
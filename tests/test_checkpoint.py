@@ -0,0 +1,116 @@
+from datetime import datetime
+
+from mock import MagicMock
+
+from datacube_stats.output_drivers import OutputDriver
+from datacube_stats.utils.checkpoint import ChunkManifest, IterativeCheckpoint, chunk_key
+
+CHUNKS = [(slice(None), slice(0, 200), slice(0, 200)),
+          (slice(None), slice(0, 200), slice(200, 400))]
+
+
+def test_chunk_manifest_survives_reopening_and_ignores_incomplete_lines(tmpdir):
+    path = tmpdir / 'out.nc.partial.chunks'
+    manifest = ChunkManifest(path)
+    assert len(manifest) == 0
+
+    manifest.add(CHUNKS[0])
+    manifest.add(CHUNKS[0])
+    assert CHUNKS[0] in ChunkManifest(path)
+    assert len(ChunkManifest(path)) == 1
+
+    # the process was killed while recording the next chunk
+    with open(str(path), 'a') as fl:
+        fl.write(chunk_key(CHUNKS[1])[:-1])
+    reopened = ChunkManifest(path)
+    assert CHUNKS[0] in reopened
+    assert CHUNKS[1] not in reopened
+
+    reopened.remove()
+    assert not path.exists()
+
+
+def test_iterative_checkpoint_round_trips_closures(tmpdir):
+    checkpoint = IterativeCheckpoint(tmpdir / 'state', every=2)
+    assert checkpoint.load() is None
+
+    def make_proc():
+        total = [0]
+
+        def proc(x=None):
+            if x is None:
+                return total[0]
+            total[0] += x
+        return proc
+
+    proc = make_proc()
+    proc(3)
+    checkpoint.save([proc], [1, 0])
+
+    loaded, consumed = checkpoint.load()
+    loaded[0](4)
+    assert loaded[0]() == 7
+    assert consumed == [1, 0]
+
+    (tmpdir / 'state').write('not a pickle')
+    assert checkpoint.load() is None
+
+
+class CheckpointingOutputDriver(OutputDriver):
+    supports_checkpoint = True
+    valid_extensions = ['.nc']
+
+    def open_output_files(self):
+        for prod_name, stat in self._output_products.items():
+            tmp_path = self._prepare_output_file(stat)
+            self._resumable_manifest(prod_name, tmp_path)
+            tmp_path.write_text('partial')
+            self._output_file_handles[prod_name] = open(str(tmp_path))
+
+    def write_data(self, prod_name, measurement_name, chunk, values):
+        pass
+
+    def write_global_attributes(self, attributes):
+        pass
+
+
+def make_task(*prod_names):
+    task = MagicMock()
+    task.spatial_id = {'x': 1, 'y': 2}
+    task.time_period = datetime(2015, 1, 1), datetime(2016, 1, 1)
+    task.output_products = {}
+    for prod_name in prod_names:
+        product = MagicMock()
+        product.name = prod_name
+        product.file_path_template = prod_name + '_{x}_{y}.nc'
+        product.extras = {}
+        task.output_products[prod_name] = product
+    return task
+
+
+def test_output_driver_resumes_chunks_written_to_all_products(tmpdir):
+    task = make_task('mean', 'count')
+
+    def run(fail):
+        try:
+            with CheckpointingOutputDriver(task=task, storage={}, output_path=str(tmpdir),
+                                           checkpoint=True) as output_files:
+                written = output_files.written_chunks()
+                output_files.mark_chunk_written(CHUNKS[0], ['mean', 'count'])
+                output_files.mark_chunk_written(CHUNKS[1], ['mean'])
+                if fail:
+                    raise RuntimeError('walltime exceeded')
+                return written, output_files.written_chunks(['mean'])
+        except RuntimeError:
+            return None
+
+    assert run(fail=True) is None
+    assert (tmpdir / 'mean_1_2.nc.partial').exists()
+    assert (tmpdir / 'mean_1_2.nc.partial.chunks').exists()
+
+    written, written_mean = run(fail=False)
+    assert written == {chunk_key(CHUNKS[0])}
+    assert written_mean == {chunk_key(CHUNKS[0]), chunk_key(CHUNKS[1])}
+
+    assert (tmpdir / 'mean_1_2.nc').exists()
+    assert sorted(path.basename for path in tmpdir.listdir()) == ['count_1_2.nc', 'mean_1_2.nc']
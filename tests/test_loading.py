@@ -0,0 +1,789 @@
+"""
+Tests for loading and masking chunks of source data, against an in-memory fake of `GridWorkflow.load`.
+"""
+from collections import OrderedDict
+from datetime import datetime
+
+import mock
+import numpy as np
+import pytest
+import xarray
+
+from affine import Affine
+from datacube.api import Tile
+from datacube.model import Measurement
+from datacube.utils.geometry import GeoBox, CRS, box
+from datacube_stats.main import load_data, load_masked_data, load_masked_data_lazy, execute_task
+from datacube_stats.main import task_coverage, chunk_is_covered, geometry_mask
+from datacube_stats.main import make_mask_from_spec, mask_lookup_table, _evaluate_mask_spec, native_dtype_sources
+from datacube_stats.main import plan_chunking, estimate_task_cost
+from datacube_stats.models import DataSource, StatsTask
+from datacube_stats.utils import tile_iter, sensible_mask_invalid_data, ds_completely_invalid
+
+NODATA = -999
+SHAPE = (6, 5)
+GEOBOX = GeoBox(SHAPE[1], SHAPE[0], Affine(25.0, 0.0, 1000.0, 0.0, -25.0, 2000.0), CRS('EPSG:3577'))
+
+
+class FakeProduct:
+    def __init__(self, measurements):
+        self.measurements = measurements
+
+    def lookup_measurements(self, measurements=None):
+        if measurements is None:
+            return self.measurements
+        return OrderedDict((name, self.measurements[name]) for name in measurements)
+
+
+class FakeDataset:
+    """ Stands in for a datacube `Dataset`, carrying the pixels it would load. """
+    def __init__(self, product, values, extent=None):
+        self.type = product
+        self.values = values
+        self.extent = extent
+
+
+def make_product(*names, dtype='int16', nodata=NODATA, **kwargs):
+    return FakeProduct(OrderedDict((name, Measurement(name=name, dtype=dtype, nodata=nodata, units='1', **kwargs))
+                                   for name in names))
+
+
+def make_tile(product, times, make_values, extent=None):
+    datasets = [(FakeDataset(product, make_values(i), extent),) for i in range(len(times))]
+    sources = xarray.DataArray(np.empty(len(times), dtype=object), dims=['time'],
+                               coords={'time': np.array(times, dtype='datetime64[ns]')})
+    for i, dss in enumerate(datasets):
+        sources.values[i] = dss
+    return Tile(sources, GEOBOX)
+
+
+def fake_load(tile, measurements=None, fuse_func=None, skip_broken_datasets=False, **kwargs):
+    product = tile.product
+    measurement_defs = product.lookup_measurements(measurements)
+    coords = OrderedDict((dim, coord.values) for dim, coord in tile.geobox.coordinates.items())
+    full = OrderedDict((dim, coord.values) for dim, coord in GEOBOX.coordinates.items())
+    ys = np.searchsorted(-full['y'], -coords['y'])
+    xs = np.searchsorted(full['x'], coords['x'])
+
+    def load_var(name):
+        values = np.stack([dss[0].values[name][np.ix_(ys, xs)] for dss in tile.sources.values])
+        attrs = {'nodata': measurement_defs[name]['nodata'], 'units': '1', 'crs': GEOBOX.crs}
+        if 'flags_definition' in measurement_defs[name]:
+            attrs['flags_definition'] = measurement_defs[name]['flags_definition']
+        return xarray.DataArray(values, dims=('time', 'y', 'x'),
+                                coords={'time': tile.sources.time.values, 'y': coords['y'], 'x': coords['x']},
+                                attrs=attrs)
+
+    return xarray.Dataset(OrderedDict((name, load_var(name)) for name in measurement_defs),
+                          attrs={'crs': GEOBOX.crs})
+
+
+@pytest.fixture
+def fake_grid_workflow():
+    with mock.patch('datacube_stats.main.GridWorkflow') as mock_gwf_class:
+        mock_gwf_class.load.side_effect = fake_load
+        yield mock_gwf_class
+
+
+def random_values(seed, names=('red', 'green'), dtype='int16'):
+    rng = np.random.RandomState(seed)
+
+    def make_values(i):
+        return {name: rng.randint(-5, 100, size=SHAPE).astype(dtype) for name in names}
+
+    return make_values
+
+
+def pq_values(seed):
+    rng = np.random.RandomState(seed)
+
+    def make_values(i):
+        return {'pixelquality': rng.randint(0, 2, size=SHAPE).astype('uint8')}
+
+    return make_values
+
+
+def make_source(times, seed, source_index, with_mask=True):
+    data = make_tile(make_product('red', 'green'), times, random_values(seed))
+    spec = {'product': 'nbar', 'measurements': ['red', 'green']}
+    masks = []
+    if with_mask:
+        spec['masks'] = [{'product': 'pq', 'measurement': 'pixelquality', 'less_than': 1}]
+        masks = [make_tile(make_product('pixelquality', dtype='uint8', nodata=255), times, pq_values(seed + 1))]
+    return DataSource(data=data, masks=masks, spec=spec, source_index=source_index)
+
+
+def reference_load_data(sub_tile_slice, sources):
+    """ Concatenate each masked source and sort by time, as `load_data` used to. """
+    datasets = [load_masked_data(sub_tile_slice, source) for source in sources]
+    datasets = [dataset for dataset in datasets if dataset is not None]
+    return xarray.concat(datasets, dim='time').sortby('time')
+
+
+SUB_TILE_SLICES = [(slice(None), slice(None), slice(None)),
+                   (slice(None), slice(2, 5), slice(1, 3))]
+
+
+@pytest.mark.parametrize('sub_tile_slice', SUB_TILE_SLICES)
+def test_load_data_interleaves_sources_in_time_order(fake_grid_workflow, sub_tile_slice):
+    sources = [make_source(['2015-01-01', '2015-01-17', '2015-03-01'], seed=1, source_index=0),
+               make_source(['2015-01-09', '2015-01-17', '2015-02-10', '2015-04-01'], seed=3, source_index=1)]
+
+    result = load_data(sub_tile_slice, sources)
+    expected = reference_load_data(sub_tile_slice, sources)
+
+    assert list(result.data_vars) == ['red', 'green']
+    assert result.red.dtype == np.float32
+    xarray.testing.assert_identical(result, expected)
+
+
+def test_load_data_discards_sources_without_masks_or_data(fake_grid_workflow):
+    def all_nodata(i):
+        return {name: np.full(SHAPE, NODATA, dtype='int16') for name in ('red', 'green')}
+
+    empty = DataSource(data=make_tile(make_product('red', 'green'), ['2015-01-05', '2015-01-21'], all_nodata),
+                       masks=[], spec={'product': 'nbar', 'measurements': ['red', 'green']}, source_index=2)
+    missing_mask = make_source(['2015-01-03'], seed=5, source_index=1)
+    missing_mask.masks = [None]
+    sources = [make_source(['2015-01-01', '2015-01-17'], seed=1, source_index=0), missing_mask, empty]
+
+    result = load_data(SUB_TILE_SLICES[0], sources)
+
+    assert list(result.source.values) == [0, 0]
+    xarray.testing.assert_identical(result, reference_load_data(SUB_TILE_SLICES[0], sources))
+
+
+@pytest.mark.parametrize('mask_inplace', [False, True])
+def test_masks_are_matched_to_data_by_time(fake_grid_workflow, mask_inplace):
+    # the mask was found for more times than the data, eg. after the data was filtered
+    source = make_source(['2015-01-01', '2015-01-17', '2015-02-02'], seed=1, source_index=0)
+    mask_times = ['2015-01-01', '2015-01-09', '2015-01-17', '2015-02-02']
+    source.masks = [make_tile(make_product('pixelquality', dtype='uint8', nodata=255), mask_times, pq_values(2))]
+    source.spec['mask_inplace'] = mask_inplace
+
+    aligned = DataSource(data=source.data, spec=source.spec, source_index=0,
+                         masks=[Tile(source.masks[0].sources.isel(time=[0, 2, 3]), GEOBOX)])
+
+    for sub_tile_slice in SUB_TILE_SLICES:
+        result = load_data(sub_tile_slice, [source])
+        assert result.time.size == 3
+        xarray.testing.assert_identical(result, load_data(sub_tile_slice, [aligned]))
+        xarray.testing.assert_identical(load_masked_data(sub_tile_slice, source),
+                                        load_masked_data(sub_tile_slice, aligned))
+
+        lazy = list(load_masked_data_lazy(sub_tile_slice, source, src_idx=0))
+        expected = list(load_masked_data_lazy(sub_tile_slice, aligned, src_idx=0))
+        assert len(lazy) == len(expected) == 3
+        for ds, expected_ds in zip(lazy, expected):
+            xarray.testing.assert_identical(ds, expected_ds)
+
+
+def test_load_data_keeps_native_dtype_without_nodata_masking(fake_grid_workflow):
+    sources = [make_source(['2015-01-01', '2015-02-01'], seed=7, source_index=0, with_mask=False)]
+    sources[0].spec['mask_nodata'] = False
+
+    result = load_data(SUB_TILE_SLICES[0], sources)
+
+    assert result.red.dtype == np.int16
+    xarray.testing.assert_identical(result, reference_load_data(SUB_TILE_SLICES[0], sources))
+
+
+def sparse_pq_values(i):
+    """ First slice completely masked out, clear pixels of the others within rows 1-2 and columns 2-3 """
+    pq = np.zeros(SHAPE, dtype='uint8')
+    if i > 0:
+        pq[1, 2] = pq[2, 3] = 1
+    return {'pixelquality': pq}
+
+
+def make_sparse_source(times, seed, source_index, mask_first):
+    source = make_source(times, seed, source_index)
+    source.spec['masks'][0] = {'product': 'pq', 'measurement': 'pixelquality', 'flags': {'clear': True}}
+    pq_product = make_product('pixelquality', dtype='uint8', nodata=255,
+                              flags_definition={'clear': {'bits': 0, 'values': {0: False, 1: True}}})
+    source.masks = [make_tile(pq_product, times, sparse_pq_values)]
+    source.spec['mask_first'] = mask_first
+    return source
+
+
+def loaded_data_shapes(fake_grid_workflow):
+    return [call[0][0].shape for call in fake_grid_workflow.load.call_args_list
+            if call[1]['measurements'] != ['pixelquality']]
+
+
+def assert_same_values(result, expected):
+    assert list(result.data_vars) == list(expected.data_vars)
+    assert (result.time.values == expected.time.values).all()
+    for name in expected.data_vars:
+        np.testing.assert_array_equal(result[name].values, expected[name].values)
+
+
+def test_mask_first_only_reads_clear_windows(fake_grid_workflow):
+    times = ['2015-01-01', '2015-01-17', '2015-02-02']
+    expected = load_masked_data(SUB_TILE_SLICES[0], make_sparse_source(times, seed=1, source_index=0,
+                                                                       mask_first=False))
+    fake_grid_workflow.load.reset_mock()
+
+    result = load_masked_data(SUB_TILE_SLICES[0], make_sparse_source(times, seed=1, source_index=0,
+                                                                     mask_first=True))
+
+    assert loaded_data_shapes(fake_grid_workflow) == [(1, 2, 2), (1, 2, 2)]
+    assert_same_values(result, expected)
+    assert list(result.source.values) == [0, 0, 0]
+
+
+def test_mask_first_discards_completely_masked_source(fake_grid_workflow):
+    source = make_sparse_source(['2015-01-01'], seed=1, source_index=0, mask_first=True)
+
+    assert load_masked_data(SUB_TILE_SLICES[0], source) is None
+    assert loaded_data_shapes(fake_grid_workflow) == []
+
+
+@pytest.mark.parametrize('sub_tile_slice', [SUB_TILE_SLICES[0], (slice(None), slice(2, 5), slice(1, 4))])
+def test_mask_first_stacked_and_lazy_loading(fake_grid_workflow, sub_tile_slice):
+    def sources(mask_first):
+        return [make_sparse_source(['2015-01-01', '2015-03-01'], seed=1, source_index=0, mask_first=mask_first),
+                make_sparse_source(['2015-02-01', '2015-02-17'], seed=3, source_index=1, mask_first=mask_first)]
+
+    expected = load_data(sub_tile_slice, sources(mask_first=False))
+    assert_same_values(load_data(sub_tile_slice, sources(mask_first=True)), expected)
+
+    for source_prod in sources(mask_first=True):
+        lazy = list(load_masked_data_lazy(sub_tile_slice, source_prod, src_idx=source_prod.source_index))
+        assert len(lazy) == len(source_prod.data.sources)
+        for ds in lazy:
+            if ds.time.values[0] in expected.time.values:
+                assert_same_values(ds.drop('source'), expected.sel(time=ds.time.values).drop('source'))
+            else:
+                # completely masked out time slices are dropped when stacked
+                assert all(np.isnan(var.values).all() for var in ds.data_vars.values())
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_lazy_loading_with_prefetch(fake_grid_workflow, reverse):
+    source = make_source(['2015-01-01', '2015-01-17', '2015-02-02', '2015-03-01', '2015-04-01'],
+                         seed=1, source_index=0)
+    source.spec['masks'][0] = {'product': 'pq', 'measurement': 'pixelquality', 'flags': {'clear': True}}
+    pq_product = make_product('pixelquality', dtype='uint8', nodata=255,
+                              flags_definition={'clear': {'bits': 0, 'values': {0: False, 1: True}}})
+    source.masks = [make_tile(pq_product, source.data.sources.time.values, pq_values(2))]
+
+    expected = list(load_masked_data_lazy(SUB_TILE_SLICES[1], source, reverse=reverse, src_idx=0))
+    result = list(load_masked_data_lazy(SUB_TILE_SLICES[1], source, reverse=reverse, src_idx=0, prefetch=2))
+
+    assert len(result) == len(expected) == 5
+    for ds, expected_ds in zip(result, expected):
+        xarray.testing.assert_identical(ds, expected_ds)
+
+
+@pytest.mark.parametrize('mask_first', [False, True])
+@pytest.mark.parametrize('sub_tile_slice', [SUB_TILE_SLICES[0], (slice(None), slice(2, 5), slice(1, 4))])
+def test_parallel_reads_match_sequential_loading(fake_grid_workflow, sub_tile_slice, mask_first):
+    def sources():
+        return [make_sparse_source(['2015-01-01', '2015-01-17', '2015-03-01'], seed=1, source_index=0,
+                                   mask_first=mask_first),
+                make_sparse_source(['2015-01-09', '2015-01-17', '2015-02-10'], seed=3, source_index=1,
+                                   mask_first=mask_first)]
+
+    expected = load_data(sub_tile_slice, sources())
+    sequential_loads = fake_grid_workflow.load.call_count
+    fake_grid_workflow.load.reset_mock()
+
+    result = load_data(sub_tile_slice, sources(), io_threads=3)
+
+    # every measurement is read separately
+    assert fake_grid_workflow.load.call_count > sequential_loads
+    xarray.testing.assert_identical(result, expected)
+
+    source = sources()[0]
+    xarray.testing.assert_identical(load_masked_data(sub_tile_slice, source, io_threads=3),
+                                    load_masked_data(sub_tile_slice, source))
+
+
+class FakeFeature:
+    def __init__(self, geopolygon):
+        self.geopolygon = geopolygon
+
+
+def covered_chunks(footprint, feature=None):
+    times = ['2015-01-01', '2015-01-17']
+    data = make_tile(make_product('red', 'green'), times, random_values(1), extent=footprint)
+    task = StatsTask(time_period=(datetime(2015, 1, 1), datetime(2015, 2, 1)), spatial_id=(1, 2), feature=feature,
+                     sources=[DataSource(data=data, masks=[], spec={'product': 'nbar'})])
+
+    coverage = task_coverage(task)
+    chunks = [chunk for chunk in tile_iter(task.sample_tile, {'x': 2, 'y': 3})
+              if chunk_is_covered(task, chunk, coverage)]
+    return task, chunks
+
+
+def test_chunks_without_coverage_are_skipped(fake_grid_workflow):
+    top_left = box(1000, 1930, 1040, 2000, GEOBOX.crs)
+    task, chunks = covered_chunks(top_left)
+    assert [chunk[1:] for chunk in chunks] == [(slice(0, 3), slice(0, 2))]
+
+    bottom_right = FakeFeature(box(1105, 1860, 1120, 1870, GEOBOX.crs).to_crs(CRS('EPSG:4326')))
+    _, chunks = covered_chunks(GEOBOX.extent, feature=bottom_right)
+    assert [chunk[1:] for chunk in chunks] == [(slice(3, 6), slice(4, 5))]
+
+    _, chunks = covered_chunks(top_left, feature=bottom_right)
+    assert chunks == []
+
+    # unknown footprints rule nothing out
+    _, chunks = covered_chunks(None)
+    assert len(chunks) == 6
+
+    with mock.patch('datacube_stats.main.load_process_save_chunk') as process_chunk:
+        execute_task(task, output_driver=mock.MagicMock(), chunking={'x': 2, 'y': 3})
+
+    assert [call[0][1][1:] for call in process_chunk.call_args_list] == [(slice(0, 3), slice(0, 2))]
+    assert not fake_grid_workflow.load.called
+
+
+def test_feature_is_rasterised_once_per_task(fake_grid_workflow):
+    feature = FakeFeature(box(1030, 1860, 1120, 1910, GEOBOX.crs))
+    task, chunks = covered_chunks(GEOBOX.extent, feature=feature)
+    assert [chunk[1:] for chunk in chunks] == [(slice(3, 6), slice(0, 2)), (slice(3, 6), slice(2, 4)),
+                                               (slice(3, 6), slice(4, 5))]
+
+    expected = [load_data(chunk, task.sources, geom=feature.geopolygon) for chunk in chunks]
+    fake_grid_workflow.load.reset_mock()
+
+    loaded = []
+
+    def record_load_data(chunk, sources, **kwargs):
+        loaded.append(load_data(chunk, sources, **kwargs))
+        return loaded[-1]
+
+    with mock.patch('datacube_stats.main.geometry_mask', wraps=geometry_mask) as rasterise, \
+            mock.patch('datacube_stats.main.load_data', side_effect=record_load_data):
+        execute_task(task, output_driver=mock.MagicMock(), chunking={'x': 2, 'y': 3})
+
+    assert rasterise.call_count == 1
+    assert len(loaded) == len(expected)
+    for ds, expected_ds in zip(loaded, expected):
+        xarray.testing.assert_identical(ds, expected_ds)
+
+
+PQ_FLAGS = {'clear': {'bits': 0, 'values': {0: False, 1: True}},
+            'land': {'bits': [2, 3], 'values': {1: True, 0: False}},
+            'cloud': {'bits': 9, 'values': {0: False, 1: True}}}
+FMASK_FLAGS = {'fmask': {'bits': [0, 1, 2, 3, 4, 5, 6, 7],
+                         'values': {0: 'nodata', 1: 'valid', 2: 'cloud', 3: 'shadow', 4: 'snow', 5: 'water'}}}
+
+
+@pytest.mark.parametrize('dtype, mask_spec, flags_definition', [
+    ('uint16', {'flags': {'clear': True, 'cloud': False}}, PQ_FLAGS),
+    ('uint16', {'flags': {'land': True}, 'invert': True}, PQ_FLAGS),
+    ('int16', {'flags': {'clear': True, 'cloud': False}}, PQ_FLAGS),
+    ('uint8', {'nonmasked_values': ['valid', 'snow', 'water']}, FMASK_FLAGS),
+    ('uint8', {'less_than': 3}, None),
+    ('int8', {'greater_than': -2, 'invert': True}, None),
+    ('int32', {'less_than': 30}, None),
+])
+def test_mask_lookup_table_matches_direct_decoding(dtype, mask_spec, flags_definition):
+    info = np.iinfo(dtype)
+    values = np.random.RandomState(3).randint(info.min, info.max + 1, size=(2, 30, 20), dtype=dtype)
+    attrs = {} if flags_definition is None else {'flags_definition': flags_definition}
+    loaded = xarray.DataArray(values, dims=('time', 'y', 'x'), attrs=attrs)
+
+    decoded = make_mask_from_spec(loaded, mask_spec)
+    expected = _evaluate_mask_spec(loaded, mask_spec)
+
+    assert decoded.dtype == bool
+    assert decoded.dims == loaded.dims
+    np.testing.assert_array_equal(decoded.values, expected.values)
+
+    lookup_table = mask_lookup_table(mask_spec, dtype, flags_definition)
+    if np.dtype(dtype).itemsize > 2:
+        assert lookup_table is None
+    else:
+        assert lookup_table is mask_lookup_table(dict(mask_spec), dtype, flags_definition)
+
+
+def test_native_dtype_loading_marks_masked_pixels_with_nodata(fake_grid_workflow):
+    def sources():
+        return [make_source(['2015-01-01', '2015-03-01'], seed=1, source_index=0),
+                make_source(['2015-02-01', '2015-02-17'], seed=3, source_index=1)]
+
+    expected = load_data(SUB_TILE_SLICES[1], sources())
+    result = load_data(SUB_TILE_SLICES[1], native_dtype_sources(sources()))
+
+    assert result.red.dtype == np.int16
+    assert (result.red.values == NODATA).any()
+    assert_same_values(sensible_mask_invalid_data(result), expected)
+
+
+class FakeStatistic:
+    def __init__(self, multiplier, native=True, blockwise=True, keep_empty=False):
+        self.multiplier = multiplier
+        self.native = native
+        self.blockwise = blockwise
+        self.keep_empty = keep_empty
+
+    def memory_multiplier(self, num_observations):
+        return self.multiplier
+
+    def supports_native_dtypes(self):
+        return self.native
+
+    def is_blockwise(self):
+        return self.blockwise
+
+    def needs_empty_time_slices(self):
+        return self.keep_empty
+
+    def compute_cost(self, num_observations):
+        return self.multiplier * num_observations
+
+
+def planned_chunk_bytes(chunking, num_times, bytes_per_value, multiplier):
+    return chunking['y'] * chunking['x'] * num_times * 2 * bytes_per_value * (1 + multiplier)
+
+
+@pytest.mark.parametrize('budget', [200, 1500, 10 ** 6])
+def test_plan_chunking_fits_memory_budget(budget):
+    times = ['2015-01-01', '2015-01-17', '2015-02-02']
+    task = StatsTask(time_period=None, spatial_id=(1, 2),
+                     sources=[make_source(times, seed=1, source_index=0),
+                              make_source(times[:2], seed=2, source_index=1)],
+                     output_products={'medoid': FakeStatistic(3.0), 'count': FakeStatistic(1.0)})
+
+    chunking = plan_chunking(task, budget)
+    assert set(chunking) == {'y', 'x'}
+    assert 1 <= chunking['y'] <= SHAPE[0] and 1 <= chunking['x'] <= SHAPE[1]
+
+    # int16 measurements are loaded as float32
+    if chunking['y'] * chunking['x'] > 1:
+        assert planned_chunk_bytes(chunking, 5, 4, 3.0) <= budget
+    if budget >= planned_chunk_bytes({'y': SHAPE[0], 'x': SHAPE[1]}, 5, 4, 3.0):
+        assert chunking == {'y': SHAPE[0], 'x': SHAPE[1]}
+
+    # iterative statistics only hold a few time slices at once
+    task.is_iterative = True
+    iterative = plan_chunking(task, budget)
+    assert iterative['y'] * iterative['x'] >= chunking['y'] * chunking['x']
+
+    # floating point copies for statistics that need them count too
+    task.is_iterative = False
+    task.output_products['mean'] = FakeStatistic(1.0, native=False)
+    task.sources = native_dtype_sources(task.sources)
+    native = plan_chunking(task, budget, native_dtypes=True)
+    assert native['y'] * native['x'] >= chunking['y'] * chunking['x']
+
+
+def test_load_data_drops_empty_time_slices(fake_grid_workflow):
+    from datacube_stats.main import load_chunk
+    from datacube_stats.utils.timer import MultiTimer
+
+    def sources():
+        return [make_sparse_source(['2015-01-01', '2015-01-17', '2015-03-01'], seed=1, source_index=0,
+                                   mask_first=False),
+                make_source(['2015-01-09', '2015-02-10'], seed=3, source_index=1)]
+
+    result = load_data(SUB_TILE_SLICES[0], sources())
+    expected = reference_load_data(SUB_TILE_SLICES[0], sources())
+
+    # the first slice of the sparse source is completely masked out
+    assert list(expected.time.values[1:]) == list(result.time.values)
+    xarray.testing.assert_identical(result, expected.isel(time=slice(1, None)))
+    assert not any(ds_completely_invalid(result.isel(time=[t])) for t in range(result.time.size))
+    assert ds_completely_invalid(expected.isel(time=[0]))
+
+    # unless a statistic needs the whole time axis
+    xarray.testing.assert_identical(load_data(SUB_TILE_SLICES[0], sources(), keep_empty=True), expected)
+
+    task = StatsTask(time_period=None, spatial_id=(1, 2), sources=sources(),
+                     output_products={'count': FakeStatistic(1.0), 'none': FakeStatistic(1.0, keep_empty=True)})
+    xarray.testing.assert_identical(load_chunk(SUB_TILE_SLICES[0], task, MultiTimer()), expected)
+    del task.output_products['none']
+    xarray.testing.assert_identical(load_chunk(SUB_TILE_SLICES[0], task, MultiTimer()), result)
+
+
+def test_estimate_task_cost():
+    times = ['2015-01-01', '2015-01-17', '2015-02-02']
+
+    def cost(num_times, chunking, multiplier=1.0):
+        task = StatsTask(time_period=None, spatial_id=(1, 2),
+                         sources=[make_source(times[:num_times], seed=1, source_index=0)],
+                         output_products={'stat': FakeStatistic(multiplier)})
+        return estimate_task_cost(task, chunking)
+
+    whole = {'y': SHAPE[0], 'x': SHAPE[1]}
+    assert cost(3, whole) == 3 + 3
+    assert cost(3, {}) == cost(3, whole)
+    assert cost(1, whole) < cost(3, whole) < cost(3, whole, multiplier=4.0)
+    assert cost(3, {'y': SHAPE[0] // 2, 'x': SHAPE[1]}) == 2 * cost(3, whole)
+
+
+def test_estimate_task_cost_leaves_out_chunks_without_coverage(fake_grid_workflow):
+    top_left = box(1000, 1930, 1040, 2000, GEOBOX.crs)
+    task, chunks = covered_chunks(top_left)
+    task.output_products = {'stat': FakeStatistic(1.0)}
+
+    assert len(chunks) == 1
+    assert estimate_task_cost(task, {'x': 2, 'y': 3}) == 2 + 2
+
+
+class FakeMeanStatistic(FakeStatistic):
+    data_measurements = [{'name': 'red', 'dtype': 'float32'}]
+
+    def __init__(self, blockwise=True):
+        super().__init__(1.0, blockwise=blockwise)
+
+    def compute(self, data):
+        return data[['red']].mean(dim='time')
+
+
+def test_chunks_are_computed_in_parallel_with_a_single_writer(fake_grid_workflow):
+    import threading
+    from datacube_stats.main import plan_chunk_workers
+
+    times = ['2015-01-01', '2015-01-17', '2015-02-02']
+    task = StatsTask(time_period=(datetime(2015, 1, 1), datetime(2015, 3, 1)), spatial_id=(1, 2),
+                     sources=[make_source(times, seed=1, source_index=0)],
+                     output_products={'mean': FakeMeanStatistic()})
+
+    def run(**kwargs):
+        writing = threading.Lock()
+        written = {}
+
+        def write_chunk(prod_name, chunk, result):
+            # fails if another write is in progress
+            assert writing.acquire(blocking=False)
+            written[repr(chunk)] = result.red.values
+            writing.release()
+
+        output_files = mock.MagicMock()
+        output_files.__enter__.return_value.write_chunk.side_effect = write_chunk
+        execute_task(task, output_driver=mock.MagicMock(return_value=output_files), **kwargs)
+        return written
+
+    expected = run(chunking={'x': 2, 'y': 2})
+    result = run(chunking={'x': 2, 'y': 2}, chunk_workers=4)
+
+    assert len(expected) == 9
+    assert result.keys() == expected.keys()
+    for chunk in expected:
+        np.testing.assert_array_equal(result[chunk], expected[chunk])
+
+    # a memory budget is shared between the workers, so the whole tile no longer fits into one chunk
+    assert len(run(chunking={}, memory_budget=2000)) == 1
+    assert len(run(chunking={}, memory_budget=2000, chunk_workers=2)) > 1
+    assert plan_chunk_workers(task, {'x': 2, 'y': 2}, 4, 9) == 4
+    assert plan_chunk_workers(task, {'x': 2, 'y': 2}, 4, 2) == 2
+    # each chunk takes 2 * 2 pixels * 3 times * 2 bands * 4 bytes * (1 + 1)
+    assert plan_chunk_workers(task, {'x': 2, 'y': 2}, 4, 9, memory_budget=600) == 3
+    assert plan_chunk_workers(task, {'x': 2, 'y': 2}, 4, 9, memory_budget=10) == 1
+
+
+class FakeIterativeMeanStatistic(FakeMeanStatistic):
+    def make_iterative_proc(self):
+        slices = []
+
+        def proc(ds=None):
+            if ds is None:
+                return xarray.concat(slices, dim='time').mean(dim='time')
+            slices.append(ds[['red']])
+
+        return proc
+
+
+@pytest.mark.parametrize('iterative', [False, True])
+def test_pipeline_overlaps_loading_computing_and_writing(fake_grid_workflow, iterative):
+    import threading
+    from datacube_stats import main
+    from datacube_stats.main import pipeline_chunks, covered_chunks
+    from datacube_stats.utils.timer import MultiTimer
+
+    times = ['2015-01-01', '2015-01-17', '2015-02-02']
+    stat = FakeIterativeMeanStatistic() if iterative else FakeMeanStatistic()
+    task = StatsTask(time_period=(datetime(2015, 1, 1), datetime(2015, 3, 1)), spatial_id=(1, 2),
+                     sources=[make_source(times, seed=1, source_index=0, with_mask=False)],
+                     output_products={'mean': stat})
+    task.is_iterative = iterative
+    chunks = list(covered_chunks(task, {'x': 2, 'y': 2}))
+
+    # iterative statistics load while computing, so their next chunk is one ahead instead of two
+    stage, overlapped_chunk = ('compute_chunk_iteratively', chunks[1][0]) if iterative else ('load_chunk', chunks[2][0])
+    started = threading.Event()
+    run_stage = getattr(main, stage)
+
+    def start_stage(chunk, *args, **kwargs):
+        if chunk == overlapped_chunk:
+            started.set()
+        return run_stage(chunk, *args, **kwargs)
+
+    written = {}
+
+    def write(prod_name, var_name, chunk, values):
+        if not written:
+            # the first chunk is still being written when the overlapped chunk starts
+            assert started.wait(5)
+        written[repr(chunk)] = values
+
+    output_files = mock.MagicMock()
+    output_files.write_data.side_effect = write
+    output_files.write_chunk.side_effect = \
+        lambda prod_name, chunk, result: write(prod_name, 'red', chunk, result.red.values)
+
+    timer = MultiTimer()
+    with mock.patch.object(main, stage, side_effect=start_stage):
+        pipeline_chunks(output_files, chunks, task, timer)
+
+    assert len(written) == len(chunks) == 9
+    assert {'mean', 'loading_data', 'writing_data'} <= set(timer.run_times)
+
+    expected = mock.MagicMock()
+    execute_task(task, output_driver=mock.MagicMock(return_value=expected), chunking={'x': 2, 'y': 2})
+    calls = expected.__enter__.return_value.write_data.call_args_list if iterative else \
+        expected.__enter__.return_value.write_chunk.call_args_list
+    assert len(calls) == len(written)
+    for call in calls:
+        values = call[0][3] if iterative else call[0][2].red.values
+        np.testing.assert_array_equal(written[repr(call[0][-2] if iterative else call[0][1])], values)
+
+
+@pytest.mark.parametrize('scheduler', ['synchronous', 'threads'])
+@pytest.mark.parametrize('iterative', [False, True])
+def test_dask_engine_matches_processing_chunk_by_chunk(fake_grid_workflow, scheduler, iterative):
+    import dask
+
+    times = ['2015-01-01', '2015-01-17', '2015-02-02']
+    make_stat = FakeIterativeMeanStatistic if iterative else FakeMeanStatistic
+    task = StatsTask(time_period=(datetime(2015, 1, 1), datetime(2015, 3, 1)), spatial_id=(1, 2),
+                     sources=[make_source(times, seed=1, source_index=0, with_mask=False)],
+                     output_products=OrderedDict([('mean', make_stat()), ('whole', make_stat(blockwise=False))]))
+    task.is_iterative = iterative
+
+    def run(**kwargs):
+        written = {}
+
+        def write(prod_name, var_name, chunk, values):
+            written[prod_name, repr(chunk)] = values
+
+        output_files = mock.MagicMock()
+        output_files.__enter__.return_value.write_data.side_effect = write
+        output_files.__enter__.return_value.write_chunk.side_effect = \
+            lambda prod_name, chunk, result: write(prod_name, 'red', chunk, result.red.values)
+        execute_task(task, output_driver=mock.MagicMock(return_value=output_files), **kwargs)
+        return written
+
+    expected = run(chunking={'x': 2, 'y': 2})
+    result = run(chunking={'x': 2, 'y': 2}, engine='dask', scheduler=scheduler)
+
+    # the statistic that is not blockwise-safe is computed on the whole tile at once
+    whole_tile = [key for key in result if key[0] == 'whole']
+    assert len(whole_tile) == 1
+    whole_values = result.pop(whole_tile[0])
+    for chunk in tile_iter(task.sample_tile, {'x': 2, 'y': 2}):
+        np.testing.assert_array_equal(whole_values[chunk[1:]], expected['whole', repr(chunk)])
+
+    assert result.keys() == {key for key in expected if key[0] == 'mean'}
+    for key in result:
+        np.testing.assert_array_equal(result[key], expected[key])
+
+    # without any chunking, chunks are sized for the dask array chunk size
+    with dask.config.set({'array.chunk-size': '500B'}):
+        assert len(run(chunking={}, engine='dask', scheduler=scheduler)) > 2
+    assert len(run(chunking={}, engine='dask', scheduler=scheduler)) == 2
+
+
+def test_dask_engine_runs_the_planned_chunks_at_once_and_the_whole_task_alone(fake_grid_workflow, caplog):
+    import dask
+
+    times = ['2015-01-01', '2015-01-17', '2015-02-02']
+    task = StatsTask(time_period=(datetime(2015, 1, 1), datetime(2015, 3, 1)), spatial_id=(1, 2),
+                     sources=[make_source(times, seed=1, source_index=0, with_mask=False)],
+                     output_products=OrderedDict([('mean', FakeMeanStatistic()),
+                                                  ('whole', FakeMeanStatistic(blockwise=False))]))
+
+    num_workers = []
+    compute = dask.compute
+
+    def record_compute(*args, **kwargs):
+        num_workers.append((len(args), kwargs['num_workers']))
+        return compute(*args, **kwargs)
+
+    def run(**kwargs):
+        num_workers.clear()
+        with mock.patch('dask.compute', side_effect=record_compute), \
+                mock.patch('datacube_stats.main.cpu_count', return_value=4):
+            execute_task(task, output_driver=mock.MagicMock(), engine='dask', scheduler='threads', **kwargs)
+        return num_workers
+
+    # 9 chunks, one per CPU at once by default, then the whole tile
+    assert run(chunking={'x': 2, 'y': 2}) == [(9, 4), (1, 1)]
+    assert run(chunking={'x': 2, 'y': 2}, chunk_workers=1) == [(9, 1), (1, 1)]
+    assert run(chunking={'x': 2, 'y': 2}, chunk_workers=3) == [(9, 3), (1, 1)]
+    assert 'memory budget' not in caplog.text
+
+    # the whole tile takes 30 pixels * 3 time slices * 2 float32 bands, doubled while computing: 1440 bytes
+    planned = run(memory_budget=1000, chunk_workers=3)
+    assert [workers for _, workers in planned] == [3, 1]
+    assert planned[1][0] == 1
+    assert 'memory budget of 1000 bytes' in caplog.text
+
+
+def test_dask_clients_are_closed():
+    from datacube_stats import dask_engine
+
+    client = mock.MagicMock()
+    with mock.patch.dict(dask_engine._CLIENTS, {'tcp://scheduler:8786': client}):
+        assert dask_engine.get_client('tcp://scheduler:8786') is client
+        dask_engine.close_clients()
+        assert not dask_engine._CLIENTS
+    client.close.assert_called_once_with()
+
+
+def test_iterative_chunk_resumes_from_its_checkpoint(fake_grid_workflow, tmpdir):
+    from datacube_stats.main import compute_chunk_iteratively
+    from datacube_stats.utils.checkpoint import IterativeCheckpoint
+    from datacube_stats.utils.timer import MultiTimer
+
+    task = StatsTask(time_period=(datetime(2015, 1, 1), datetime(2015, 5, 1)), spatial_id=(1, 2),
+                     sources=[make_source(['2015-01-01', '2015-01-17', '2015-03-01'], seed=1, source_index=0,
+                                          with_mask=False),
+                              make_source(['2015-01-09', '2015-02-10', '2015-04-01'], seed=3, source_index=1,
+                                          with_mask=False)],
+                     output_products={'mean': FakeIterativeMeanStatistic()})
+    chunk = (slice(None), slice(2, 5), slice(1, 3))
+    (_, expected), = compute_chunk_iteratively(chunk, task, MultiTimer())
+
+    def interrupted_load(*args, **kwargs):
+        # the fifth time slice read, after the first two have been used
+        if fake_grid_workflow.load.call_count >= 5:
+            raise RuntimeError('walltime exceeded')
+        return fake_load(*args, **kwargs)
+
+    checkpoint = IterativeCheckpoint(tmpdir / 'state', every=2)
+    fake_grid_workflow.load.reset_mock()
+    fake_grid_workflow.load.side_effect = interrupted_load
+    with pytest.raises(RuntimeError):
+        compute_chunk_iteratively(chunk, task, MultiTimer(), checkpoint=checkpoint)
+    assert checkpoint.load()[1] == [1, 1]
+
+    fake_grid_workflow.load.reset_mock()
+    fake_grid_workflow.load.side_effect = fake_load
+    (_, result), = compute_chunk_iteratively(chunk, task, MultiTimer(), checkpoint=checkpoint)
+
+    # only the time slices not yet used are read again
+    assert fake_grid_workflow.load.call_count == 4
+    np.testing.assert_array_equal(result.red.values, expected.red.values)
+
+
+def test_execute_task_skips_chunks_already_written(fake_grid_workflow):
+    from datacube_stats.utils.checkpoint import chunk_key
+
+    task = StatsTask(time_period=(datetime(2015, 1, 1), datetime(2015, 3, 1)), spatial_id=(1, 2),
+                     sources=[make_source(['2015-01-01', '2015-01-17'], seed=1, source_index=0, with_mask=False)],
+                     output_products={'mean': FakeMeanStatistic()})
+    chunks = list(tile_iter(task.sample_tile, {'x': 2, 'y': 2}))
+
+    output_files = mock.MagicMock()
+    output_files.__enter__.return_value.written_chunks.return_value = {chunk_key(chunk) for chunk in chunks[:4]}
+    execute_task(task, output_driver=mock.MagicMock(return_value=output_files), chunking={'x': 2, 'y': 2})
+
+    output = output_files.__enter__.return_value
+    assert [call[0][1] for call in output.write_chunk.call_args_list] == chunks[4:]
+    assert [call[0][0] for call in output.mark_chunk_written.call_args_list] == chunks[4:]
@@ -19,7 +19,8 @@ from datacube_stats.incremental_stats import mk_incremental_mean, mk_incremental
     mk_incremental_max, mk_incremental_counter
 from datacube_stats.stat_funcs import nan_percentile, argpercentile, axisindex
 from datacube_stats.statistics import NormalisedDifferenceStats, WofsStats, TCWStats, \
-    StatsConfigurationError, Medoid
+    StatsConfigurationError, Medoid, Percentile, ReducingXarrayStatistic, NoneStat
+from datacube_stats.utils import cast_back, sensible_mask_invalid_data
 
 
 FAKE_MEASUREMENT_INFO = {'dtype': 'int16', 'nodata': -1, 'units': '1'}
@@ -282,6 +283,75 @@ def test_medoid_statistic(dataset, stat_class):
     assert dataset.crs == result.crs
 
 
+def integer_dataset_with_nodata(nodata=-999):
+    rng = np.random.RandomState(5)
+    shape = (6, 8, 7)
+    coords = {'time': [datetime(2015, month, 1) for month in range(1, shape[0] + 1)],
+              'y': np.arange(shape[1]), 'x': np.arange(shape[2])}
+
+    def band():
+        arr = rng.randint(0, 3000, size=shape).astype('int16')
+        arr[rng.random_sample(shape) < 0.3] = nodata
+        arr[:, 0, 0] = nodata  # no valid observations at all
+        return xr.DataArray(arr, dims=('time', 'y', 'x'), coords=coords, attrs={'nodata': nodata})
+
+    return xr.Dataset({'red': band(), 'nir': band()}, attrs={'crs': CRS('EPSG:3577')})
+
+
+@pytest.mark.parametrize('stat', [Medoid(), Percentile([10, 50, 90]), ReducingXarrayStatistic('min'),
+                                  ReducingXarrayStatistic('max'), ReducingXarrayStatistic('count')],
+                         ids=repr)
+def test_native_dtype_statistics_match_floating_point(stat):
+    native = integer_dataset_with_nodata()
+    measurements = stat.measurements([Measurement(name=name, dtype='int16', nodata=-999, units='1')
+                                      for name in native.data_vars])
+
+    assert stat.supports_native_dtypes()
+    expected = cast_back(stat.compute(sensible_mask_invalid_data(native)), measurements)
+    result = cast_back(stat.compute_native(native), measurements)
+
+    assert set(result.data_vars) == set(expected.data_vars)
+    for name in expected.data_vars:
+        np.testing.assert_array_equal(result[name].values, expected[name].values)
+    assert (native.red.values != -999).any()
+
+
+def test_statistics_needing_the_whole_time_axis_keep_empty_time_slices():
+    assert NoneStat().needs_empty_time_slices()
+    assert Percentile(q=50, per_pixel_metadata=['source']).needs_empty_time_slices()
+    assert not Percentile(q=50).needs_empty_time_slices()
+    assert not ReducingXarrayStatistic('mean').needs_empty_time_slices()
+
+
+@pytest.mark.parametrize('reduction', ['min', 'max', 'count'])
+def test_simple_reductions_only_skip_nodata_in_native_dtype_mode(reduction):
+    # integer data loaded with `mask_nodata: False` keeps the nodata value as an ordinary value
+    data = integer_dataset_with_nodata()
+    stat = ReducingXarrayStatistic(reduction)
+
+    expected = getattr(data, reduction)(dim='time')
+    result = stat.compute(data)
+    for name in expected.data_vars:
+        np.testing.assert_array_equal(result[name].values, expected[name].values)
+
+    native = stat.compute_native(data)
+    assert not all(np.array_equal(native[name].values, expected[name].values) for name in expected.data_vars)
+
+
+@pytest.mark.parametrize('stat', [Medoid(), Percentile([10, 50])], ids=repr)
+def test_index_statistics_only_skip_nodata_in_native_dtype_mode(stat):
+    # as integers, or as floating point without NaN, the nodata value is an ordinary value
+    data = integer_dataset_with_nodata()
+
+    expected = stat.compute(data.astype('float32'))
+    result = stat.compute(data)
+    for name in expected.data_vars:
+        np.testing.assert_array_equal(result[name].values, expected[name].values)
+
+    native = stat.compute_native(data)
+    assert not all(np.array_equal(native[name].values, expected[name].values) for name in expected.data_vars)
+
+
 def compute_incrementally(dataset, proc):
     for i in range(len(dataset.time)):
         time_slice = dataset.isel(time=[i])
@@ -0,0 +1,117 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+import xarray
+from mock import MagicMock
+
+from datacube.api import Tile
+from datacube.model import Dataset, DatasetType
+from datacube.ui.task_app import pickle_stream
+from datacube.utils.geometry import GeoBox, CRS
+from affine import Affine
+
+from datacube_stats.models import StatsTask, DataSource
+from datacube_stats.utils.task_file import save_tasks, read_tasks, TaskFile, is_task_file
+
+
+@pytest.fixture
+def products(mock_index):
+    metadata_type = mock_index.metadata_types.get_by_name('eo')
+    return {name: DatasetType(metadata_type, {'name': name, 'metadata_type': 'eo', 'metadata': {},
+                                              'measurements': []})
+            for name in ('fake_nbar', 'fake_pq')}
+
+
+def make_tile(product, task_number, dataset_numbers, id_offset=0):
+    times = np.array(['2000-01-{:02}'.format(day + 1) for day in range(len(dataset_numbers))], dtype='datetime64[ns]')
+    groups = np.empty(len(dataset_numbers), dtype=object)
+    for i, numbers in enumerate(dataset_numbers):
+        groups[i] = tuple(Dataset(product, {'id': '00000000-0000-0000-0000-{:012}'.format(id_offset + number),
+                                            'ga_label': '{} {}'.format(product.name, number)},
+                                  uris=['file:///tmp/{}/{}.yaml'.format(product.name, number)])
+                          for number in numbers)
+    sources = xarray.DataArray(groups, dims=['time'], coords=[times])
+    sources.time.attrs['units'] = 'seconds since 1970-01-01 00:00:00'
+    geobox = GeoBox(10, 20, Affine(25.0, 0.0, 1000.0 * task_number, 0.0, -25.0, -2000.0), CRS('EPSG:3577'))
+    return Tile(sources, geobox)
+
+
+def make_tasks(products):
+    output_products = {'fake_output': 'fake output product'}
+    tasks = []
+    for number in range(4):
+        task = StatsTask(time_period=(datetime(2000, 1, 1), datetime(2000, 12, 31)),
+                         spatial_id={'x': number, 'y': -number}, output_products=output_products)
+        task.is_iterative = True
+        # neighbouring tasks share datasets
+        dataset_numbers = [[number, number + 1], [10 + number]]
+        task.sources.append(DataSource(data=make_tile(products['fake_nbar'], number, dataset_numbers),
+                                       masks=[make_tile(products['fake_pq'], number, dataset_numbers, 100), None],
+                                       spec={'product': 'fake_nbar', 'measurements': ['red']},
+                                       source_index=0))
+        tasks.append(task)
+    return tasks
+
+
+def assert_same_tasks(result, expected):
+    assert len(result) == len(expected)
+    for task, expected_task in zip(result, expected):
+        assert str(task) == str(expected_task)
+        assert task.is_iterative == expected_task.is_iterative
+        assert task.output_products == expected_task.output_products
+        for source, expected_source in zip(task.sources, expected_task.sources):
+            assert (source.spec, source.source_index) == (expected_source.spec, expected_source.source_index)
+            for tile, expected_tile in zip([source.data, *source.masks],
+                                           [expected_source.data, *expected_source.masks]):
+                if expected_tile is None:
+                    assert tile is None
+                    continue
+                assert tile.geobox == expected_tile.geobox
+                xarray.testing.assert_identical(tile.sources.time, expected_tile.sources.time)
+                assert [[(ds.id, ds.type.name, ds.uris, ds.metadata_doc) for ds in group]
+                        for group in tile.sources.values] == \
+                    [[(ds.id, ds.type.name, ds.uris, ds.metadata_doc) for ds in group]
+                     for group in expected_tile.sources.values]
+
+
+def test_task_file_round_trip_and_random_access(products, tmpdir):
+    tasks = make_tasks(products)
+    filename = str(tmpdir.join('tasks.bin'))
+
+    assert save_tasks(iter(tasks), filename) == 4
+    assert is_task_file(filename)
+
+    assert_same_tasks(list(read_tasks(filename)), tasks)
+    assert_same_tasks(list(read_tasks(filename, task_slice=slice(1, None, 2))), tasks[1::2])
+
+    with TaskFile(filename) as task_file:
+        assert len(task_file) == 4
+        assert_same_tasks([task_file.read(2)], [tasks[2]])
+
+
+def test_task_file_without_documents_fetches_datasets_in_bulk(products, tmpdir):
+    tasks = make_tasks(products)
+    filename = str(tmpdir.join('tasks.bin'))
+    save_tasks(tasks, filename, embed_documents=False)
+
+    with pytest.raises(ValueError):
+        list(read_tasks(filename))
+
+    all_datasets = {str(ds.id): ds
+                    for task in tasks for tile in [task.sources[0].data, task.sources[0].masks[0]]
+                    for group in tile.sources.values for ds in group}
+    index = MagicMock()
+    index.datasets.bulk_get.side_effect = lambda ids: [all_datasets[dataset_id] for dataset_id in ids]
+
+    assert_same_tasks(list(read_tasks(filename, index=index, task_slice=slice(3, 4))), tasks[3:])
+    assert index.datasets.bulk_get.call_count == 1
+
+
+def test_read_tasks_from_pickle_stream(products, tmpdir):
+    tasks = make_tasks(products)
+    filename = str(tmpdir.join('tasks.pickle'))
+    pickle_stream(tasks, filename)
+
+    assert not is_task_file(filename)
+    assert_same_tasks(list(read_tasks(filename, task_slice=slice(2, None))), tasks[2:])
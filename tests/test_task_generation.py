@@ -1,7 +1,9 @@
+import mock
+import pytest
 from mock import MagicMock
 from pandas._libs import json
 
-from datacube.utils.geometry import Geometry, CRS
+from datacube.utils.geometry import Geometry, CRS, GeoBox
 from datacube_stats.tasks import NonGriddedTaskGenerator, ArbitraryTileMaker, GriddedTaskGenerator, \
     select_task_generator
 from datetime import datetime
@@ -42,7 +44,7 @@ BIG_POLYGON = {
 
 class FakeDataset:
     extent = Geometry(BIG_POLYGON, crs=CRS('EPSG:4326'))
-    center_time = datetime(2001, 5, 10)
+    center_time = datetime(2000, 5, 10)
     crs = CRS('EPSG:4326')
 
 
@@ -152,3 +154,202 @@ def test_gridded_task_generation_when_inline_geojson():
     task_generator = select_task_generator(input_region, EXAMPLE_STORAGE, None)
 
     assert isinstance(task_generator, GriddedTaskGenerator)
+
+
+def test_gridded_task_generation_queries_index_once_for_all_periods(mock_index):
+    def dataset_at(center_time):
+        dataset = FakeDataset()
+        dataset.center_time = center_time
+        return dataset
+
+    mock_index.datasets.search_eager.return_value = [dataset_at(datetime(2000, month, 10)) for month in (1, 2, 5)]
+    date_ranges = [(datetime(2000, 1, 1), datetime(2000, 1, 31)),
+                   (datetime(2000, 2, 1), datetime(2000, 3, 31)),
+                   (datetime(2000, 4, 1), datetime(2000, 4, 30)),
+                   (datetime(2000, 1, 1), datetime(2000, 12, 31))]
+    gridded_generator = GriddedTaskGenerator(storage=EXAMPLE_STORAGE, tile_indexes=[(120, -45)])
+
+    tasks = list(gridded_generator(mock_index, EXAMPLE_SOURCES_SPEC, date_ranges))
+
+    assert mock_index.datasets.search_eager.call_count == 1
+    assert [task.time_period for task in tasks] == [date_ranges[0], date_ranges[1], date_ranges[3]]
+    assert [len(task.sources[0].data.sources.time) for task in tasks] == [1, 1, 3]
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_gridded_task_generation_yields_tasks_as_each_period_is_ready(mock_index, workers):
+    from datacube_stats import tasks as tasks_module
+
+    def dataset_at(center_time):
+        dataset = FakeDataset()
+        dataset.center_time = center_time
+        return dataset
+
+    mock_index.datasets.search_eager.return_value = [dataset_at(datetime(2000, month, 10)) for month in range(1, 13)]
+    date_ranges = [(datetime(2000, month, 1), datetime(2000, month, 28)) for month in range(1, 13)]
+    gridded_generator = GriddedTaskGenerator(storage=EXAMPLE_STORAGE, tile_indexes=[(120, -45)], workers=workers)
+
+    with mock.patch.object(tasks_module, 'match_period_cells', wraps=tasks_module.match_period_cells) as match:
+        tasks = gridded_generator(mock_index, EXAMPLE_SOURCES_SPEC, date_ranges)
+        assert next(tasks).time_period == date_ranges[0]
+        # only the periods being planned ahead have been collected yet
+        assert match.call_count <= 1 + workers
+        assert [task.time_period for task in tasks] == date_ranges[1:]
+
+    assert match.call_count == len(date_ranges)
+    assert mock_index.datasets.search_eager.call_count == 1
+
+
+def test_gridded_task_generation_queries_index_once_for_all_tiles(mock_index):
+    mock_index.datasets.search_eager.return_value = [FakeDataset()]
+    tile_indexes = [[121, -45], [120, -45], [130, -48], [160, -45]]
+    gridded_generator = GriddedTaskGenerator(storage=EXAMPLE_STORAGE, tile_indexes=tile_indexes)
+
+    tasks = list(gridded_generator(mock_index, EXAMPLE_SOURCES_SPEC, EXAMPLE_DATE_RANGE))
+
+    assert mock_index.datasets.search_eager.call_count == 1
+    # no data outside of the dataset extent
+    assert [(task.spatial_id['x'], task.spatial_id['y']) for task in tasks] == [(121, -45), (120, -45), (130, -48)]
+
+
+def test_query_cache_reuses_searches_until_product_changes(mock_index, tmpdir):
+    from datacube.model import Dataset, DatasetType, Range
+    from datacube_stats.utils.query_cache import CachedIndex, DatasetQueryCache
+
+    product = DatasetType(mock_index.metadata_types.get_by_name('eo'),
+                          {'name': 'fake_product', 'metadata_type': 'eo', 'metadata': {}, 'measurements': []})
+    datasets = [Dataset(product, {'id': '4ec8fe97-e8b9-11e4-87ff-1040f381a756', 'ga_label': 'first'},
+                        uris=['file:///tmp/first.yaml']),
+                Dataset(product, {'id': '9cd4ca3e-ad1a-4e81-a5fb-d3a2e2fa1ee5', 'ga_label': 'second'},
+                        uris=['file:///tmp/second.yaml'])]
+
+    mock_index.products.get_by_name.return_value = product
+    mock_index.datasets.search_eager.return_value = datasets
+    mock_index.datasets.count.return_value = 2
+    mock_index.datasets.get_product_time_bounds.return_value = (datetime(2000, 1, 1), datetime(2001, 1, 1))
+
+    query = dict(product='fake_product', time=Range(datetime(2000, 1, 1), datetime(2000, 12, 31)))
+    filename = str(tmpdir.join('query_cache.sqlite'))
+
+    def search(**kwargs):
+        return CachedIndex(mock_index, DatasetQueryCache(filename)).datasets.search_eager(**kwargs)
+
+    assert search(**query) == datasets
+    assert mock_index.datasets.search_eager.call_count == 1
+
+    # a re-run finds the same datasets without searching the index
+    cached = search(**query)
+    assert mock_index.datasets.search_eager.call_count == 1
+    assert [(ds.id, ds.metadata_doc, ds.uris, ds.type) for ds in cached] == \
+        [(ds.id, ds.metadata_doc, ds.uris, ds.type) for ds in datasets]
+
+    # a different query is a different search
+    search(product='fake_product', time=Range(datetime(2000, 1, 1), datetime(2000, 6, 30)))
+    assert mock_index.datasets.search_eager.call_count == 2
+
+    # as is the same query once the product has changed
+    mock_index.datasets.count.return_value = 3
+    search(**query)
+    assert mock_index.datasets.search_eager.call_count == 3
+
+
+def test_product_state_of_postgres_index_is_one_aggregate_query(mock_index):
+    from datacube.drivers.postgres import PostgresDb
+    from datacube_stats.utils.query_cache import product_state
+
+    mock_index._db = MagicMock(spec=PostgresDb)
+    execute = mock_index._db.connect.return_value.__enter__.return_value._connection.execute
+    execute.return_value.fetchone.return_value = (10, 2, datetime(2000, 1, 1))
+    state = product_state(mock_index, 'fake_product')
+
+    # as many datasets archived as added
+    execute.return_value.fetchone.return_value = (11, 3, datetime(2000, 2, 1))
+    assert product_state(mock_index, 'fake_product') != state
+    assert execute.call_count == 2
+    assert mock_index.datasets.search_returning.call_count == 0
+    assert mock_index.datasets.count.call_count == 0
+
+
+class FakeFeature:
+    def __init__(self, feature_id, left, bottom, right, top):
+        from datacube.utils.geometry import box
+        self.id = feature_id
+        self.crs = CRS('EPSG:4326')
+        self.geopolygon = box(left, bottom, right, top, self.crs)
+
+
+@pytest.mark.parametrize('workers', [0, 3])
+def test_non_gridded_task_generation_searches_once_for_all_features(mock_index, workers):
+    from datacube.utils.geometry import box
+
+    def dataset_at(left, bottom, day):
+        dataset = FakeDataset()
+        dataset.extent = box(left, bottom, left + 1, bottom + 1, CRS('EPSG:4326'))
+        dataset.center_time = datetime(2000, 5, day)
+        return dataset
+
+    datasets = [dataset_at(137, -42, 1), dataset_at(140, -42, 2), dataset_at(137.2, -41.7, 3)]
+    mock_index.datasets.search.return_value = datasets
+    features = [FakeFeature(1, 137.1, -41.9, 137.4, -41.6),
+                FakeFeature(2, 140.5, -41.5, 140.8, -41.2),
+                FakeFeature(3, 145, -41, 145.5, -40.5)]
+
+    # features are read lazily from the file
+    with mock.patch('datacube_stats.tasks.features_from_file', return_value=iter(features)) as from_file:
+        generator = select_task_generator({'from_file': 'features.shp', 'feature_id': ['id']},
+                                          EXAMPLE_STORAGE, filter_product=None, workers=workers)
+    from_file.assert_called_once_with('features.shp', ['id'])
+    assert isinstance(generator, NonGriddedTaskGenerator)
+    tasks = list(generator(mock_index, EXAMPLE_SOURCES_SPEC, EXAMPLE_DATE_RANGE))
+
+    assert mock_index.datasets.search.call_count == 1
+    # no task for the feature without data
+    assert [task.spatial_id['feature_id'] for task in tasks] == ['1', '2']
+    assert [[ds for group in task.sources[0].data.sources.values for ds in group] for task in tasks] == \
+        [[datasets[0], datasets[2]], [datasets[1]]]
+    assert tasks[0].sources[0].data.geobox == GeoBox.from_geopolygon(features[0].geopolygon, resolution=[0.1, 0.1])
+
+
+def test_non_gridded_task_generation_without_features(mock_index):
+    with mock.patch('datacube_stats.tasks.features_from_file', return_value=iter([])):
+        generator = select_task_generator({'from_file': 'features.shp', 'feature_id': ['id']},
+                                          EXAMPLE_STORAGE, filter_product=None)
+
+    assert generator.input_geopolygon() is None
+    assert list(generator(mock_index, EXAMPLE_SOURCES_SPEC, EXAMPLE_DATE_RANGE)) == []
+    assert mock_index.datasets.search.call_count == 0
+
+def test_set_task_filters_source_times_to_the_second():
+    import numpy as np
+    import xarray
+    from datacube.api import Tile
+    from datacube_stats.models import StatsTask, DataSource
+
+    def tile(times):
+        groups = np.empty(len(times), dtype=object)
+        groups[:] = [(name,) for name in times]
+        sources = xarray.DataArray(groups, dims=['time'], coords=[np.array(times, dtype='datetime64[ns]')])
+        return Tile(sources, geobox=None)
+
+    def source(times, masks=()):
+        return DataSource(data=tile(times), masks=list(masks), spec={})
+
+    mask_times = ['2000-01-02T10:00:00', '2000-01-03T10:00:00.7', '2000-01-03T10:00:01', '2000-01-04T10:00:00']
+    task = StatsTask(time_period=None, spatial_id=None,
+                     sources=[source(['2000-01-01T10:00:00']),
+                              source(['2000-01-02T10:00:00']),
+                              source(['2000-01-03T10:00:00.7', '2000-01-03T10:00:01', '2000-01-04T10:00:00'],
+                                     masks=[tile(mask_times), None])])
+
+    generator = NonGriddedTaskGenerator({'from_file': 'features.shp'}, storage=EXAMPLE_STORAGE,
+                                        filter_product={'method': 'by_tide_height'})
+    task = generator.set_task(task, ['2000-01-03T10:00:00', '2000-01-04T10:00:00'])
+
+    # the sources without matching times are all removed, keeping the one that matches
+    assert len(task.sources) == 1
+    assert list(task.sources[0].data.sources.values) == [('2000-01-03T10:00:00.7',), ('2000-01-04T10:00:00',)]
+    # and the masks keep the same time slices
+    mask, missing = task.sources[0].masks
+    assert missing is None
+    np.testing.assert_array_equal(mask.sources.time.values, task.sources[0].data.sources.time.values)
+    assert list(mask.sources.values) == [('2000-01-03T10:00:00.7',), ('2000-01-04T10:00:00',)]
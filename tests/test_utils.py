@@ -1,5 +1,5 @@
 from hypothesis.extra.numpy import arrays
-from hypothesis.strategies import integers
+from hypothesis.strategies import integers, lists
 from hypothesis import given
 import numpy as np
 from datacube_stats.utils import wofs_fuser
@@ -39,3 +39,194 @@ def test(dest, src):
 
     if is_dry(src) and is_dry(orig_dest):
         assert is_dry(dest)
+
+
+def test_prefetch_map_keeps_order_and_bounds_read_ahead():
+    import threading
+    import time
+    from datacube_stats.utils import prefetch_map
+
+    lock = threading.Lock()
+    started = []
+
+    def slow_square(x):
+        with lock:
+            started.append(x)
+        time.sleep(0.01 * (x % 3))
+        return x * x
+
+    consumed = 0
+    for x, result in zip(range(20), prefetch_map(slow_square, range(20), prefetch=3)):
+        assert result == x * x
+        consumed += 1
+        with lock:
+            assert len(started) <= consumed + 3
+
+    assert list(prefetch_map(slow_square, [], prefetch=3)) == []
+    assert list(prefetch_map(slow_square, range(4))) == [0, 1, 4, 9]
+
+
+def test_unordered_prefetch_map_yields_results_as_they_finish():
+    import threading
+    from datacube_stats.utils import prefetch_map
+
+    release_first = threading.Event()
+
+    def slow_first(x):
+        if x == 0:
+            assert release_first.wait(5)
+        return x
+
+    results = prefetch_map(slow_first, range(2), prefetch=2, ordered=False)
+    assert next(results) == 1
+    release_first.set()
+    assert list(results) == [0]
+    assert sorted(prefetch_map(lambda x: x * x, range(10), prefetch=3, ordered=False)) == [x * x for x in range(10)]
+
+
+def test_parse_memory_size():
+    import pytest
+    from datacube_stats.utils import parse_memory_size
+
+    assert parse_memory_size(1000) == 1000
+    assert parse_memory_size('4GB') == 4 * 10 ** 9
+    assert parse_memory_size('512 MiB') == 512 * 2 ** 20
+    assert parse_memory_size('1.5gib') == 3 * 2 ** 29
+    assert parse_memory_size('2048') == 2048
+
+    with pytest.raises(ValueError):
+        parse_memory_size('four gigabytes')
+
+
+def test_emptiness_checks_work_block_by_block():
+    import xarray
+    from datacube_stats.utils import iter_blocks, ds_completely_invalid, da_invalid
+
+    values = np.arange(4 * 30 * 20).reshape(4, 30, 20)
+    blocks = list(iter_blocks(values, block_size=50))
+    assert all(block.base is not None for block in blocks)
+    np.testing.assert_array_equal(np.concatenate([block.ravel() for block in blocks]), values.ravel())
+    assert max(block.size for block in blocks) <= 50
+
+    floats = np.full((3, 30, 20), np.nan, dtype='float32')
+    ints = np.full((3, 30, 20), -1, dtype='int16')
+    floats[2, 29, 19] = 1
+    ints[0, 3, 4] = ints[2, 0, 0] = 7
+    ds = xarray.Dataset({'a': (('time', 'y', 'x'), floats),
+                         'b': (('time', 'y', 'x'), ints, {'nodata': -1})},
+                        coords={'time': np.arange(3)})
+
+    assert [ds_completely_invalid(ds.isel(time=[t])) for t in range(3)] == [False, True, False]
+    assert not ds_completely_invalid(ds)
+    # integers without nodata are always valid, same as for `da_invalid`
+    zeros = xarray.Dataset({'c': (('time',), np.zeros(3, dtype='int8'))})
+    assert not ds_completely_invalid(zeros)
+    assert not da_invalid(zeros.c).any()
+    np.testing.assert_array_equal(da_invalid(ds.b), ints == -1)
+    np.testing.assert_array_equal(da_invalid(ds.a), np.isnan(floats))
+
+
+class FakeTimedDataset:
+    def __init__(self, center_time):
+        self.center_time = center_time
+
+
+@given(lists(lists(integers(0, 20), max_size=15), min_size=1, max_size=4))
+def test_common_obs_per_cell_matches_sets_of_times(days):
+    from datetime import datetime, timedelta
+    from datacube_stats.utils.query import common_obs_per_cell, common_subset
+
+    tile_obs = [dict(datasets=[FakeTimedDataset(datetime(2000, 1, 1) + timedelta(days=day)) for day in product_days],
+                     geobox=None)
+                for product_days in days]
+
+    common_times = common_subset([o['datasets'] for o in tile_obs], lambda ds: ds.center_time)
+
+    common, unmatched = common_obs_per_cell(*tile_obs)
+
+    for o, o_common, o_unmatched in zip(tile_obs, common, unmatched):
+        assert o_common['datasets'] == [ds for ds in o['datasets'] if ds.center_time in common_times]
+        assert o_unmatched['datasets'] == [ds for ds in o['datasets'] if ds.center_time not in common_times]
+
+
+def test_balanced_shards_evens_out_cost():
+    from datacube_stats.utils import balanced_shards
+
+    costs = [100, 5, 5, 5, 90, 5, 5, 5, 80, 5, 5, 5]
+    shards = balanced_shards(costs, 3)
+
+    assert sorted(position for shard in shards for position in shard) == list(range(len(costs)))
+    assert all(shard == sorted(shard) for shard in shards)
+
+    def spread(shards):
+        totals = [sum(costs[position] for position in shard) for shard in shards]
+        return max(totals) - min(totals)
+
+    round_robin = [list(range(len(costs)))[i::3] for i in range(3)]
+    assert spread(shards) < spread(round_robin)
+    assert spread(shards) <= max(costs[1:4])
+
+
+def test_find_periods_with_data_finds_solar_days_with_one_search(tmpdir):
+    from collections import namedtuple
+    from datetime import datetime, timezone
+    from mock import MagicMock
+    from datacube.model import Range
+    from datacube.utils.geometry import box, CRS
+    from datacube_stats.utils import _find_periods_with_data
+    from datacube_stats.utils.query_cache import DatasetQueryCache
+
+    def utc(*args):
+        return datetime(*args, tzinfo=timezone.utc)
+
+    row = namedtuple('search_result', ['time'])
+    index = MagicMock()
+    index.datasets.count.return_value = 3
+    index.datasets.get_product_time_bounds.return_value = (utc(2000, 1, 1, 23), utc(2000, 1, 3, 1))
+    # late in the UTC day is the next solar day in eastern Australia
+    index.datasets.search_returning.return_value = [row(Range(utc(2000, 1, 1, 23), utc(2000, 1, 1, 23))),
+                                                    row(Range(utc(2000, 1, 2, 1), utc(2000, 1, 2, 1))),
+                                                    row(Range(utc(2000, 1, 3, 1), utc(2000, 1, 3, 1)))]
+    geopolygon = box(149, -36, 151, -35, CRS('EPSG:4326'))
+    cache = DatasetQueryCache(tmpdir.join('cache.sqlite'))
+
+    def find_periods():
+        return list(_find_periods_with_data(index, ['nbar', 'pq'], '2000-01-01', '2000-02-01',
+                                            geopolygon=geopolygon, cache=cache))
+
+    assert find_periods() == [(utc(2000, 1, 1, 14), utc(2000, 1, 2, 14)),
+                              (utc(2000, 1, 2, 14), utc(2000, 1, 3, 14))]
+    assert index.datasets.search_returning.call_count == 1
+    assert index.datasets.search_returning.call_args[1]['product'] == ['nbar', 'pq']
+
+    assert len(find_periods()) == 2
+    assert index.datasets.search_returning.call_count == 1
+
+    index.datasets.count.return_value = 4
+    find_periods()
+    assert index.datasets.search_returning.call_count == 2
+
+    assert len(list(_find_periods_with_data(index, ['nbar'], '2000-01-01', '2000-02-01'))) == 3
+
+
+def _fail_on_odd_numbers(number):
+    import os
+    if number % 2 == 1:
+        raise ValueError('odd number')
+    return os.getpid()
+
+
+def test_process_pool_runner_counts_successful_and_failed_tasks():
+    from datacube_stats.utils.process_runner import ProcessPoolRunner
+
+    consumed = []
+
+    def tasks():
+        for number in range(9):
+            consumed.append(number)
+            yield number
+
+    runner = ProcessPoolRunner(workers=2, tasks_per_worker=1)
+    assert runner.max_pending == 4
+    assert runner(tasks(), _fail_on_odd_numbers) == (5, 4)
+    assert consumed == list(range(9))